@@ -100,7 +100,8 @@ def str_highlight_day(day, devents, hmethod, default_color, multiple, color, bol
 
 def str_week(week, today, collection=None,
              hmethod=None, default_color=None, multiple=None, color=None,
-             highlight_event_days=False, locale=None, bold_for_light_color=True):
+             highlight_event_days=False, locale=None, bold_for_light_color=True,
+             day_calendars=None):
     """returns a string representing one week,
     if for day == today colour is reversed
 
@@ -108,16 +109,22 @@ def str_week(week, today, collection=None,
     :type day: list()
     :param today: the date of today
     :type today: datetime.date
+    :param day_calendars: the calendars with events on each day (as returned
+                          by `CalendarCollection.get_calendars_between`),
+                          looked up for this week if not given
+    :type day_calendars: dict(datetime.date, list())
     :return: string, which if printed on terminal appears to have length 20,
              but may contain ascii escape sequences
     :rtype: str
     """
     strweek = ''
+    if highlight_event_days and day_calendars is None:
+        day_calendars = dict(collection.get_calendars_between(week[0], week[-1]))
     for day in week:
         if day == today:
             day = style(str(day.day).rjust(2), reverse=True)
         elif highlight_event_days:
-            devents = list(collection.get_events_on(day, minimal=True))
+            devents = day_calendars[day]
             if len(devents) > 0:
                 day = str_highlight_day(day, devents, hmethod, default_color,
                                         multiple, color, bold_for_light_color)
@@ -170,11 +177,24 @@ def vertical_month(month=datetime.date.today().month,
     weekheaders = get_weekheader(firstweekday)
     khal.append(style('    ' + weekheaders + ' ' + w_number, bold=True))
     _calendar = calendar.Calendar(firstweekday)
+    months = list()
     for _ in range(count):
-        for week in _calendar.monthdatescalendar(year, month):
+        months.append(_calendar.monthdatescalendar(year, month))
+        month = month + 1
+        if month > 12:
+            month = 1
+            year = year + 1
+    if highlight_event_days:
+        # all days shown are looked up at once
+        day_calendars = dict(collection.get_calendars_between(months[0][0][0], months[-1][-1][-1]))
+    else:
+        day_calendars = None
+    for weeks in months:
+        for week in weeks:
             new_month = len([day for day in week if day.day == 1])
             strweek = str_week(week, today, collection, hmethod, default_color,
-                               multiple, color, highlight_event_days, locale, bold_for_light_color)
+                               multiple, color, highlight_event_days, locale, bold_for_light_color,
+                               day_calendars)
             if new_month:
                 m_name = style(month_abbr(week[6].month).ljust(4), bold=True)
             elif weeknumber == 'left':
@@ -189,8 +209,4 @@ def vertical_month(month=datetime.date.today().month,
             sweek = m_name + strweek + w_number
             if sweek != khal[-1]:
                 khal.append(sweek)
-        month = month + 1
-        if month > 12:
-            month = 1
-            year = year + 1
     return khal
@@ -19,7 +19,10 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 #
+import io
 import logging
+import os
+import signal
 import sys
 import textwrap
 from shutil import get_terminal_size
@@ -31,11 +34,12 @@ except ImportError:
         pass
 
 import click
-import pytz
 
-from khal import aux, controllers, khalendar, __version__
+# everything needed for parsing the events (icalendar, pytz, vdirsyncer, the
+# db, ...) is imported by the commands which need it, so that commands which
+# only need the configuration (or not even that, e.g. `--help`) start faster
+from khal import __version__
 from khal.log import logger
-from khal.settings import get_config, InvalidSettingsError
 from khal.exceptions import FatalError
 from .terminal import colored
 
@@ -145,9 +149,13 @@ def global_options(f):
 
 
 def build_collection(ctx):
+    from khal import daemon, khalendar
+
     try:
         conf = ctx.obj['conf']
         selection = ctx.obj.get('calendar_selection', None)
+        if selection is None and 'collection' in ctx.obj:  # see `answer()`
+            return ctx.obj['collection']
 
         props = dict()
         for name, cal in conf['calendars'].items():
@@ -164,6 +172,14 @@ def build_collection(ctx):
             color=ctx.obj['conf']['highlight_days']['color'],
             locale=ctx.obj['conf']['locale'],
             dbpath=conf['sqlite']['path'],
+            horizon=conf['sqlite']['horizon'],
+            timeout=conf['sqlite']['timeout'],
+            retries=conf['sqlite']['retries'],
+            read_threads=conf['sqlite']['read_threads'],
+            parse_processes=conf['sqlite']['parse_processes'],
+            shards=conf['sqlite']['shards'],
+            store_items=conf['sqlite']['store_items'],
+            update=not daemon.is_running(conf['sqlite']['path']),
             hmethod=ctx.obj['conf']['highlight_days']['method'],
             default_color=ctx.obj['conf']['highlight_days']['default_color'],
             multiple=ctx.obj['conf']['highlight_days']['multiple'],
@@ -178,7 +194,9 @@ def build_collection(ctx):
 
 
 def prepare_context(ctx, config):
-    assert ctx.obj is None
+    if ctx.obj is not None:  # already prepared by `khal daemon`, see `answer()`
+        return
+    from khal.settings import get_config, InvalidSettingsError
 
     ctx.obj = {}
     try:
@@ -194,6 +212,67 @@ def prepare_context(ctx, config):
         raise click.UsageError('Invalid config file, exiting.')
 
 
+def _served_command(cli, conf, argv):
+    """the name of the command khal would run for `argv`, as parsed by click,
+    or None if it cannot be run with the daemon's configuration (e.g. because
+    another one is requested) or `argv` cannot be parsed"""
+    ctx = click.Context(cli, info_name='khal', resilient_parsing=True)
+    try:
+        opts, args, _ = cli.make_parser(ctx).parse_args(list(argv))
+        if opts.get('config') is not None:
+            return None
+        if not args:
+            return conf['default']['default_command']
+        command, _, _ = cli.resolve_command(ctx, args)
+    except click.ClickException:
+        return None
+    return command
+
+
+def answer(cli, conf, collection, request):
+    """run khal as requested by `khalc`, with an already loaded configuration
+    and collection
+
+    :param request: see `client.request()`
+    :type request: dict
+    :returns: the exit status and output on stdout and stderr, or None if the
+        command cannot be run here
+    :rtype: tuple(int, bytes, bytes) or None
+    """
+    from khal import client
+
+    argv = request['argv']
+    if request['version'] != __version__ or \
+            _served_command(cli, conf, argv) not in client.SERVED_COMMANDS:
+        return None
+    out, err = io.BytesIO(), io.BytesIO()
+    status = 0
+    streams = sys.stdout, sys.stderr
+    environ = dict(os.environ)
+    level = logger.level  # -v must not stick
+    wrappers = [io.TextIOWrapper(stream, encoding=request['encoding'], write_through=True)
+                for stream in (out, err)]
+    sys.stdout, sys.stderr = wrappers
+    # for get_terminal_size()
+    os.environ['COLUMNS'], os.environ['LINES'] = str(request['columns']), str(request['lines'])
+    try:
+        cli.main(argv, prog_name='khal', color=request['color'],
+                 obj={'conf': conf, 'collection': collection})
+    except SystemExit as exit:
+        status = exit.code
+    finally:
+        sys.stdout, sys.stderr = streams
+        for wrapper in wrappers:
+            wrapper.detach()  # instead of closing `out` and `err` later
+        os.environ.clear()
+        os.environ.update(environ)
+        logger.setLevel(level)
+    if status is not None and not isinstance(status, int):  # sys.exit('message')
+        err.write('{0}\n'.format(status).encode(request['encoding']))
+        status = 1
+    return status or 0, out.getvalue(), err.getvalue()
+
+
 def stringify_conf(conf):
     # since we have only two levels of recursion, a recursive function isn't
     # really worth it
@@ -236,6 +315,8 @@ def _get_cli():
                   is_flag=True)
     def calendar(ctx, days, events, dates, full=False):
         '''Print calendar with agenda.'''
+        from khal import controllers
+
         controllers.calendar(
             build_collection(ctx),
             date=dates,
@@ -263,6 +344,8 @@ def _get_cli():
                   is_flag=True)
     def agenda(ctx, days, events, dates, full=False):
         '''Print agenda.'''
+        from khal import controllers
+
         controllers.agenda(
             build_collection(ctx),
             date=dates,
@@ -299,6 +382,8 @@ def _get_cli():
         assumed to be the event's summary, if two colons (::) are present,
         everything behind them is taken as the event's description.
         '''
+        from khal import controllers
+
         # ugly hack to change how click presents the help string
         eventlist = [start, end, timezone, summary] + list(description)
         eventlist = [element for element in eventlist if element is not None]
@@ -336,6 +421,8 @@ def _get_cli():
         each calendar's name or any unique prefix of a calendar's name.
 
         '''
+        from khal import controllers
+
         ics_str = ics.read()
         controllers.import_ics(
             build_collection(ctx),
@@ -350,6 +437,8 @@ def _get_cli():
     @click.pass_context
     def interactive(ctx):
         '''Interactive UI. Also launchable via `ikhal`.'''
+        from khal import controllers
+
         controllers.interactive(build_collection(ctx), ctx.obj['conf'])
 
     @click.command()
@@ -358,14 +447,52 @@ def _get_cli():
     @click.pass_context
     def interactive_cli(ctx):
         '''Interactive UI. Also launchable via `khal interactive`.'''
+        from khal import controllers
+
         controllers.interactive(build_collection(ctx), ctx.obj['conf'])
 
+    @cli.command('daemon')
+    @click.option('--interval', type=int,
+                  help=('How often to check for changes (in seconds), if they '
+                        'cannot be watched (needs pyinotify), default: 10.'))
+    @click.option('--serve', is_flag=True,
+                  help=('Also run agenda, at, calendar and search for khalc.'))
+    @click.pass_context
+    def daemon_cmd(ctx, interval, serve):
+        '''Keep the database up to date in the background.
+
+        While the daemon is running, other khal commands start faster as they
+        do not need to check all vdirs for changes. With --serve, `khalc` can
+        ask the daemon to run some commands, which saves starting khal at all.
+        '''
+        from khal import daemon
+
+        conf = ctx.obj['conf']
+        if interval is None:
+            interval = daemon.POLL_INTERVAL
+        # clean up when stopped by e.g. the init system
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            collection = build_collection(ctx)
+            serving = None if not serve else \
+                lambda request: answer(cli, conf, collection, request)
+            daemon.run(collection, conf['sqlite']['path'], interval, answer=serving)
+        except FatalError as error:
+            logger.fatal(error)
+            sys.exit(1)
+        except KeyboardInterrupt:
+            pass
+
     @cli.command()
     @multi_calendar_option
     @click.pass_context
     def printcalendars(ctx):
         '''List all calendars.'''
-        click.echo('\n'.join(build_collection(ctx).names))
+        conf = ctx.obj['conf']
+        selection = ctx.obj.get('calendar_selection', None)
+        # no need to open (or update) the db for this
+        click.echo('\n'.join(name for name in conf['calendars']
+                             if selection is None or name in selection))
 
     @cli.command()
     @click.pass_context
@@ -420,6 +547,9 @@ def _get_cli():
         for this moment are shown, if only a time is given, the date is assumed
         to be today
         '''
+        import pytz
+        from khal import aux
+
         collection = build_collection(ctx)
         locale = ctx.obj['conf']['locale']
         dtime_list = list(datetime)
@@ -0,0 +1,105 @@
+# Copyright (c) 2013-2016 Christian Geier et al.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""a thin client for `khal daemon --serve`
+
+Starting khal takes a lot longer than running most of its commands, so
+`khalc` hands its arguments to a running `khal daemon --serve` and prints
+what it answers. If no daemon is serving (or it cannot run the command),
+khal is run as usual.
+
+This module is imported on every call of `khalc`, so it must stay cheap to
+import, i.e. only import from the standard library.
+
+The daemon answers each request (a line of JSON) with a line of JSON, either
+`{"fallback": true}` or the exit status and the lengths of the output on
+stdout and stderr, followed by that output.
+"""
+import json
+import os
+import shutil
+import socket
+import sys
+
+from khal import __version__
+
+# commands the daemon runs, they only read from the db
+SERVED_COMMANDS = ('agenda', 'at', 'calendar', 'search')
+
+
+def socket_path():
+    """where `khal daemon --serve` listens"""
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or os.environ.get('TMPDIR', '/tmp')
+    return os.path.join(runtime_dir, 'khal-{0}.socket'.format(os.getuid()))
+
+
+def request(argv, path=None):
+    """ask the daemon listening at `path` to run khal with `argv`
+
+    :returns: the exit status and output on stdout and stderr, or None if khal
+        needs to be run in this process
+    :rtype: tuple(int, bytes, bytes) or None
+    """
+    if any(arg in ('-c', '--config') or arg.startswith('--config=') for arg in argv):
+        # the daemon only knows its own configuration
+        return None
+    path = path or socket_path()
+    try:
+        if os.stat(path).st_uid != os.getuid():
+            return None
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    except (AttributeError, OSError):  # no daemon or no unix sockets
+        return None
+    columns, lines = shutil.get_terminal_size()
+    message = {
+        'version': __version__,
+        'argv': argv,
+        'color': sys.stdout.isatty(),
+        'encoding': sys.stdout.encoding or 'utf-8',
+        'columns': columns,
+        'lines': lines,
+    }
+    try:
+        with conn:
+            conn.connect(path)
+            conn.sendall(json.dumps(message).encode('utf-8') + b'\n')
+            with conn.makefile('rb') as response:
+                header = json.loads(response.readline().decode('utf-8'))
+                if header.get('fallback'):
+                    return None
+                out = response.read(header['stdout'])
+                err = response.read(header['stderr'])
+    except (OSError, ValueError, KeyError):  # e.g. the daemon just stopped
+        return None
+    return header['status'], out, err
+
+
+def main():
+    answer = request(sys.argv[1:])
+    if answer is None:
+        from khal.cli import main_khal
+        main_khal(prog_name='khal')
+    status, out, err = answer
+    sys.stdout.buffer.write(out)
+    sys.stdout.flush()
+    sys.stderr.buffer.write(err)
+    sys.stderr.flush()
+    sys.exit(status)
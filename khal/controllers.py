@@ -35,7 +35,7 @@ import textwrap
 from khal import aux, calendar_display
 from khal.khalendar.exceptions import ReadOnlyCalendarError, DuplicateUid
 from khal.exceptions import InvalidDate, FatalError
-from khal.khalendar.event import Event
+from khal.khalendar.event import Event, create_timezone, used_timezones
 from khal.khalendar.backend import sort_key
 from khal import __version__, __productname__
 from khal.log import logger
@@ -61,6 +61,23 @@ def construct_daynames(daylist, longdateformat):
             yield (date, date.strftime(longdateformat))
 
 
+def consecutive_ranges(daylist):
+    """group a sorted list of dates into ranges of consecutive dates
+
+    :param daylist: sorted list of dates without duplicates
+    :type daylist: list(datetime.date)
+    :returns: first and last date of each range
+    :rtype: list((datetime.date, datetime.date))
+    """
+    ranges = list()
+    for date in daylist:
+        if ranges and ranges[-1][1] + datetime.timedelta(days=1) == date:
+            ranges[-1] = (ranges[-1][0], date)
+        else:
+            ranges.append((date, date))
+    return ranges
+
+
 def get_agenda(collection, locale, dates=None, firstweekday=0, days=None, events=None, width=45,
                full=False, show_all_days=False, bold_for_light_color=True):
     """returns a list of events scheduled for all days in daylist
@@ -100,10 +117,27 @@ def get_agenda(collection, locale, dates=None, firstweekday=0, days=None, events
                    for one in range(days) for date in dates]
         daylist.sort()
 
-    daylist = construct_daynames(daylist, locale['longdateformat'])
+    events_per_day = dict()
+    for start, end in consecutive_ranges(sorted(set(daylist))):
+        events_per_day.update(collection.get_events_between(start, end))
+
+    daylist = list(construct_daynames(daylist, locale['longdateformat']))
+
+    def render(event, day):
+        lines = list()
+        items = event.relative_to(day, full).splitlines()
+        for item in items:
+            lines += textwrap.wrap(item, width)
+        return [colored(line, event.color, bold_for_light_color=bold_for_light_color)
+                for line in lines]
+
+    # the lines of most events are the same as last time
+    rendered = iter(collection.rendered(
+        [(day, event) for day, _ in daylist for event in events_per_day[day]], render,
+        width=width, full=full, bold_for_light_color=bold_for_light_color))
 
     for day, dayname in daylist:
-        events = sorted(collection.get_events_on(day))
+        events = events_per_day[day]
         if not events and not show_all_days:
             continue
 
@@ -111,14 +145,7 @@ def get_agenda(collection, locale, dates=None, firstweekday=0, days=None, events
             event_column.append('')
         event_column.append(style(dayname, bold=True))
         for event in events:
-            lines = list()
-            items = event.relative_to(day, full).splitlines()
-            for item in items:
-                lines += textwrap.wrap(item, width)
-            event_column.extend(
-                [colored(line, event.color, bold_for_light_color=bold_for_light_color)
-                 for line in lines]
-            )
+            event_column.extend(next(rendered))
 
     if event_column == []:
         event_column = [style('No events', bold=True)]
@@ -266,13 +293,26 @@ def import_event(vevent, collection, locale, batch, random_uid):
 
     if batch or confirm(u"Do you want to import this event into `{}`?"
                         u"".format(calendar_name)):
-        ics = aux.ics_from_list(vevent, random_uid)
+        if random_uid:
+            uid = icalendar.vText(aux.generate_random_uid())
+            for sub_event in vevent:
+                sub_event['uid'] = uid
+        if any('RECURRENCE-ID' not in sub_event for sub_event in vevent):
+            # the collection can save the already parsed VEVENTs without
+            # parsing them again, Event.raw includes their VTIMEZONEs
+            event = Event.fromVEvents(list(vevent), calendar=calendar_name, locale=locale)
+        else:
+            # without a proto event (only overwritten instances) there is no
+            # Event, the text is saved instead
+            ics = aux.ics_from_list(vevent)
+            for tzinfo in used_timezones(vevent):
+                ics.add_component(create_timezone(tzinfo, vevent[0]['DTSTART'].dt))
+            event = Item(ics.to_ical().decode('utf-8'))
         try:
-            collection.new(Item(ics.to_ical().decode('utf-8')), collection=calendar_name)
+            collection.new(event, collection=calendar_name)
         except DuplicateUid:
             if batch or confirm(u"An event with the same UID already exists. "
                                 u"Do you want to update it?"):
-                collection.force_update(
-                    Item(ics.to_ical().decode('utf-8')), collection=calendar_name)
+                collection.force_update(event, collection=calendar_name)
             else:
-                logger.warn(u"Not importing event with UID `{}`".format(event.uid))
+                logger.warn(u"Not importing event with UID `{}`".format(vevent[0]['UID']))
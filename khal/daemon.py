@@ -0,0 +1,283 @@
+# Copyright (c) 2013-2016 Christian Geier et al.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""keeping the database up to date in the background, see `khal daemon`
+
+While the daemon runs, it holds an exclusive lock on a file next to the
+database (see :func:`lock_path`), so other khal instances can find out if they
+need to update the database themselves.
+
+With `--serve`, the daemon also runs some commands for `khalc` (see
+:mod:`khal.client`) with its already loaded configuration and db.
+"""
+import contextlib
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+from .client import socket_path
+from .exceptions import FatalError
+from .log import logger
+
+# how often the vdirs are checked for changes if they cannot be watched
+POLL_INTERVAL = 10
+# changes are collected until nothing changed for this long (in seconds), e.g.
+# while vdirsyncer is writing many files
+SETTLE_TIME = 0.5
+# requests are answered one after another, clients which don't send their
+# request (or read the answer) within this many seconds are dropped
+REQUEST_TIMEOUT = 5
+
+
+class DaemonRunning(FatalError):
+
+    """another daemon is already keeping this database up to date"""
+
+
+def lock_path(db_path):
+    """the file a daemon keeping the db at `db_path` up to date locks"""
+    return db_path + '.daemon'
+
+
+def is_running(db_path):
+    """check if a daemon is keeping the db at `db_path` up to date
+
+    :rtype: bool
+    """
+    if db_path is None or db_path == ':memory:' or fcntl is None:
+        return False
+    try:
+        lockfile = open(lock_path(db_path), 'r')
+    except (IOError, OSError):  # no daemon has ever run
+        return False
+    with lockfile:
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            return True
+        fcntl.flock(lockfile, fcntl.LOCK_UN)
+        return False
+
+
+@contextlib.contextmanager
+def running(db_path):
+    """mark the daemon for the db at `db_path` as running while in this
+    context
+
+    :raises DaemonRunning: if another one is running already
+    """
+    if fcntl is None:
+        raise FatalError('khal daemon is not supported on this platform')
+    with open(lock_path(db_path), 'a') as lockfile:
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            raise DaemonRunning(
+                'khal daemon is already running for {0}'.format(db_path))
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def watch(paths, interval=POLL_INTERVAL):
+    """wait for changes to the vdirs in `paths`
+
+    The vdirs are watched with inotify if pyinotify is available, otherwise
+    they are assumed to have changed every `interval` seconds.
+
+    :param paths: the paths of the vdirs by calendar
+    :type paths: dict(str, str)
+    :returns: the calendars whose vdirs changed, whenever some did
+    :rtype: generator of list(str)
+    """
+    if pyinotify is None:
+        logger.info('pyinotify is not installed, checking for changes every {0} '
+                    'seconds'.format(interval))
+        return _poll(paths, interval)
+    return _inotify(paths)
+
+
+def _poll(paths, interval):
+    while True:
+        time.sleep(interval)
+        yield sorted(paths)
+
+
+def _inotify(paths):
+    changed = set()
+
+    class Changes(pyinotify.ProcessEvent):
+        def process_default(self, event):
+            changed.add(event.path)
+
+    manager = pyinotify.WatchManager()
+    mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM |
+            pyinotify.IN_DELETE | pyinotify.IN_ATTRIB)
+    for path in paths.values():
+        manager.add_watch(path, mask)
+    notifier = pyinotify.Notifier(manager, Changes(), timeout=int(SETTLE_TIME * 1000))
+    try:
+        while True:
+            if notifier.check_events():
+                notifier.read_events()
+                notifier.process_events()
+            elif changed:
+                yield sorted(calendar for calendar, path in paths.items()
+                             if path.rstrip('/') in changed)
+                changed.clear()
+    finally:
+        notifier.stop()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    timeout = REQUEST_TIMEOUT
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            answer = self.server.answer(request)
+        except socket.timeout:
+            logger.warning('dropping a client which did not send its request in time')
+            return
+        except Exception:
+            logger.exception('could not answer request')
+            answer = None
+        if answer is None:
+            header, out, err = {'fallback': True}, b'', b''
+        else:
+            status, out, err = answer
+            header = {'status': status, 'stdout': len(out), 'stderr': len(err)}
+        try:
+            self.wfile.write(json.dumps(header).encode('utf-8') + b'\n' + out + err)
+        except socket.timeout:
+            logger.warning('dropping a client which did not read its answer in time')
+
+
+class _Server(socketserver.UnixStreamServer):
+
+    timeout = SETTLE_TIME
+
+    def __init__(self, path, answer):
+        self.answer = answer
+        # only we may connect
+        umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, _Handler)
+        finally:
+            os.umask(umask)
+
+    def handle_timeout(self):
+        pass
+
+
+@contextlib.contextmanager
+def _serving(path, answer):
+    """listen at `path` (if nobody else is) while in this context
+
+    :returns: the server or None
+    """
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:  # left over from a daemon that was killed
+            os.remove(path)
+        else:
+            logger.warning('another khal daemon is already serving at {0}, not '
+                           'serving'.format(path))
+            yield None
+            return
+        finally:
+            probe.close()
+    server = _Server(path, answer)
+    logger.info('serving at {0}'.format(path))
+    try:
+        yield server
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+@contextlib.contextmanager
+def _not_serving():
+    yield None
+
+
+def _forward(changes, updates):
+    for calendars in changes:
+        updates.put(calendars)
+    updates.put(None)
+
+
+def run(collection, db_path, interval=POLL_INTERVAL, answer=None, path=None):
+    """keep the db at `db_path` of `collection` up to date, until interrupted
+
+    If `answer` is given, requests of `khalc` are answered with it in between
+    updating the db.
+
+    :type collection: khalendar.CalendarCollection
+    :param answer: called with each request, returns the exit status, stdout
+        and stderr of khal or None, if khal should run in the client
+    :type answer: callable(dict)
+    :param path: where to listen for requests, see `client.socket_path()`
+    """
+    with running(db_path):
+        # changes made before we were running might not have been noticed
+        collection.update_db()
+        paths = dict((calendar['name'], calendar['path']) for calendar in collection.calendars)
+        logger.info('keeping {0} up to date'.format(db_path))
+        # the changes are waited for in another thread, so all access to the
+        # db happens in this one
+        updates = queue.Queue()
+        watcher = threading.Thread(target=_forward, args=(watch(paths, interval), updates))
+        watcher.daemon = True
+        watcher.start()
+        serving = _serving(path or socket_path(), answer) if answer else _not_serving()
+        with serving as server:
+            while True:
+                if server is None:
+                    calendars = updates.get()
+                else:
+                    server.handle_request()
+                    try:
+                        calendars = updates.get_nowait()
+                    except queue.Empty:
+                        continue
+                if calendars is None:
+                    return
+                logger.debug('updating {0}'.format(', '.join(calendars)))
+                collection.update_db(calendars)
@@ -12,7 +12,14 @@ from .exceptions import UnsupportedRecursion
 logger = log.logger
 
 
-def expand(vevent, href=''):
+def is_unbounded(vevent):
+    """returns True if `vevent` recurs forever (has an RRULE without UNTIL and
+    COUNT)"""
+    return 'RRULE' in vevent and \
+        not set(['UNTIL', 'COUNT']).intersection(vevent['RRULE'].keys())
+
+
+def expand(vevent, href='', since=None, until=None):
     """
     Constructs a list of start and end dates for all recurring instances of the
     event defined in vevent.
@@ -22,11 +29,20 @@ def expand(vevent, href=''):
     If the timezone defined in vevent is not understood by icalendar,
     default_tz is used.
 
+    Instances of RRULEs without UNTIL and COUNT are only calculated between
+    `since` and `until` (if given), all other instances are always returned.
+
     :param vevent: vevent to be expanded
     :type vevent: icalendar.cal.Event
     :param href: the href of the vevent, used for more informative logging and
                  nothing else
     :type href: str
+    :param since: expand unbounded RRULEs starting from here, in the event's
+                  (naive) local time
+    :type since: datetime.datetime or None
+    :param until: expand unbounded RRULEs up to here, in the event's (naive)
+                  local time, defaults to the end of 2037
+    :type until: datetime.datetime or None
     :returns: list of start and end (date)times of the expanded event
     :rtyped list(tuple(datetime, datetime))
     """
@@ -54,12 +70,12 @@ def expand(vevent, href=''):
         rrulestr = vevent['RRULE'].to_ical().decode()
         rrule = dateutil.rrule.rrulestr(rrulestr, dtstart=vevent['DTSTART'].dt)
 
-        if not set(['UNTIL', 'COUNT']).intersection(vevent['RRULE'].keys()):
+        unbounded = is_unbounded(vevent)
+        if unbounded:
             # rrule really doesn't like to calculate all recurrences until
-            # eternity, so we only do it until 2037, because a) I'm not sure
-            # if python can deal with larger datetime values yet and b) pytz
-            # doesn't know any larger transition times
-            rrule._until = datetime(2037, 12, 31)
+            # eternity, so we only do it until `until` (the caller extends
+            # that as needed) or, by default, until 2037
+            rrule._until = until or datetime(2037, 12, 31)
 
         if getattr(rrule._until, 'tzinfo', False):
             rrule._until = rrule._until.astimezone(events_tz)
@@ -67,9 +83,15 @@ def expand(vevent, href=''):
 
         logger.debug('calculating recurrence dates for {0}, '
                      'this might take some time.'.format(href))
-        dtstartl = list(rrule)
-        if len(dtstartl) == 0:
-            raise UnsupportedRecursion
+        if unbounded and since is not None:
+            dtstartl = rrule.between(since, rrule._until, inc=True)
+        else:
+            dtstartl = list(rrule)
+        if len(dtstartl) == 0 and since is None:
+            # an empty window doesn't mean that there are no instances at all
+            rrule._until = max(rrule._until, datetime(2037, 12, 31))
+            if rrule.after(vevent['DTSTART'].dt, inc=True) is None:
+                raise UnsupportedRecursion
     else:
         dtstartl = [vevent['DTSTART'].dt]
 
@@ -31,24 +31,43 @@ note on naming:
 # TODO remove creating Events from SQLiteDb
 # we currently expect str/CALENDAR objects but return Event(), we should
 # accept and return the same kind of events
+from calendar import isleap
+from collections import Counter, namedtuple
 import contextlib
-from datetime import datetime, timedelta
-from os import makedirs, path
+import copy
+from datetime import date, datetime, time, timedelta
+from functools import partial
+import heapq
+from itertools import count
+import json
+from os import fstat, getpid, makedirs, path, replace
 import sqlite3
+from time import sleep
+from urllib.parse import quote
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
 
 from dateutil import parser
 import icalendar
 import pytz
+from vdirsyncer.utils import get_etag_from_file
 import xdg.BaseDirectory
 
-from .event import Event, EventStandIn
+from .event import Event, EventStandIn, LightEvent, vevents_by_ref
 from . import aux
 from .. import log
-from .exceptions import CouldNotCreateDbDir, OutdatedDbVersionError, UpdateFailed
+from .exceptions import ChangedFileError, CouldNotCreateDbDir, OutdatedDbVersionError, \
+    UpdateFailed
 
 logger = log.logger
 
-DB_VERSION = 5  # The current db layout version
+DB_VERSION = 14  # The current db layout version
+# dbs with older layouts cannot be migrated and are rebuilt from the vdirs
+FIRST_MIGRATABLE_VERSION = 5
 
 RECURRENCE_ID = 'RECURRENCE-ID'
 THISANDFUTURE = 'THISANDFUTURE'
@@ -59,6 +78,50 @@ DATETIME = 1
 
 PROTO = 'PROTO'
 
+# items are compressed with a preset dictionary (see `train_zdict`), which is
+# trained on up to ZDICT_SAMPLES items once there are ZDICT_MIN_ITEMS of them
+ZDICT_MIN_ITEMS = 16
+ZDICT_SAMPLES = 256
+ZDICT_SIZE = 32 * 1024  # zlib doesn't look further back than this
+
+# how many search results are fetched from the db at once
+SEARCH_PAGE_SIZE = 100
+
+# the year birthdays without one (--MMDD) are saved with, a leap year, so
+# February 29th can be parsed, and early enough for them to show up in any year
+BDAY_NO_YEAR = 1604
+# how many rows `SQLiteDb.sql_stream` fetches from the db at once
+STREAM_PAGE_SIZE = 100
+
+# an instance overlaps with the time range [start, end] if it starts before
+# that range ends and ends after that range starts (instances without a
+# duration if they start within that range), this is the only test we use for
+# range queries, as SQLite can answer it from the (calendar, dtstart) or
+# (calendar, dtend) indexes, bind (end, start, start)
+OVERLAPS = 'dtstart <= ? AND dtend >= ? AND (dtend > ? OR dtstart = dtend)'
+
+# SQLite attaches at most 10 dbs to a connection (unless compiled otherwise),
+# if more calendars are in use, the events of the others are kept in the
+# (unsharded) db itself, see `SQLiteDb`
+MAX_SHARDS = 10
+
+
+# the lines printed for an instance of an event on some day (e.g. in the
+# agenda), for the `settings` (a hash of the locale, the width of the lines
+# etc.) they were rendered with, they are only reused as long as the event's
+# etag and color have not changed, see `SQLiteDb.get_rendered`
+RENDERED_TABLE = '''CREATE TABLE IF NOT EXISTS rendered (
+    calendar_id INT NOT NULL,
+    day INT NOT NULL,
+    settings TEXT NOT NULL,
+    href TEXT NOT NULL,
+    instance TEXT NOT NULL,
+    etag TEXT,
+    color TEXT,
+    lines TEXT NOT NULL,
+    primary key (calendar_id, day, settings, href, instance)
+    ) WITHOUT ROWID;'''
+
 
 def sort_key(vevent):
     # insert the (sub) events in the right order, e.g. recurrence-id events
@@ -75,6 +138,23 @@ def sort_key(vevent):
         return uid, 1
 
 
+def _ref(ref):
+    """the ref of an event (see :func:`vevents_by_ref`) from its ref as
+    saved in the db"""
+    return PROTO if ref is None else str(ref)
+
+
+def shard_path(db_path, calendar):
+    """where the events of `calendar` are kept if the db at `db_path` is
+    sharded
+
+    Shards have the same layout as the unsharded db (including the calendar
+    columns, which only ever hold one calendar there), so all statements work
+    on both and a calendar's events can be kept in either.
+    """
+    return '{0}.shards/{1}.db'.format(db_path, quote(calendar, safe=''))
+
+
 class SQLiteDb(object):
     """
     This class should provide a caching database for a calendar, keeping raw
@@ -89,39 +169,260 @@ class SQLiteDb(object):
                     None, a place according to the XDG specifications will be
                     chosen
     :type db_path: str or None
+    :param horizon: instances of events recurring forever are saved up to
+                    this many days in the future, the horizon is extended as
+                    soon as events further in the future are requested
+    :type horizon: int
+    :param timeout: how long to wait (in seconds) for other processes to
+                    finish writing to the db
+    :type timeout: float
+    :param retries: how often to retry statements which failed because the
+                    database was locked anyway
+    :type retries: int
+    :param shards: keep the events of each calendar in a db of its own (see
+                   :func:`shard_path`), which are attached to an in-memory db,
+                   only the shards of `calendars` are ever opened, but no
+                   more than MAX_SHARDS of them (the first ones in sorted
+                   order), the events of the other calendars are kept in the
+                   db at `db_path`
+    :type shards: bool
+    :param vdirs: the paths of the vdirs of those calendars whose events are
+                  not saved in the db but read from their files when needed
+    :type vdirs: dict(str, str)
     """
 
-    def __init__(self, calendars, db_path, locale):
+    def __init__(self, calendars, db_path, locale, horizon=365, timeout=5.0, retries=3,
+                 shards=False, vdirs=None):
         if db_path is None:
             db_path = xdg.BaseDirectory.save_data_path('khal') + '/khal.db'
         self.calendars = calendars
         self.db_path = path.expanduser(db_path)
         self._create_dbdir()
         self.locale = locale
+        self._vdirs = vdirs or dict()
+        # the ids of the calendars in their calendars table, see `_calendar_id`
+        self._calendar_ids = dict()
+        # the schema holding each calendar's tables, see `_schema`
+        self._schemas = dict()
+        # the preset dictionary for compressing the items in each schema (or
+        # None), see `_zdict`, and all dictionaries by schema and id
+        self._zdicts = dict()
+        self._zdicts_by_id = dict()
+        if shards and self.db_path != ':memory:':
+            self._schemas = dict(
+                (calendar, 'shard_{0}'.format(num))
+                for num, calendar in enumerate(sorted(self.calendars)[:MAX_SHARDS]))
         self._at_once = False
-        self.conn = sqlite3.connect(self.db_path)
-        self.cursor = self.conn.cursor()
+        self.horizon = timedelta(days=horizon)
+        # all events in `calendars` are expanded at least until this (unix)
+        # time, None if unknown
+        self._expanded_until = None
+        self.retries = retries
+        self._timeout = timeout
+        # where the db is being rebuilt, see `finish_rebuild`
+        self._rebuild_path = None
+        if self._schemas:
+            self._attach_shards(horizon)
+            return
+        self._connect(self.db_path)
+        version = self._get_version()
+        if version is not None and version < FIRST_MIGRATABLE_VERSION:
+            self._rebuild_path = '{0}.rebuild.{1}'.format(self.db_path, getpid())
+            logger.warning('{0} is too old to be upgraded, it is rebuilt now'.format(
+                self.db_path))
+            self.conn.close()
+            self._connect(self._rebuild_path)
+        elif version is not None and version < DB_VERSION:
+            self._migrate(version)
         self._create_default_tables()
         self._check_calendars_exists()
         self._check_table_version()
+        self._drop_referenced_items()
+        self._connect_readonly(self._rebuild_path or self.db_path)
+
+    def _connect(self, db_path):
+        """open the (default) connection to the db at `db_path`"""
+        self.conn = sqlite3.connect(db_path, timeout=self._timeout)
+        self.cursor = self.conn.cursor()
+        if db_path != ':memory:':
+            # with a write-ahead log readers and writers don't block each other
+            self.sql_ex('PRAGMA journal_mode=WAL;')
+
+    def _connect_readonly(self, db_path):
+        """open a read-only connection for queries, or use the default
+        connection if that is not possible"""
+        self.query_conn = self.conn
+        if db_path != ':memory:':
+            uri = 'file:{0}?mode=ro'.format(quote(db_path))
+            try:
+                self.query_conn = sqlite3.connect(uri, timeout=self._timeout, uri=True)
+            except TypeError:  # python 3.3 doesn't know URIs yet
+                pass
+        self.query_cursor = self.query_conn.cursor()
+
+    def _attach_shards(self, horizon):
+        """create (or upgrade) the shards of all calendars and attach them to
+        in-memory dbs (or to the db at `db_path`, if it keeps the events of the
+        calendars without a shard), read-only for queries if possible"""
+        unsharded = [calendar for calendar in self.calendars if calendar not in self._schemas]
+        dbs = [([calendar], shard_path(self.db_path, calendar))
+               for calendar in sorted(self._schemas)]
+        if unsharded:
+            dbs.append((unsharded, self.db_path))
+        for calendars, db_path in dbs:
+            shard = SQLiteDb(calendars, db_path, self.locale, horizon=horizon,
+                             timeout=self._timeout, retries=self.retries, vdirs=self._vdirs)
+            # there's no old db to keep around while this one is filled again
+            shard.finish_rebuild()
+            self._fts = shard._fts
+            shard.close()
+        if unsharded:
+            self._connect(self.db_path)
+            self._connect_readonly(self.db_path)
+        else:
+            self.conn = sqlite3.connect(':memory:', timeout=self._timeout)
+            self.cursor = self.conn.cursor()
+            try:
+                self.query_conn = sqlite3.connect('file::memory:', timeout=self._timeout,
+                                                  uri=True)
+            except TypeError:  # python 3.3 doesn't know URIs yet
+                self.query_conn = self.conn
+            self.query_cursor = self.query_conn.cursor()
+        for calendar, schema in sorted(self._schemas.items()):
+            shard = shard_path(self.db_path, calendar)
+            self.sql_ex('ATTACH DATABASE ? AS {0};'.format(schema), (shard, ))
+            if self.query_conn is not self.conn:
+                uri = 'file:{0}?mode=ro'.format(quote(shard))
+                self.sql_query('ATTACH DATABASE ? AS {0};'.format(schema), (uri, ))
+            self._calendar_id(calendar)
+
+    def close(self):
+        """close all connections to the db"""
+        if self.query_conn is not self.conn:
+            self.query_conn.close()
+        self.conn.close()
 
     @property
-    def _select_calendars(self):
-        return ', '.join(['\'' + cal + '\'' for cal in self.calendars])
+    def rebuilding(self):
+        """if the db is being rebuilt and not all vdirs have been read yet"""
+        return self._rebuild_path is not None
+
+    def finish_rebuild(self):
+        """replace the old db with the rebuilt one (if it has been rebuilt)
+
+        Until the rebuilt db is complete, other processes can still use the old
+        db. Should be called after all vdirs have been read.
+        """
+        if self._rebuild_path is None:
+            return
+        # the write-ahead log must not be left behind when moving the db
+        self.sql_ex('PRAGMA journal_mode=DELETE;')
+        self.close()
+        replace(self._rebuild_path, self.db_path)
+        self._rebuild_path = None
+        self._connect(self.db_path)
+        self._connect_readonly(self.db_path)
+
+    def _schema(self, calendar):
+        """the schema holding the tables of `calendar`, `main` unless the db
+        is sharded"""
+        return self._schemas.get(calendar, 'main')
+
+    def _calendar_id(self, calendar):
+        """the id of `calendar` in the calendars table, which `calendar` is
+        added to if needed"""
+        if calendar not in self._calendar_ids:
+            schema = self._schema(calendar)
+            sql_s = 'SELECT id FROM {0}.calendars WHERE calendar = ?;'.format(schema)
+            result = self.sql_ex(sql_s, (calendar, ))
+            if not result:
+                self.sql_ex('INSERT INTO {0}.calendars (calendar, resource) '
+                            'VALUES (?, ?);'.format(schema), (calendar, ''))
+                result = self.sql_ex(sql_s, (calendar, ))
+            self._calendar_ids[calendar] = result[0][0]
+        return self._calendar_ids[calendar]
+
+    def _union(self, select, stuple=()):
+        """combine `select` for all schemas holding any of our calendars with
+        UNION ALL
+
+        `select` is formatted with the `schema`, placeholders for the ids of
+        the `calendars` in it (for an `IN` clause, which needs to come after
+        all other placeholders) and the number of the schema (`shard`).
+
+        :returns: the statement and the values to bind, `stuple` and the ids
+                  of the calendars for each schema
+        :rtype: tuple(str, tuple)
+        """
+        schemas = dict()
+        for calendar in self.calendars:
+            schemas.setdefault(self._schema(calendar), list()).append(
+                self._calendar_id(calendar))
+        if not schemas:
+            schemas['main'] = list()
+        selects, stuples = list(), tuple()
+        for num, schema in enumerate(sorted(schemas)):
+            selects.append(select.format(schema=schema, shard=num,
+                                         calendars=', '.join('?' for _ in schemas[schema])))
+            stuples += tuple(stuple) + tuple(schemas[schema])
+        return ' UNION ALL '.join(selects), stuples
 
     @contextlib.contextmanager
     def at_once(self):
-        assert not self._at_once
+        """execute all statements in this context in one transaction
+
+        The transaction is committed when leaving the outermost context and
+        rolled back if an exception occurs there, nested contexts are part of
+        the outer transaction.
+        """
+        if self._at_once:
+            yield self
+            return
         self._at_once = True
         try:
             yield self
         except:
+            self.conn.rollback()
             raise
         else:
             self.conn.commit()
         finally:
             self._at_once = False
 
+    @contextlib.contextmanager
+    def writer_lock(self, calendars=None, blocking=True):
+        """hold an exclusive lock, shared with all other processes using the
+        same db, while in this context
+
+        :param calendars: if the db is sharded, only lock the shards of these
+                          calendars (default: all of ours)
+        :param blocking: wait for other processes holding the lock, otherwise
+                         the context's value is False if the lock is not free
+        """
+        if self.db_path == ':memory:' or fcntl is None:
+            yield True
+            return
+        if self._schemas:
+            calendars = self.calendars if calendars is None else calendars
+            lockfiles = sorted(set(
+                (shard_path(self.db_path, calendar) if calendar in self._schemas
+                 else self.db_path) + '.lock' for calendar in calendars))
+        else:
+            lockfiles = [self.db_path + '.lock']
+        operation = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        with contextlib.ExitStack() as stack:
+            locked = True
+            # always in the same order, so processes don't deadlock
+            for lockfile in lockfiles:
+                lockfile = stack.enter_context(open(lockfile, 'a'))
+                try:
+                    fcntl.flock(lockfile, operation)
+                except BlockingIOError:
+                    locked = False
+                    break
+                stack.callback(fcntl.flock, lockfile, fcntl.LOCK_UN)
+            yield locked
+
     def _create_dbdir(self):
         """create the dbdir if it doesn't exist"""
         if self.db_path == ':memory:':
@@ -136,6 +437,84 @@ class SQLiteDb(object):
                 logger.fatal('failed to create {0}: {1}'.format(dbdir, error))
                 raise CouldNotCreateDbDir()
 
+    def _get_version(self):
+        """return the layout version of the db, None if it is new"""
+        try:
+            result = self.sql_ex('SELECT version FROM version;')
+        except sqlite3.OperationalError:  # there is no version table yet
+            return None
+        return result[0][0] if result else None
+
+    def _migrate(self, version):
+        """upgrade the db from `version` to DB_VERSION, step by step
+
+        All steps run in one transaction, events are only parsed (once) if one
+        of the steps needs information from them, but never expanded.
+        """
+        logger.info('upgrading {0} from version {1} to {2}'.format(
+            self.db_path, version, DB_VERSION))
+        # sqlite3 only begins transactions before INSERTs, UPDATEs etc. on its
+        # own, the CREATE, ALTER and DROP statements of the steps would be
+        # committed right away, so the transaction is managed by hand
+        isolation_level = self.conn.isolation_level
+        self.conn.isolation_level = None
+        self._at_once = True
+        try:
+            self.cursor.execute('BEGIN IMMEDIATE;')
+            try:
+                self._migrate_steps(version)
+            except:
+                self.cursor.execute('ROLLBACK;')
+                raise
+            self.cursor.execute('COMMIT;')
+        finally:
+            self._at_once = False
+            self.conn.isolation_level = isolation_level
+
+    def _migrate_steps(self, version):
+        """run the steps of `_migrate`, in its transaction"""
+        backfills = list()
+        for step in range(version, DB_VERSION):
+            if step not in MIGRATIONS:
+                raise OutdatedDbVersionError(
+                    str(self.db_path) +
+                    " is probably an invalid or outdated database.\n"
+                    "You should consider removing it and running khal again.")
+            backfill = MIGRATIONS[step](self)
+            if backfill is not None and backfill not in backfills:
+                backfills.append(backfill)
+        self._fts = bool(self.sql_ex(
+            "SELECT name FROM sqlite_master WHERE name = 'events_fts';"))
+        if backfills:
+            self._backfill(backfills)
+        self.sql_ex('UPDATE version SET version = ?;', (DB_VERSION, ))
+
+    def _backfill(self, backfills):
+        """call all `backfills` with the parsed VEVENTs of each event in the db
+
+        events which cannot be parsed are deleted, they will be read from their
+        vdir again on the next update
+        """
+        sql_s = ('SELECT events.id, href, calendars.calendar, item FROM events '
+                 'JOIN calendars ON events.calendar_id = calendars.id WHERE events.id > ? '
+                 'ORDER BY events.id LIMIT 1000;')
+        rows = self.sql_ex(sql_s, (0, ))
+        while rows:
+            for event_id, href, calendar, item in rows:
+                try:
+                    ical = icalendar.Event.from_ical(self._item(item, href, calendar))
+                    vevents = sorted(
+                        (aux.sanitize(c, self.locale['default_timezone'], href, calendar)
+                         for c in ical.walk() if c.name == 'VEVENT'), key=sort_key)
+                except Exception as error:
+                    logger.warning('Cannot upgrade {0}/{1}: {2}, it will be read again.'.format(
+                        calendar, href, error))
+                    self.delete(href, calendar=calendar)
+                    continue
+                for backfill in backfills:
+                    backfill(self, event_id, href, calendar, vevents)
+            rows = self.sql_ex(sql_s, (event_id, ))
+
     def _check_table_version(self):
         """tests for curent db Version
         if the table is still empty, insert db_version
@@ -160,38 +539,100 @@ class SQLiteDb(object):
         logger.debug(u"created version table")
 
         self.cursor.execute('''CREATE TABLE IF NOT EXISTS calendars (
+            id INTEGER PRIMARY KEY,
             calendar TEXT NOT NULL UNIQUE,
             resource TEXT NOT NULL,
             ctag TEXT
             )''')
+        # preset dictionaries for compressing the items, their ids are the
+        # dictionaries' Adler-32 checksums, as found in the compressed items
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS zdicts (
+            id INTEGER PRIMARY KEY,
+            zdict BLOB NOT NULL
+            );''')
+        # `item` is either the text of the event or that text compressed
+        # with zlib (as a BLOB), see `_deflate`
         self.cursor.execute('''CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY,
                 href TEXT NOT NULL,
-                calendar TEXT NOT NULL,
+                calendar_id INT NOT NULL,
                 sequence INT,
                 etag TEXT,
                 item TEXT,
-                primary key (href, calendar)
+                expanded_until INT,
+                UNIQUE (href, calendar_id)
                 );''')
-        self.cursor.execute('''CREATE TABLE IF NOT EXISTS recs_loc (
-            dtstart INT NOT NULL,
-            dtend INT NOT NULL,
-            href TEXT NOT NULL REFERENCES events( href ),
-            rec_inst TEXT NOT NULL,
-            ref TEXT NOT NULL,
-            dtype INT NOT NULL,
-            calendar TEXT NOT NULL,
-            primary key (href, rec_inst, calendar)
+        # the instances of all events, `ref` is the RECURRENCE-ID of the
+        # VEVENT the instance belongs to, NULL for the proto VEVENT
+        for table in ['recs_loc', 'recs_float']:
+            self.cursor.execute('''CREATE TABLE IF NOT EXISTS {0} (
+                event_id INT NOT NULL,
+                rec_inst INT NOT NULL,
+                calendar_id INT NOT NULL,
+                dtstart INT NOT NULL,
+                dtend INT NOT NULL,
+                ref INT,
+                dtype INT NOT NULL,
+                primary key (event_id, rec_inst)
+                ) WITHOUT ROWID;'''.format(table))
+        # the properties needed for displaying events, for each VEVENT
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS vevents (
+            event_id INT NOT NULL,
+            ref INT,
+            uid TEXT,
+            summary TEXT,
+            location TEXT,
+            description TEXT,
+            recurring INT NOT NULL,
+            x_birthday TEXT,
+            x_fname TEXT
             );''')
-        self.cursor.execute('''CREATE TABLE IF NOT EXISTS recs_float (
-            dtstart INT NOT NULL,
-            dtend INT NOT NULL,
-            href TEXT NOT NULL REFERENCES events( href ),
-            rec_inst TEXT NOT NULL,
-            ref TEXT NOT NULL,
-            dtype INT NOT NULL,
+        self.cursor.execute(
+            'CREATE INDEX IF NOT EXISTS vevents_event_id ON vevents (event_id, ref);')
+        # birthdays are not expanded, instead we keep their month and day
+        # (as month * 100 + day) and the first year they occur in
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS birthdays (
+            event_id INT NOT NULL PRIMARY KEY,
+            calendar_id INT NOT NULL,
+            month_day INT NOT NULL,
+            year INT NOT NULL
+            ) WITHOUT ROWID;''')
+        self.cursor.execute(
+            'CREATE INDEX IF NOT EXISTS birthdays_month_day '
+            'ON birthdays (calendar_id, month_day);')
+        # inode, size and mtime of all files in the vdirs when they were last
+        # read, to find changed files without reading them
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS files (
             calendar TEXT NOT NULL,
-            primary key (href, rec_inst, calendar)
+            name TEXT NOT NULL,
+            inode INT NOT NULL,
+            size INT NOT NULL,
+            mtime_ns INT NOT NULL,
+            primary key (calendar, name)
             );''')
+        self.cursor.execute(RENDERED_TABLE)
+        # full text index over the properties users search for (its rowids are
+        # the events' ids), if the SQLite library at hand was compiled without
+        # FTS5, we fall back to matching those properties in the vevents table
+        try:
+            self.cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS events_fts USING fts5(
+                summary, description, location, attendees
+                );''')
+            self._fts = True
+        except sqlite3.OperationalError as error:
+            logger.debug('full text search is not available: {0}'.format(error))
+            self._fts = False
+        # the primary keys above are no help in finding instances by their
+        # time, these indexes allow an overlap test to only look at the
+        # instances in question instead of scanning the whole table
+        for table in ['recs_loc', 'recs_float']:
+            for column in ['dtstart', 'dtend']:
+                self.cursor.execute(
+                    'CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} (calendar_id, {1});'.format(
+                        table, column))
+        self.cursor.execute(
+            'CREATE INDEX IF NOT EXISTS events_expanded_until '
+            'ON events (calendar_id, expanded_until);')
         self.conn.commit()
 
     def _check_calendars_exists(self):
@@ -199,30 +640,62 @@ class SQLiteDb(object):
         table
         """
         for cal in self.calendars:
-            self.cursor.execute('''SELECT count(*) FROM calendars
-                    WHERE calendar = ?;''', (cal,))
-            result = self.cursor.fetchone()
-
-            if result[0] != 0:
-                logger.debug(u"tables for calendar {0} exist".format(cal))
-            else:
-                sql_s = 'INSERT INTO calendars (calendar, resource) VALUES (?, ?);'
-                stuple = (cal, '')
-                self.sql_ex(sql_s, stuple)
+            logger.debug(u"calendar {0} has the id {1}".format(cal, self._calendar_id(cal)))
 
     def sql_ex(self, statement, stuple=''):
-        """wrapper for sql statements, does a "fetchall" """
-        self.cursor.execute(statement, stuple)
-        result = self.cursor.fetchall()
+        """wrapper for sql statements, does a "fetchall"
+
+        Outside of transactions statements failing because the db is locked
+        are retried.
+        """
+        for retry in range(self.retries + 1):
+            try:
+                self.cursor.execute(statement, stuple)
+                result = self.cursor.fetchall()
+                if not self._at_once:
+                    self.conn.commit()
+                return result
+            except sqlite3.OperationalError as error:
+                if self._at_once or retry == self.retries or 'locked' not in str(error):
+                    raise
+                logger.debug('database is locked, retrying')
+                sleep(0.1 * 2 ** retry)
+
+    def sql_query(self, statement, stuple=''):
+        """wrapper for SELECT statements, which are run on the read-only
+        connection, does a "fetchall" """
+        self.query_cursor.execute(statement, stuple)
+        return self.query_cursor.fetchall()
+
+    def sql_stream(self, statement, stuple=''):
+        """wrapper for SELECT statements returning many rows, which are run on
+        the read-only connection and fetched a page at a time
+
+        Each call uses a cursor of its own, so several results can be consumed
+        at once. Until the generator is exhausted (or closed), it sees the db
+        as it was when the first row was requested.
+
+        :rtype: generator of tuple
+        """
+        cursor = self.query_conn.cursor()
+        try:
+            cursor.execute(statement, stuple)
+            for rows in iter(partial(cursor.fetchmany, STREAM_PAGE_SIZE), []):
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
+    def sql_many(self, statement, stuples):
+        """wrapper for executing one statement for each of `stuples`"""
+        self.cursor.executemany(statement, stuples)
         if not self._at_once:
             self.conn.commit()
-        return result
 
-    def update(self, vevent_str, href, etag='', calendar=None):
+    def update(self, vevent_str, href, etag='', calendar=None, vevents=None):
         """insert a new or update an existing card in the db
 
-        This is mostly a wrapper around two SQL statements, doing some cleanup
-        before.
+        This is mostly a wrapper around :func:`prepare` and :meth:`write`.
 
         :param vevent_str: event to be inserted or updated.
                            We assume that even if it contains more than one
@@ -240,150 +713,200 @@ class SQLiteDb(object):
                      the server. For locally created vcards this should not be
                      set
         :type etag: str()
+        :param vevents: the VEVENTs in `vevent_str`, if they have been parsed
+                        already, see :func:`prepare`
+        :type vevents: list(icalendar.Event)
         """
         assert calendar is not None
         if href is None:
             raise ValueError('href may not be None')
-        ical = icalendar.Event.from_ical(vevent_str)
+        prepared = prepare(vevent_str, href, calendar, self.locale['default_timezone'],
+                           self.default_until(), vevents)
+        self.write(prepared, href, etag, calendar=calendar)
 
-        vevents = (aux.sanitize(c, self.locale['default_timezone'], href, calendar) for
-                   c in ical.walk() if c.name == 'VEVENT')
-        # Need to delete the whole event in case we are updating a
-        # recurring event with an event which is either not recurring any
-        # more or has EXDATEs, as those would be left in the recursion
-        # tables. There are obviously better ways to achieve the same
-        # result.
-        self.delete(href, calendar=calendar)
-        for vevent in sorted(vevents, key=sort_key):
-            check_support(vevent, href, calendar)
-            self._update_impl(vevent, href, calendar)
-
-        sql_s = ('INSERT INTO events '
-                 '(item, etag, href, calendar) '
-                 'VALUES (?, ?, ?, ?);')
-        stuple = (vevent_str, etag, href, calendar)
-        self.sql_ex(sql_s, stuple)
+    def _drop_referenced_items(self):
+        """delete the events which refer to their files instead of being saved
+        in the db, if their calendar's events are to be saved in the db now
 
-    def update_birthday(self, vevent, href, etag='', calendar=None):
+        The records of their files are deleted as well, so they are read again
+        on the next update.
         """
-        XXX write docstring
+        for calendar in self.calendars:
+            if calendar in self._vdirs:
+                continue
+            schema = self._schema(calendar)
+            sql_s = 'SELECT href FROM {0}.events WHERE item IS NULL AND calendar_id = ?;'.format(
+                schema)
+            hrefs = [href for href, in self.sql_ex(sql_s, (self._calendar_id(calendar), ))]
+            if not hrefs:
+                continue
+            logger.info('{0} events of {1} will be read again'.format(len(hrefs), calendar))
+            with self.at_once():
+                for href in hrefs:
+                    self.delete(href, calendar=calendar)
+                    self.sql_ex('DELETE FROM {0}.files WHERE calendar = ? AND name = ?;'.format(
+                        schema), (calendar, href))
+
+    def update_birthday(self, vevent, href, etag='', calendar=None):
+        """insert a new or update an existing birthday event, created from the
+        vcard `vevent`, see :func:`prepare_birthday`
         """
         assert calendar is not None
 
         if href is None:
             raise ValueError('href may not be None')
-        ical = icalendar.Event.from_ical(vevent)
-        vcard = ical.walk()[0]
-        if 'BDAY' in vcard.keys():
-            bday = vcard['BDAY']
-            try:
-                if bday[0:2] == '--' and bday[3] != '-':
-                    bday = '1900' + bday[2:]
-                    orig_bday = False
-                else:
-                    orig_bday = True
-                bday = parser.parse(bday).date()
-            except ValueError:
-                logger.info('cannot parse BIRTHDAY in {0} in collection '
-                            '{1}'.format(href, calendar))
-                return
-            if 'FN' in vcard:
-                name = vcard['FN']
-            else:
-                n = vcard['N'].split(';')
-                name = ' '.join([n[1], n[2], n[0]])
-            event = icalendar.Event()
-            event.add('dtstart', bday)
-            event.add('dtend', bday + timedelta(days=1))
-            event.add('summary', '{0}\'s birthday'.format(name))
-            event.add('rrule', {'freq': 'YEARLY'})
-            if orig_bday:
-                event.add('x-birthday',
-                          '{:04}{:02}{:02}'.format(bday.year, bday.month, bday.day))
-                event.add('x-fname', name)
-            event.add('uid', href)
-            event_str = event.to_ical().decode('utf-8')
-            self._update_impl(event, href, calendar)
-            sql_s = ('INSERT INTO events (item, etag, href, calendar) VALUES (?, ?, ?, ?);')
-            stuple = (event_str, etag, href, calendar)
-            self.sql_ex(sql_s, stuple)
+        prepared = prepare_birthday(vevent, href, calendar)
+        if prepared is not None:
+            self.write(prepared, href, etag, calendar=calendar)
 
-    def _update_impl(self, vevent, href, calendar):
-        """insert `vevent` into the database
+    def write(self, prepared, href, etag='', calendar=None):
+        """write an event prepared by :func:`prepare` or
+        :func:`prepare_birthday` to the db, replacing the event at `href`
 
-        expand `vevent`'s reccurence rules (if needed) and insert all instance
-        in the respective tables
-        than insert non-reccuring and original recurring (those with an RRULE
-        property) events into table `events`
+        :type prepared: Prepared
         """
-        # TODO FIXME this function is a steaming pile of shit
-        rec_id = vevent.get(RECURRENCE_ID)
-        if rec_id is None:
-            rrange = None
-        else:
-            rrange = rec_id.params.get('RANGE')
-
-        # testing on datetime.date won't work as datetime is a child of date
-        if not isinstance(vevent['DTSTART'].dt, datetime):
-            dtype = DATE
-        else:
-            dtype = DATETIME
-        if ('TZID' in vevent['DTSTART'].params and dtype == DATETIME) or \
-                getattr(vevent['DTSTART'].dt, 'tzinfo', None):
-            recs_table = 'recs_loc'
-        else:
-            recs_table = 'recs_float'
-
-        thisandfuture = (rrange == THISANDFUTURE)
-        if thisandfuture:
-            start_shift, duration = calc_shift_deltas(vevent)
-            start_shift = start_shift.days * 3600 * 24 + start_shift.seconds
-            duration = duration.days * 3600 * 24 + duration.seconds
-
-        dtstartend = aux.expand(vevent, href)
-        if not dtstartend:
-            # Does this event even have dates? Technically it is possible for
-            # events to be empty/non-existent by deleting all their recurrences
-            # through EXDATE.
-            return
-
-        for dtstart, dtend in dtstartend:
-            if dtype == DATE:
-                dbstart = aux.to_unix_time(dtstart)
-                dbend = aux.to_unix_time(dtend)
-                if rec_id is not None:
-                    rec_inst = aux.to_unix_time(rec_id.dt)
-                    ref = rec_inst
-                else:
-                    rec_inst = dbstart
-                    ref = PROTO
-            else:
-                dbstart = aux.to_unix_time(dtstart)
-                dbend = aux.to_unix_time(dtend)
-
-                if rec_id is not None:
-                    ref = rec_inst = str(aux.to_unix_time(rec_id.dt))
-                else:
-                    rec_inst = dbstart
-                    ref = PROTO
-
-            if thisandfuture:
-                recs_sql_s = (
-                    'UPDATE {0} SET dtstart = rec_inst + ?, dtend = rec_inst + ?, ref = ? '
-                    'WHERE rec_inst >= ? AND href = ? AND calendar = ?;'.format(recs_table))
-                stuple = (start_shift, start_shift + duration, ref, rec_inst, href, calendar)
+        assert calendar is not None
+        with self.at_once():
+            # Need to delete the whole event in case we are updating a
+            # recurring event with an event which is either not recurring any
+            # more or has EXDATEs, as those would be left in the recursion
+            # tables. There are obviously better ways to achieve the same
+            # result.
+            self.delete(href, calendar=calendar)
+            sql_s = ('INSERT INTO {0}.events '
+                     '(item, etag, href, calendar_id, expanded_until) '
+                     'VALUES (?, ?, ?, ?, ?);'.format(self._schema(calendar)))
+            if calendar in self._vdirs:
+                item = None  # see `_read_item`
             else:
-                recs_sql_s = (
-                    'INSERT OR REPLACE INTO {0} '
-                    '(dtstart, dtend, href, ref, dtype, rec_inst, calendar)'
-                    'VALUES (?, ?, ?, ?, ?, ?, ?);'.format(recs_table))
-                stuple = (dbstart, dbend, href, ref, dtype, rec_inst, calendar)
-            self.sql_ex(recs_sql_s, stuple)
-            # end of loop
+                item = self._deflate(prepared.item, calendar)
+            stuple = (item, etag, href, self._calendar_id(calendar), prepared.expanded_until)
+            self.sql_ex(sql_s, stuple)
+            event_id = self.cursor.lastrowid
+            self._write_props(calendar, event_id, prepared.props)
+            for instances in prepared.instances:
+                self._write_instances(calendar, event_id, *instances)
+            if prepared.birthday is not None:
+                sql_s = ('INSERT INTO {0}.birthdays (event_id, calendar_id, month_day, year) '
+                         'VALUES (?, ?, ?, ?);'.format(self._schema(calendar)))
+                self.sql_ex(sql_s, (event_id, self._calendar_id(calendar)) + prepared.birthday)
+            if self._fts:
+                self._write_search(calendar, event_id, prepared.search)
+        if prepared.expanded_until is not None and self._expanded_until is not None:
+            self._expanded_until = min(self._expanded_until, prepared.expanded_until)
+
+    def default_until(self):
+        """up to when instances of newly inserted events are saved"""
+        return datetime.combine(date.today() + self.horizon, time.min)
+
+    def _expand(self, end):
+        """make sure all instances starting before `end` are saved in the db
+
+        This is called by queries, which write to the db if they reach beyond
+        the instances saved so far. They don't wait for other processes
+        writing to the db though: if the writer lock is taken (or writing
+        fails), the queries return the instances saved so far and a warning
+        is logged.
+
+        :param end: unix time
+        :type end: int
+        """
+        # events' local times may be up to 14 hours ahead of UTC
+        end = end + 24 * 3600
+        if self._expanded_until is None:
+            sql_s, stuple = self._union(
+                'SELECT min(expanded_until) AS watermark FROM {schema}.events '
+                'WHERE calendar_id IN ({calendars})')
+            watermarks = [watermark for watermark, in self.sql_ex(sql_s, stuple)
+                          if watermark is not None]
+            self._expanded_until = min(watermarks) if watermarks else float('inf')
+        if end <= self._expanded_until:
+            return
+        missing = 'recurring events after {0} might be missing'.format(
+            datetime.utcfromtimestamp(self._expanded_until).date())
+        with self.writer_lock(blocking=False) as locked:
+            if not locked:
+                logger.warning('the database is being updated by another khal instance, ' +
+                               missing)
+                return
+            try:
+                self._extend_instances(end)
+            except sqlite3.OperationalError as error:
+                logger.warning('cannot save more instances of recurring events ({0}), '
+                               '{1}'.format(error, missing))
+                return
+        self._expanded_until = None
+
+    def _extend_instances(self, end):
+        """save all instances of events starting before `end` (and up to the
+        horizon after it), see `_expand`"""
+        until = datetime.utcfromtimestamp(end) + self.horizon
+        sql_s, stuple = self._union(
+            'SELECT events.id, href, calendars.calendar, item, expanded_until '
+            'FROM {schema}.events JOIN {schema}.calendars ON '
+            'events.calendar_id = calendars.id WHERE '
+            'expanded_until < ? AND calendar_id IN ({calendars})', (end, ))
+        result = self.sql_ex(sql_s, stuple)
+        logger.debug('extending the recurrences of {0} events up to {1}'.format(
+            len(result), until))
+        with self.at_once():
+            for event_id, href, calendar, item, watermark in result:
+                try:
+                    item = self._item(item, href, calendar)
+                except ChangedFileError as error:
+                    logger.warning('Skipping {0}/{1}: {2}'.format(calendar, href, error))
+                    continue
+                ical = icalendar.Event.from_ical(item)
+                vevents = (aux.sanitize(c, self.locale['default_timezone'], href, calendar)
+                           for c in ical.walk() if c.name == 'VEVENT')
+                since = datetime.utcfromtimestamp(watermark)
+                # overwritten instances need to be overwritten again
+                for vevent in sorted(vevents, key=sort_key):
+                    instances = _instances(vevent, href, calendar, since=since, until=until)
+                    if instances is not None:
+                        self._write_instances(calendar, event_id, *instances)
+                sql_s = 'UPDATE {0}.events SET expanded_until = ? WHERE id = ?;'.format(
+                    self._schema(calendar))
+                self.sql_ex(sql_s, (aux.to_unix_time(until), event_id))
+
+    def _write_props(self, calendar, event_id, props):
+        """insert the properties of the VEVENTs of the event with the id
+        `event_id` as returned by `_props`"""
+        sql_s = ('INSERT INTO {0}.vevents '
+                 '(event_id, ref, uid, summary, location, description, recurring, '
+                 'x_birthday, x_fname) '
+                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);'.format(self._schema(calendar)))
+        self.sql_many(sql_s, ((event_id, ) + tuple(prop) for prop in props))
+
+    def _write_search(self, calendar, event_id, search):
+        """insert the searchable properties of the event with the id
+        `event_id` as returned by `_search_texts` into the full text index"""
+        sql_s = ('INSERT INTO {0}.events_fts '
+                 '(rowid, summary, description, location, attendees) '
+                 'VALUES (?, ?, ?, ?, ?);'.format(self._schema(calendar)))
+        self.sql_ex(sql_s, (event_id, ) + tuple(search))
+
+    def _write_instances(self, calendar, event_id, recs_table, stuples, shift):
+        """insert instances (or shift them) of the event with the id
+        `event_id` as calculated by `_instances`"""
+        if shift is not None:
+            recs_sql_s = (
+                'UPDATE {0}.{1} SET dtstart = rec_inst + ?, dtend = rec_inst + ?, ref = ? '
+                'WHERE rec_inst >= ? AND event_id = ?;'.format(
+                    self._schema(calendar), recs_table))
+            self.sql_ex(recs_sql_s, tuple(shift) + (event_id, ))
+        else:
+            recs_sql_s = (
+                'INSERT OR REPLACE INTO {0}.{1} '
+                '(event_id, calendar_id, rec_inst, dtstart, dtend, ref, dtype) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?);'.format(self._schema(calendar), recs_table))
+            ids = (event_id, self._calendar_id(calendar))
+            self.sql_many(recs_sql_s, (ids + tuple(stuple) for stuple in stuples))
 
     def get_ctag(self, calendar):
         stuple = (calendar, )
-        sql_s = 'SELECT ctag FROM calendars WHERE calendar = ?;'
+        sql_s = 'SELECT ctag FROM {0}.calendars WHERE calendar = ?;'.format(
+            self._schema(calendar))
         try:
             ctag = self.sql_ex(sql_s, stuple)[0][0]
             return ctag
@@ -392,7 +915,8 @@ class SQLiteDb(object):
 
     def set_ctag(self, ctag, calendar):
         stuple = (ctag, calendar, )
-        sql_s = 'UPDATE calendars SET ctag = ? WHERE calendar = ?;'
+        sql_s = 'UPDATE {0}.calendars SET ctag = ? WHERE calendar = ?;'.format(
+            self._schema(calendar))
         self.sql_ex(sql_s, stuple)
         self.conn.commit()
 
@@ -403,13 +927,55 @@ class SQLiteDb(object):
         return: etag
         rtype: str()
         """
-        sql_s = 'SELECT etag FROM events WHERE href = ? AND calendar = ?;'
+        sql_s = 'SELECT etag FROM {0}.events WHERE href = ? AND calendar_id = ?;'.format(
+            self._schema(calendar))
         try:
-            etag = self.sql_ex(sql_s, (href, calendar))[0][0]
+            etag = self.sql_ex(sql_s, (href, self._calendar_id(calendar)))[0][0]
             return etag
         except IndexError:
             return None
 
+    def get_etags(self, calendar):
+        """get the etags of all events in `calendar`
+
+        :rtype: dict(str, str)
+        """
+        sql_s = 'SELECT href, etag FROM {0}.events WHERE calendar_id = ?;'.format(
+            self._schema(calendar))
+        return dict(self.sql_ex(sql_s, (self._calendar_id(calendar), )))
+
+    def get_files(self, calendar):
+        """get the inode, size and mtime of all files of `calendar` as saved
+        by `set_files` or `set_file`
+
+        :rtype: dict(str, tuple(int, int, int))
+        """
+        sql_s = 'SELECT name, inode, size, mtime_ns FROM {0}.files WHERE calendar = ?;'.format(
+            self._schema(calendar))
+        return dict((name, (inode, size, mtime)) for name, inode, size, mtime in
+                    self.sql_ex(sql_s, (calendar, )))
+
+    def set_files(self, calendar, files):
+        """replace the saved inode, size and mtime of all files of `calendar`
+
+        :type files: dict(str, tuple(int, int, int))
+        """
+        schema = self._schema(calendar)
+        with self.at_once():
+            self.sql_ex('DELETE FROM {0}.files WHERE calendar = ?;'.format(schema), (calendar, ))
+            sql_s = ('INSERT INTO {0}.files (calendar, name, inode, size, mtime_ns) '
+                     'VALUES (?, ?, ?, ?, ?);'.format(schema))
+            self.sql_many(sql_s, ((calendar, name) + stat for name, stat in files.items()))
+
+    def set_file(self, calendar, name, stat):
+        """save the inode, size and mtime of one file of `calendar`
+
+        :type stat: tuple(int, int, int)
+        """
+        sql_s = ('INSERT OR REPLACE INTO {0}.files (calendar, name, inode, size, mtime_ns) '
+                 'VALUES (?, ?, ?, ?, ?);'.format(self._schema(calendar)))
+        self.sql_ex(sql_s, (calendar, name) + tuple(stat))
+
     def delete(self, href, etag=None, calendar=None):
         """
         removes the event from the db,
@@ -419,11 +985,78 @@ class SQLiteDb(object):
         :returns: None
         """
         assert calendar is not None
-        for table in ['recs_loc', 'recs_float']:
-            sql_s = 'DELETE FROM {0} WHERE href = ? AND calendar = ?;'.format(table)
-            self.sql_ex(sql_s, (href, calendar))
-        sql_s = 'DELETE FROM events WHERE href = ? AND calendar = ?;'
-        self.sql_ex(sql_s, (href, calendar))
+        schema = self._schema(calendar)
+        sql_s = 'SELECT id FROM {0}.events WHERE href = ? AND calendar_id = ?;'.format(schema)
+        result = self.sql_ex(sql_s, (href, self._calendar_id(calendar)))
+        if not result:
+            return
+        event_id = result[0][0]
+        for table in ['recs_loc', 'recs_float', 'vevents', 'birthdays']:
+            sql_s = 'DELETE FROM {0}.{1} WHERE event_id = ?;'.format(schema, table)
+            self.sql_ex(sql_s, (event_id, ))
+        if self._fts:
+            sql_s = 'DELETE FROM {0}.events_fts WHERE rowid = ?;'.format(schema)
+            self.sql_ex(sql_s, (event_id, ))
+        self.sql_ex('DELETE FROM {0}.events WHERE id = ?;'.format(schema), (event_id, ))
+
+    def get_rendered(self, first, last, settings):
+        """get the lines saved by `set_rendered` for the days from `first` to
+        `last` and `settings`
+
+        :type first: datetime.date
+        :type last: datetime.date
+        :returns: the etag and color of the event and the lines by calendar,
+                  href, instance and day
+        :rtype: dict(tuple(str, str, str, datetime.date), tuple(str, str, list(str)))
+        """
+        sql_s, stuple = self._union(
+            'SELECT calendars.calendar, href, instance, day, etag, color, lines '
+            'FROM {schema}.rendered JOIN {schema}.calendars '
+            'ON rendered.calendar_id = calendars.id WHERE day BETWEEN ? AND ? '
+            'AND settings = ? AND calendar_id IN ({calendars})',
+            (first.toordinal(), last.toordinal(), settings))
+        return dict(
+            ((calendar, href, instance, date.fromordinal(day)), (etag, color, json.loads(lines)))
+            for calendar, href, instance, day, etag, color, lines in self.sql_query(sql_s, stuple))
+
+    def set_rendered(self, settings, rows):
+        """save the lines printed for event instances on some day
+
+        This is only a cache, if the db cannot be written to (e.g. because it
+        is read-only or another khal instance is updating it), nothing is
+        saved.
+
+        :param rows: calendar, href, instance, day, etag and color of the event
+                     and the lines
+        :type rows: list(tuple(str, str, str, datetime.date, str, str, list(str)))
+        """
+        if not rows:
+            return
+        with self.writer_lock(sorted(set(row[0] for row in rows)), blocking=False) as locked:
+            if not locked:
+                logger.debug('not saving the rendered events, the db is being updated')
+                return
+            try:
+                with self.at_once():
+                    for calendar, href, instance, day, etag, color, lines in rows:
+                        self.sql_ex(
+                            'INSERT OR REPLACE INTO {0}.rendered (calendar_id, day, settings, '
+                            'href, instance, etag, color, lines) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?, ?);'.format(self._schema(calendar)),
+                            (self._calendar_id(calendar), day.toordinal(), settings, href,
+                             instance, etag, color, json.dumps(lines)))
+            except sqlite3.OperationalError as error:
+                logger.debug('cannot save the rendered events: {0}'.format(error))
+
+    def prune_rendered(self, calendars):
+        """drop the lines saved by `set_rendered` for days before today for
+        `calendars`, should only be called while holding the writer lock"""
+        today = date.today().toordinal()
+        with self.at_once():
+            for calendar in calendars:
+                self.sql_ex('DELETE FROM {0}.rendered WHERE calendar_id = ? AND day < ?;'
+                            .format(self._schema(calendar)),
+                            (self._calendar_id(calendar), today))
 
     def list(self, calendar):
         """ list all events in `calendar`
@@ -431,8 +1064,9 @@ class SQLiteDb(object):
         used for testing
         :returns: list of (href, etag)
         """
-        sql_s = 'SELECT href, etag FROM events WHERE calendar = ?;'
-        return list(set(self.sql_ex(sql_s, (calendar, ))))
+        sql_s = 'SELECT href, etag FROM {0}.events WHERE calendar_id = ?;'.format(
+            self._schema(calendar))
+        return list(set(self.sql_ex(sql_s, (self._calendar_id(calendar), ))))
 
     def get_localized(self, start, end, minimal=False):
         """returns
@@ -445,23 +1079,22 @@ class SQLiteDb(object):
         assert end.tzinfo is not None
         start = aux.to_unix_time(start)
         end = aux.to_unix_time(end)
-        sql_s = (
-            'SELECT item, recs_loc.href, dtstart, dtend, ref, etag, dtype, events.calendar FROM '
-            'recs_loc JOIN events ON '
-            'recs_loc.href = events.href AND '
-            'recs_loc.calendar = events.calendar WHERE '
-            '(dtstart >= ? AND dtstart <= ? OR '
-            'dtend > ? AND dtend <= ? OR '
-            'dtstart <= ? AND dtend >= ?) AND events.calendar in ({0});')
-        stuple = (start, end, start, end, start, end)
-        result = self.sql_ex(sql_s.format(self._select_calendars), stuple)
+        self._expand(end)
+        sql_s, stuple = self._union(
+            'SELECT item, href, dtstart, dtend, ref, etag, dtype, calendars.calendar FROM '
+            '{schema}.recs_loc JOIN {schema}.events ON recs_loc.event_id = events.id '
+            'JOIN {schema}.calendars ON events.calendar_id = calendars.id WHERE ' +
+            OVERLAPS + ' AND recs_loc.calendar_id IN ({calendars})', (end, start, start))
+        result = self.sql_stream(sql_s, stuple)
         for item, href, start, end, ref, etag, dtype, calendar in result:
-            start = pytz.UTC.localize(datetime.utcfromtimestamp(start))
-            end = pytz.UTC.localize(datetime.utcfromtimestamp(end))
+            start = datetime.fromtimestamp(start, pytz.UTC)
+            end = datetime.fromtimestamp(end, pytz.UTC)
             if minimal:
                 yield EventStandIn(calendar)
             else:
-                yield self.construct_event(item, href, start, end, ref, etag, calendar, dtype)
+                event = self.construct_event(item, href, start, end, ref, etag, calendar, dtype)
+                if event is not None:
+                    yield event
 
     def get_floating(self, start, end, minimal=False):
         """return floating events between `start` and `end`
@@ -475,23 +1108,29 @@ class SQLiteDb(object):
         assert end.tzinfo is None
         strstart = aux.to_unix_time(start)
         strend = aux.to_unix_time(end)
-        sql_s = (
-            'SELECT item, recs_float.href, dtstart, dtend, ref, etag, dtype, events.calendar FROM '
-            'recs_float JOIN events ON '
-            'recs_float.href = events.href AND '
-            'recs_float.calendar = events.calendar WHERE '
-            '(dtstart >= ? AND dtstart < ? OR '
-            'dtend > ? AND dtend <= ? OR '
-            'dtstart <= ? AND dtend > ? ) AND events.calendar in ({0});')
-        stuple = (strstart, strend, strstart, strend, strstart, strend)
-        result = self.sql_ex(sql_s.format(self._select_calendars), stuple)
+        birthdays = self._birthdays(start.date(), end.date())
+        self._expand(strend)
+        sql_s, stuple = self._union(
+            'SELECT item, href, dtstart, dtend, ref, etag, dtype, calendars.calendar FROM '
+            '{schema}.recs_float JOIN {schema}.events ON recs_float.event_id = events.id '
+            'JOIN {schema}.calendars ON events.calendar_id = calendars.id WHERE ' +
+            OVERLAPS + ' AND recs_float.calendar_id IN ({calendars})',
+            (strend, strstart, strstart))
+        result = self.sql_stream(sql_s, stuple)
         for item, href, start, end, ref, etag, dtype, calendar in result:
             start = datetime.utcfromtimestamp(start)
             end = datetime.utcfromtimestamp(end)
             if minimal:
                 yield EventStandIn(calendar)
             else:
-                yield self.construct_event(item, href, start, end, ref, etag, calendar, dtype)
+                event = self.construct_event(item, href, start, end, ref, etag, calendar, dtype)
+                if event is not None:
+                    yield event
+        for day, (href, etag, item, calendar) in birthdays:
+            if minimal:
+                yield EventStandIn(calendar)
+            else:
+                yield self._construct_birthday(item, href, etag, calendar, day)
 
     def get_localized_at(self, dtime):
         """return localized events which are scheduled at `dtime`
@@ -500,19 +1139,20 @@ class SQLiteDb(object):
         """
         assert dtime.tzinfo is not None
         dtime = aux.to_unix_time(dtime)
-        sql_s = (
-            'SELECT item, recs_loc.href, dtstart, dtend, ref, etag, dtype, events.calendar FROM '
-            'recs_loc JOIN events ON '
-            'recs_loc.href = events.href AND '
-            'recs_loc.calendar = events.calendar WHERE '
-            '(dtstart <= ? AND dtend >= ? ) '
-            'AND events.calendar in ({0});')
-        stuple = (dtime, dtime)
-        result = self.sql_ex(sql_s.format(self._select_calendars), stuple)
+        self._expand(dtime)
+        sql_s, stuple = self._union(
+            'SELECT item, href, dtstart, dtend, ref, etag, dtype, calendars.calendar FROM '
+            '{schema}.recs_loc JOIN {schema}.events ON recs_loc.event_id = events.id '
+            'JOIN {schema}.calendars ON events.calendar_id = calendars.id WHERE '
+            'dtstart <= ? AND dtend >= ? '
+            'AND recs_loc.calendar_id IN ({calendars})', (dtime, dtime))
+        result = self.sql_stream(sql_s, stuple)
         for item, href, start, end, ref, etag, dtype, calendar in result:
-            start = pytz.UTC.localize(datetime.utcfromtimestamp(start))
-            end = pytz.UTC.localize(datetime.utcfromtimestamp(end))
-            yield self.construct_event(item, href, start, end, ref, etag, calendar, dtype)
+            start = datetime.fromtimestamp(start, pytz.UTC)
+            end = datetime.fromtimestamp(end, pytz.UTC)
+            event = self.construct_event(item, href, start, end, ref, etag, calendar, dtype)
+            if event is not None:
+                yield event
 
     def get_floating_at(self, dtime):
         """return allday events which are scheduled at `dtime`
@@ -520,20 +1160,324 @@ class SQLiteDb(object):
         :type dtime: datetime.datetime
         """
         assert dtime.tzinfo is None
+        # a birthday ending at `dtime` (at midnight) is still scheduled then
+        if dtime.time() == time.min:
+            birthdays = self._birthdays(dtime.date() - timedelta(days=1), dtime.date())
+        else:
+            birthdays = self._birthdays(dtime.date(), dtime.date())
         dtime = aux.to_unix_time(dtime)
-        sql_s = (
-            'SELECT item, recs_float.href, dtstart, dtend, ref, etag, dtype, events.calendar FROM '
-            'recs_float JOIN events ON '
-            'recs_float.href = events.href AND '
-            'recs_float.calendar = events.calendar WHERE '
-            '(dtstart <= ? AND dtend >= ? ) '
-            'AND events.calendar in ({0});')
-        stuple = (dtime, dtime)
-        result = self.sql_ex(sql_s.format(self._select_calendars), stuple)
+        self._expand(dtime)
+        sql_s, stuple = self._union(
+            'SELECT item, href, dtstart, dtend, ref, etag, dtype, calendars.calendar FROM '
+            '{schema}.recs_float JOIN {schema}.events ON recs_float.event_id = events.id '
+            'JOIN {schema}.calendars ON events.calendar_id = calendars.id WHERE '
+            'dtstart <= ? AND dtend >= ? '
+            'AND recs_float.calendar_id IN ({calendars})', (dtime, dtime))
+        result = self.sql_stream(sql_s, stuple)
         for item, href, start, end, ref, etag, dtype, calendar in result:
             start = datetime.utcfromtimestamp(start)
             end = datetime.utcfromtimestamp(end)
-            yield self.construct_event(item, href, start, end, ref, etag, calendar, dtype)
+            event = self.construct_event(item, href, start, end, ref, etag, calendar, dtype)
+            if event is not None:
+                yield event
+        for day, (href, etag, item, calendar) in birthdays:
+            yield self._construct_birthday(item, href, etag, calendar, day)
+
+    def _birthdays(self, first, last, columns='href, etag, item, calendars.calendar'):
+        """return the birthdays on the days from `first` to `last` (inclusive)
+
+        Birthdays are not expanded, for every year in question we look up those
+        with their month and day in the respective part of that year. Birthdays
+        on February 29th are celebrated on February 28th in other years.
+
+        :type first: datetime.date
+        :type last: datetime.date
+        :param columns: the columns of each birthday to return
+        :rtype: generator of (datetime.date, tuple), ordered by the date
+        """
+        select = (
+            'SELECT month_day, ' + columns + ' FROM {schema}.birthdays '
+            'JOIN {schema}.events ON birthdays.event_id = events.id '
+            'JOIN {schema}.calendars ON events.calendar_id = calendars.id '
+            'JOIN {schema}.vevents ON birthdays.event_id = vevents.event_id WHERE '
+            'month_day BETWEEN ? AND ? AND year <= ? '
+            'AND birthdays.calendar_id IN ({calendars})')
+        for year in range(first.year, last.year + 1):
+            low = first.month * 100 + first.day if year == first.year else 101
+            high = last.month * 100 + last.day if year == last.year else 1231
+            if high == 228 and not isleap(year):
+                high = 229
+            sql_s, stuple = self._union(select, (low, high, year))
+            for row in self.sql_stream(sql_s + ' ORDER BY month_day;', stuple):
+                yield _birthday(year, row[0]), row[1:]
+
+    def _construct_birthday(self, item, href, etag, calendar, day):
+        """construct the instance of a birthday event on `day`"""
+        start = datetime.combine(day, time.min)
+        return self.construct_event(
+            item, href, start, start + timedelta(days=1), None, etag, calendar, DATE)
+
+    def get_range(self, start, end):
+        """return all floating and localized events between `start` and `end`
+
+        Both tables are queried at once and the results are ordered by their
+        start. No items are parsed, the events returned are LightEvents built
+        from the properties saved for each VEVENT.
+
+        :param start: start of the time range in local time
+        :type start: datetime.datetime
+        :param end: end of the time range in local time
+        :type end: datetime.datetime
+        :returns: the event, whether it is floating and its start and end as
+                  saved in the db
+        :rtype: generator of (LightEvent, bool, int, int)
+        """
+        assert start.tzinfo is None
+        assert end.tzinfo is None
+        localize = self.locale['local_timezone'].localize
+        birthdays = self._birthdays(
+            start.date(), end.date(),
+            'href, etag, calendars.calendar, uid, summary, location, description, '
+            'recurring, x_birthday, x_fname')
+        self._expand(aux.to_unix_time(end))
+        select = (
+            'SELECT href, dtstart, dtend, {0}.ref, etag, dtype, calendars.calendar, {1}, '
+            'uid, summary, location, description, recurring, x_birthday, x_fname '
+            'FROM {{schema}}.{0} JOIN {{schema}}.events ON {0}.event_id = events.id '
+            'JOIN {{schema}}.calendars ON events.calendar_id = calendars.id '
+            'JOIN {{schema}}.vevents ON '
+            '{0}.event_id = vevents.event_id AND {0}.ref IS vevents.ref WHERE '
+            '{2} AND {0}.calendar_id IN ({{calendars}})')
+        loc_s, loc_stuple = self._union(
+            select.format('recs_loc', 0, OVERLAPS),
+            (aux.to_unix_time(localize(end)), aux.to_unix_time(localize(start)),
+             aux.to_unix_time(localize(start))))
+        float_s, float_stuple = self._union(
+            select.format('recs_float', 1, OVERLAPS),
+            (aux.to_unix_time(end), aux.to_unix_time(start), aux.to_unix_time(start)))
+        result = self.sql_stream(loc_s + ' UNION ALL ' + float_s + ' ORDER BY dtstart;',
+                                 loc_stuple + float_stuple)
+
+        def birthday_rows():
+            for day, row in birthdays:
+                dbstart = aux.to_unix_time(datetime.combine(day, time.min))
+                href, etag, calendar = row[:3]
+                yield (href, dbstart, dbstart + 24 * 3600, None, etag, DATE, calendar, 1) + \
+                    row[3:]
+
+        # both are ordered by their start, the counter makes sure the rows
+        # themselves are never compared
+        counter = count()
+        result = heapq.merge(((row[1], next(counter), row) for row in result),
+                             ((row[1], next(counter), row) for row in birthday_rows()))
+        for _, _, row in result:
+            href, dbstart, dbend, ref, etag, dtype, calendar, floating = row[:8]
+            start = datetime.utcfromtimestamp(dbstart)
+            end = datetime.utcfromtimestamp(dbend)
+            if dtype == DATE:
+                start = start.date()
+                end = end.date()
+            elif not floating:
+                start = pytz.UTC.localize(start)
+                end = pytz.UTC.localize(end)
+            event = LightEvent.create(
+                partial(self._get_vevents, href, calendar), row[8:], ref=_ref(ref),
+                locale=self.locale, href=href, calendar=calendar, etag=etag,
+                start=start, end=end)
+            yield event, bool(floating), dbstart, dbend
+
+    def get_day_calendars(self, start, end):
+        """return the calendars with events on each day from `start` to `end`
+
+        One aggregate query tests all instances (and birthdays) against the
+        bounds of every day, the events' items are never read.
+
+        :type start: datetime.date
+        :param end: last day (inclusive)
+        :type end: datetime.date
+        :rtype: generator of (datetime.date, str), ordered by the date
+        """
+        if end < start:
+            return
+        localize = self.locale['local_timezone'].localize
+        days = list()
+        for num in range((end - start).days + 1):
+            day = start + timedelta(days=num)
+            day_start = datetime.combine(day, time.min)
+            day_end = datetime.combine(day, time.max)
+            month_day = day.month * 100 + day.day
+            # birthdays on February 29th are celebrated on February 28th
+            leap_day = 229 if month_day == 228 and not isleap(day.year) else month_day
+            days.append((day.toordinal(),
+                         aux.to_unix_time(localize(day_start)),
+                         aux.to_unix_time(localize(day_end)),
+                         aux.to_unix_time(day_start), aux.to_unix_time(day_end),
+                         day.year, month_day, leap_day))
+        self._expand(days[-1][4])
+        # the days' values are all integers we calculated ourselves, they are
+        # part of the statement as binding them would soon hit SQLite's limit
+        # on the number of variables
+        values = ', '.join('({0})'.format(', '.join(str(int(value)) for value in day))
+                           for day in days)
+        instances = (
+            'SELECT days.day AS day, calendars.calendar AS calendar '
+            'FROM {{schema}}.{0} CROSS JOIN days JOIN {{schema}}.calendars ON '
+            '{0}.calendar_id = calendars.id WHERE ' + OVERLAPS + ' AND '
+            'dtstart <= days.{1}_end AND dtend >= days.{1}_start AND '
+            '(dtend > days.{1}_start OR dtstart = dtend) '
+            'AND {0}.calendar_id IN ({{calendars}})')
+        loc_s, loc_stuple = self._union(
+            instances.format('recs_loc', 'loc'), (days[-1][2], days[0][1], days[0][1]))
+        float_s, float_stuple = self._union(
+            instances.format('recs_float', 'float'), (days[-1][4], days[0][3], days[0][3]))
+        bday_s, bday_stuple = self._union(
+            'SELECT days.day AS day, calendars.calendar AS calendar '
+            'FROM days JOIN {schema}.birthdays ON '
+            'birthdays.month_day IN (days.month_day, days.leap_day) AND '
+            'birthdays.year <= days.year JOIN {schema}.calendars ON '
+            'birthdays.calendar_id = calendars.id '
+            'WHERE birthdays.calendar_id IN ({calendars})')
+        sql_s = (
+            'WITH days (day, loc_start, loc_end, float_start, float_end, year, month_day, '
+            'leap_day) AS (VALUES {0}) SELECT day, calendar FROM ({1} UNION ALL {2} '
+            'UNION ALL {3}) GROUP BY day, calendar ORDER BY day, calendar;'.format(
+                values, loc_s, float_s, bday_s))
+        for day, calendar in self.sql_stream(sql_s, loc_stuple + float_stuple + bday_stuple):
+            yield date.fromordinal(day), calendar
+
+    def _zdict(self, schema):
+        """the preset dictionary for compressing items in `schema`
+
+        :returns: its id and the dictionary, None if there is none (yet)
+        :rtype: tuple(int, bytes) or None
+        """
+        if schema not in self._zdicts:
+            result = self.sql_ex('SELECT id, zdict FROM {0}.zdicts LIMIT 1;'.format(schema))
+            self._zdicts[schema] = result[0] if result else None
+        return self._zdicts[schema]
+
+    def _deflate(self, item, calendar):
+        """compress `item` for saving it in `calendar`"""
+        zdict = self._zdict(self._schema(calendar))
+        return deflate(item, zdict[1] if zdict is not None else None)
+
+    def _item(self, item, href, calendar):
+        """return the text of the event at `href` from `item` as saved in the
+        db, which is decompressed (or read from the event's file) if needed"""
+        if item is None:
+            return self._read_item(href, calendar)
+        if not isinstance(item, bytes):
+            return item
+        zdict_id = _zdict_id(item)
+        if zdict_id is None:
+            return inflate(item)
+        key = self._schema(calendar), zdict_id
+        if key not in self._zdicts_by_id:
+            sql_s = 'SELECT zdict FROM {0}.zdicts WHERE id = ?;'.format(key[0])
+            self._zdicts_by_id[key] = self.sql_ex(sql_s, (zdict_id, ))[0][0]
+        return inflate(item, self._zdicts_by_id[key])
+
+    def _read_item(self, href, calendar):
+        """read the event at `href` from its file in the vdir of `calendar`
+
+        If the file changed since the db was last updated (e.g. while a daemon
+        skipped updating it), the event is read again and, if no other khal
+        instance is updating the db right then, saved again.
+
+        :raises ChangedFileError: if the file doesn't exist any more or cannot
+                                  be read again
+        """
+        sql_s = 'SELECT inode, size, mtime_ns FROM {0}.files WHERE calendar = ? AND name = ?;'
+        snapshot = self.sql_ex(sql_s.format(self._schema(calendar)), (calendar, href))
+        fpath = path.join(self._vdirs.get(calendar, ''), href)
+        try:
+            with open(fpath, 'rb') as vfile:
+                stat = fstat(vfile.fileno())
+                text = vfile.read().decode('utf-8')
+        except (IOError, OSError):
+            raise ChangedFileError(fpath)
+        stat = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if [stat] != snapshot:
+            logger.info('{0} changed since khal last read it, reading it again'.format(fpath))
+            self._reindex(text, href, calendar, stat)
+        return text
+
+    def _reindex(self, text, href, calendar, stat):
+        """save the event at `href` again, after its file changed to `text`
+        with `stat`, see `_read_item`"""
+        fpath = path.join(self._vdirs[calendar], href)
+        with self.writer_lock([calendar], blocking=False) as locked:
+            if not locked:
+                logger.debug('not saving {0} again, the db is being updated'.format(fpath))
+                return
+            try:
+                etag = get_etag_from_file(fpath)
+                with self.at_once():
+                    self.update(text, href, etag, calendar=calendar)
+                    self.set_file(calendar, href, stat)
+            except sqlite3.OperationalError as error:
+                logger.warning('cannot save {0} again: {1}'.format(fpath, error))
+            except Exception as error:
+                logger.warning('cannot read {0} again: {1}'.format(fpath, error))
+                raise ChangedFileError(fpath)
+
+    def train_zdicts(self, calendars):
+        """train a preset dictionary for compressing the items of
+        `calendars` and compress those items with it
+
+        This is done once for each schema, as soon as it holds enough items to
+        learn from, items saved later are compressed with the same dictionary.
+        """
+        for schema in sorted(set(self._schema(calendar) for calendar in calendars)):
+            # another khal instance might have trained one in the meantime
+            self._zdicts.pop(schema, None)
+            if self._zdict(schema) is not None:
+                continue
+            n_items, = self.sql_ex(
+                'SELECT count(*) FROM {0}.events WHERE item IS NOT NULL;'.format(schema))[0]
+            if n_items < ZDICT_MIN_ITEMS:
+                continue
+            sql_s = ('SELECT item, href, calendars.calendar FROM {0}.events '
+                     'JOIN {0}.calendars ON events.calendar_id = calendars.id '
+                     'WHERE item IS NOT NULL ORDER BY random() LIMIT ?;'.format(schema))
+            zdict = train_zdict([self._item(item, href, calendar) for item, href, calendar in
+                                 self.sql_ex(sql_s, (ZDICT_SAMPLES, ))])
+            if not zdict:
+                continue
+            size, compressed = 0, 0
+            with self.at_once():
+                self.sql_ex('INSERT OR REPLACE INTO {0}.zdicts (id, zdict) VALUES (?, ?);'.format(
+                    schema), (zlib.adler32(zdict), zdict))
+                self._zdicts[schema] = zlib.adler32(zdict), zdict
+                sql_s = ('SELECT events.id, item, href, calendars.calendar FROM {0}.events '
+                         'JOIN {0}.calendars ON events.calendar_id = calendars.id '
+                         'WHERE events.id > ? AND item IS NOT NULL '
+                         'ORDER BY events.id LIMIT 1000;'.format(schema))
+                rows = self.sql_ex(sql_s, (0, ))
+                while rows:
+                    updates = list()
+                    for event_id, item, href, calendar in rows:
+                        text = self._item(item, href, calendar)
+                        updates.append((deflate(text, zdict), event_id))
+                        size += len(text.encode('utf-8'))
+                        compressed += len(updates[-1][0])
+                    self.sql_many('UPDATE {0}.events SET item = ? WHERE id = ?;'.format(schema),
+                                  updates)
+                    rows = self.sql_ex(sql_s, (event_id, ))
+            logger.debug(
+                'compressed {0} items in {1} with a {2} byte dictionary from {3} to {4} bytes '
+                '(ratio {5:.1f})'.format(n_items, schema, len(zdict), size, compressed,
+                                         size / max(compressed, 1)))
+
+    def _get_vevents(self, href, calendar):
+        """return the parsed VEVENTs of the event at `href`, sorted by ref"""
+        sql_s = 'SELECT item FROM {0}.events WHERE href = ? AND calendar_id = ?;'.format(
+            self._schema(calendar))
+        item = self._item(self.sql_query(sql_s, (href, self._calendar_id(calendar)))[0][0],
+                          href, calendar)
+        vevents = [vevent for vevent in icalendar.Calendar.from_ical(item).walk()
+                   if vevent.name == 'VEVENT']
+        return vevents_by_ref(vevents, self.locale)
 
     def get(self, href, start=None, end=None, ref=None, dtype=None, calendar=None):
         """returns the Event matching href
@@ -542,13 +1486,14 @@ class SQLiteDb(object):
         returned, otherwise the Event returned exactly as saved in the db
         """
         assert calendar is not None
-        sql_s = 'SELECT href, etag, item FROM events WHERE href = ? AND calendar = ?;'
-        result = self.sql_ex(sql_s, (href, calendar))
+        sql_s = ('SELECT href, etag, item FROM {0}.events '
+                 'WHERE href = ? AND calendar_id = ?;'.format(self._schema(calendar)))
+        result = self.sql_query(sql_s, (href, self._calendar_id(calendar)))
         href, etag, item = result[0]
         if dtype == DATE:
             start = start.date()
             end = end.date()
-        return Event.fromString(item,
+        return Event.fromString(self._item(item, href, calendar),
                                 locale=self.locale,
                                 href=href,
                                 calendar=calendar,
@@ -559,9 +1504,19 @@ class SQLiteDb(object):
                                 )
 
     def construct_event(self, item, href, start, end, ref, etag, calendar, dtype=None):
+        """construct the event (instance) of a row of a query
+
+        :returns: None if the event's file was deleted since the db was last
+                  updated, see `_read_item`
+        """
         if dtype == DATE:
             start = start.date()
             end = end.date()
+        try:
+            item = self._item(item, href, calendar)
+        except ChangedFileError as error:
+            logger.warning('Skipping {0}/{1}: {2}'.format(calendar, href, error))
+            return None
         return Event.fromString(item,
                                 locale=self.locale,
                                 href=href,
@@ -569,18 +1524,565 @@ class SQLiteDb(object):
                                 etag=etag,
                                 start=start,
                                 end=end,
-                                ref=ref,
+                                ref=_ref(ref),
                                 )
 
-    def search(self, search_string):
-        """search for events matching `search_string`"""
-        sql_s = ('SELECT href, calendar FROM events '
-                 'WHERE item LIKE (?) and calendar in ({0});')
-        stuple = ('%{0}%'.format(search_string), )
-        result = self.sql_ex(sql_s.format(self._select_calendars), stuple)
-        for href, calendar in result:
-            event = self.get(href, calendar=calendar)
-            yield event
+    def search(self, search_string, limit=None):
+        """search for events matching `search_string`
+
+        Summary, description, location and attendees are searched for all
+        words in `search_string` (or words starting with them), the best
+        matches are returned first. Results are fetched page by page.
+
+        :param limit: return at most this many events
+        :type limit: int or None
+        :rtype: generator of Event
+        """
+        if not self._fts:
+            for event in self._search_like(search_string, limit):
+                yield event
+            return
+        query = ' '.join('"{0}"*'.format(word.replace('"', '""'))
+                         for word in search_string.split())
+        if not query:
+            return
+        select = ('SELECT href, calendars.calendar, etag, item, '
+                  'events_fts.rank AS rank, {{shard}} AS shard, events_fts.rowid AS fts_rowid '
+                  'FROM {{schema}}.events_fts JOIN {{schema}}.events ON '
+                  'events_fts.rowid = events.id JOIN {{schema}}.calendars ON '
+                  'events.calendar_id = calendars.id WHERE '
+                  'events_fts MATCH ? {0}AND events.calendar_id IN ({{calendars}})')
+        after = ''
+        stuple = (query, )
+        seen = 0
+        while limit is None or seen < limit:
+            page_size = SEARCH_PAGE_SIZE if limit is None else \
+                min(SEARCH_PAGE_SIZE, limit - seen)
+            sql_s, stuples = self._union(select.format(after), stuple)
+            result = self.sql_stream(sql_s + ' ORDER BY rank, shard, fts_rowid LIMIT ?;',
+                                     stuples + (page_size, ))
+            found = 0
+            for href, calendar, etag, item, rank, shard, rowid in result:
+                found += 1
+                event = self.construct_event(item, href, None, None, None, etag, calendar)
+                if event is not None:
+                    yield event
+            seen += found
+            if found < page_size:
+                break
+            # keyset pagination, continue after the last result
+            after = ('AND (events_fts.rank > ? OR (events_fts.rank = ? AND '
+                     '({shard} > ? OR ({shard} = ? AND events_fts.rowid > ?)))) ')
+            stuple = (query, rank, rank, shard, shard, rowid)
+
+    def _search_like(self, search_string, limit):
+        """search without the full text index"""
+        sql_s, stuple = self._union(
+            'SELECT DISTINCT href, calendars.calendar, etag, item '
+            'FROM {schema}.vevents JOIN {schema}.events ON vevents.event_id = events.id '
+            'JOIN {schema}.calendars ON events.calendar_id = calendars.id WHERE '
+            '(summary LIKE (?) OR description LIKE (?) OR location LIKE (?)) '
+            'AND events.calendar_id IN ({calendars})', ('%{0}%'.format(search_string), ) * 3)
+        result = self.sql_stream(sql_s + ' LIMIT ?;',
+                                 stuple + (-1 if limit is None else limit, ))
+        for href, calendar, etag, item in result:
+            event = self.construct_event(item, href, None, None, None, etag, calendar)
+            if event is not None:
+                yield event
+
+
+Prepared = namedtuple('Prepared', ['item', 'props', 'instances', 'search', 'expanded_until',
+                                   'birthday'])
+Prepared.__doc__ = """everything :meth:`SQLiteDb.write` needs to save an event"""
+
+
+def prepare(vevent_str, href, calendar, default_timezone, until, vevents=None):
+    """parse, check and expand `vevent_str` for :meth:`SQLiteDb.write`
+
+    This doesn't need the db and the result can be pickled, so it can be run
+    in other processes.
+
+    :param until: expand RRULEs recurring forever up to here
+    :type until: datetime.datetime
+    :param vevents: the VEVENTs in `vevent_str`, if they have been parsed
+                    already (e.g. when saving an Event), copies of them are
+                    used instead of parsing `vevent_str` again
+    :type vevents: list(icalendar.Event)
+    :rtype: Prepared
+    """
+    if vevents is None:
+        ical = icalendar.Event.from_ical(vevent_str)
+        vevents = [c for c in ical.walk() if c.name == 'VEVENT']
+    else:
+        vevents = [_copy_vevent(vevent) for vevent in vevents]
+    vevents = sorted((aux.sanitize(c, default_timezone, href, calendar) for
+                      c in vevents), key=sort_key)
+    for vevent in vevents:
+        check_support(vevent, href, calendar)
+    return _prepare_vevents(vevent_str, vevents, href, calendar, until)
+
+
+def _copy_vevent(vevent):
+    """copy `vevent`, so that sanitizing and expanding the copy (which changes
+    some of its properties in place) leaves `vevent` untouched"""
+    copied = icalendar.Event()
+    for name, value in vevent.items():
+        if isinstance(value, list):
+            copied[name] = [copy.copy(one) for one in value]
+        elif isinstance(value, icalendar.vRecur):
+            # when parsed, every part of an RRULE is a list
+            copied[name] = icalendar.vRecur(
+                (key, part if isinstance(part, list) else [part])
+                for key, part in value.items())
+        else:
+            copied[name] = copy.copy(value)
+    return copied
+
+
+def prepare_birthday(vcard_str, href, calendar):
+    """create a yearly recurring event from the birthday in `vcard_str` and
+    prepare it like :func:`prepare`
+
+    The event is not expanded, its instances are calculated from its month and
+    day when querying the db (see :meth:`SQLiteDb._birthdays`).
+
+    :returns: None if the vcard has no (parsable) birthday
+    :rtype: Prepared or None
+    """
+    ical = icalendar.Event.from_ical(vcard_str)
+    vcard = ical.walk()[0]
+    if 'BDAY' not in vcard.keys():
+        return None
+    bday = vcard['BDAY']
+    try:
+        if bday[0:2] == '--' and bday[3] != '-':
+            bday = '{0}{1}'.format(BDAY_NO_YEAR, bday[2:].replace('-', ''))
+            orig_bday = False
+        else:
+            orig_bday = True
+        bday = parser.parse(bday).date()
+    except ValueError:
+        logger.info('cannot parse BIRTHDAY in {0} in collection '
+                    '{1}'.format(href, calendar))
+        return None
+    if 'FN' in vcard:
+        name = vcard['FN']
+    else:
+        n = vcard['N'].split(';')
+        name = ' '.join([n[1], n[2], n[0]])
+    event = icalendar.Event()
+    event.add('dtstart', bday)
+    event.add('dtend', bday + timedelta(days=1))
+    event.add('summary', '{0}\'s birthday'.format(name))
+    event.add('rrule', {'freq': 'YEARLY'})
+    if orig_bday:
+        event.add('x-birthday',
+                  '{:04}{:02}{:02}'.format(bday.year, bday.month, bday.day))
+        event.add('x-fname', name)
+    event.add('uid', href)
+    event_str = event.to_ical().decode('utf-8')
+    return Prepared(event_str, [_props(event)], [], _search_texts([event]), None,
+                    (bday.month * 100 + bday.day, bday.year))
+
+
+def _birthday(year, month_day):
+    """the day in `year` of a birthday on `month_day` (month * 100 + day),
+    February 29th is celebrated on February 28th in other years
+
+    :rtype: datetime.date
+    """
+    month, day = divmod(month_day, 100)
+    if month == 2 and day == 29 and not isleap(year):
+        day = 28
+    return date(year, month, day)
+
+
+def train_zdict(items, size=ZDICT_SIZE):
+    """build a preset dictionary for compressing `items` with zlib
+
+    zlib refers to strings in the dictionary like to data it has already
+    compressed, so it is made of the lines found in more than one item (i.e.
+    VTIMEZONEs, PRODIDs, TZIDs...), preferring those which save the most
+    space, in the order they appear in the items
+
+    :type items: list(str)
+    :rtype: bytes
+    """
+    counts = Counter()
+    first = dict()
+    for item in items:
+        lines = item.encode('utf-8').splitlines(True)
+        for line in lines:
+            first.setdefault(line, len(first))
+        counts.update(set(lines))
+    chosen, length = list(), 0
+    for line in sorted((line for line, times in counts.items() if times > 1),
+                       key=lambda line: counts[line] * len(line), reverse=True):
+        if length + len(line) <= size:
+            chosen.append(line)
+            length += len(line)
+    return b''.join(sorted(chosen, key=first.get))
+
+
+def deflate(item, zdict=None):
+    """compress `item` with zlib, using the preset dictionary `zdict`
+
+    :type item: str
+    :type zdict: bytes or None
+    :rtype: bytes
+    """
+    if zdict:
+        compressor = zlib.compressobj(zdict=zdict)
+    else:
+        compressor = zlib.compressobj()
+    return compressor.compress(item.encode('utf-8')) + compressor.flush()
+
+
+def inflate(compressed, zdict=None):
+    """decompress an item compressed with :func:`deflate`
+
+    :type compressed: bytes
+    :type zdict: bytes or None
+    :rtype: str
+    """
+    if zdict:
+        decompressor = zlib.decompressobj(zdict=zdict)
+    else:
+        decompressor = zlib.decompressobj()
+    return (decompressor.decompress(compressed) + decompressor.flush()).decode('utf-8')
+
+
+def _zdict_id(compressed):
+    """the id (Adler-32 checksum) of the preset dictionary `compressed` needs,
+    as noted in its zlib header, or None if it needs none"""
+    if not compressed[1] & 0x20:  # FDICT
+        return None
+    return int.from_bytes(compressed[2:6], 'big')
+
+
+def _prepare_vevents(item, vevents, href, calendar, until):
+    """:rtype: Prepared"""
+    # expanding makes DTSTART naive, so everything else needs to be done first
+    props = [_props(vevent) for vevent in vevents]
+    search = _search_texts(vevents)
+    if any(aux.is_unbounded(vevent) for vevent in vevents):
+        expanded_until = aux.to_unix_time(until)
+    else:
+        expanded_until = None
+    instances = [_instances(vevent, href, calendar, until=until) for vevent in vevents]
+    instances = [instance for instance in instances if instance is not None]
+    return Prepared(item, props, instances, search, expanded_until, None)
+
+
+def _instances(vevent, href, calendar, since=None, until=None):
+    """expand `vevent`'s reccurence rules (if needed) and return all instances
+    for inserting them into the respective table
+
+    instances of RRULEs recurring forever are only returned between `since`
+    and `until`, see :func:`aux.expand`
+
+    :returns: the table, the instances to insert (rec_inst, start, end, ref
+              and dtype of each) and the shift to apply to this and all future
+              instances (for THISANDFUTURE overrides), or None if `vevent` has
+              no instances
+    :rtype: tuple(str, list(tuple), tuple or None) or None
+    """
+    # TODO FIXME this function is a steaming pile of shit
+    rec_id = vevent.get(RECURRENCE_ID)
+    if rec_id is None:
+        rrange = None
+    else:
+        rrange = rec_id.params.get('RANGE')
+
+    # testing on datetime.date won't work as datetime is a child of date
+    if not isinstance(vevent['DTSTART'].dt, datetime):
+        dtype = DATE
+    else:
+        dtype = DATETIME
+    if ('TZID' in vevent['DTSTART'].params and dtype == DATETIME) or \
+            getattr(vevent['DTSTART'].dt, 'tzinfo', None):
+        recs_table = 'recs_loc'
+    else:
+        recs_table = 'recs_float'
+
+    if rrange == THISANDFUTURE:
+        # calculate this before expanding, which makes DTSTART naive
+        start_shift, duration = calc_shift_deltas(vevent)
+        start_shift = start_shift.days * 3600 * 24 + start_shift.seconds
+        duration = duration.days * 3600 * 24 + duration.seconds
+
+    dtstartend = aux.expand(vevent, href, since=since, until=until)
+    if not dtstartend:
+        # Does this event even have dates? Technically it is possible for
+        # events to be empty/non-existent by deleting all their recurrences
+        # through EXDATE.
+        return None
+
+    if rec_id is not None:
+        rec_inst = aux.to_unix_time(rec_id.dt)
+
+    if rrange == THISANDFUTURE:
+        # shift all following instances at once
+        shift = (start_shift, start_shift + duration, rec_inst, rec_inst)
+        return recs_table, None, shift
+
+    if rec_id is not None:
+        stuples = [(rec_inst, aux.to_unix_time(dtstart), aux.to_unix_time(dtend), rec_inst,
+                    dtype) for dtstart, dtend in dtstartend]
+    else:
+        stuples = [(aux.to_unix_time(dtstart), aux.to_unix_time(dtstart),
+                    aux.to_unix_time(dtend), None, dtype)
+                   for dtstart, dtend in dtstartend]
+    return recs_table, stuples, None
+
+
+def _props(vevent):
+    """return the properties needed for displaying `vevent`, for inserting
+    them into the vevents table"""
+    rec_id = vevent.get(RECURRENCE_ID)
+    if rec_id is None:
+        ref = None
+    else:
+        ref = aux.to_unix_time(rec_id.dt)
+    props = [vevent.get(prop) for prop in
+             ['UID', 'SUMMARY', 'LOCATION', 'DESCRIPTION', 'X-BIRTHDAY', 'X-FNAME']]
+    props = [None if prop is None else str(prop) for prop in props]
+    uid, summary, location, description, bday, fname = props
+    recurring = int(any(prop in vevent for prop in ['RRULE', RECURRENCE_ID, 'RDATE']))
+    return (ref, uid, summary, location, description, recurring, bday, fname)
+
+
+def _search_texts(vevents):
+    """return the searchable properties of all `vevents`, for inserting them
+    into the full text index"""
+    texts = dict((prop, list()) for prop in ['SUMMARY', 'DESCRIPTION', 'LOCATION'])
+    attendees = list()
+    for vevent in vevents:
+        for prop in texts:
+            if prop in vevent:
+                texts[prop].append(str(vevent[prop]))
+        for attendee in _as_list(vevent.get('ATTENDEE', [])):
+            cn = attendee.params.get('CN', '')
+            attendees.append((cn + ' ' + attendee.split(':')[-1]).strip())
+    return tuple('\n'.join(texts[prop]) for prop in
+                 ['SUMMARY', 'DESCRIPTION', 'LOCATION']) + ('\n'.join(attendees), )
+
+
+def _migrate_5(db):
+    """indexes for looking up instances by their time"""
+    for table in ['recs_loc', 'recs_float']:
+        for column in ['dtstart', 'dtend']:
+            db.sql_ex('CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} (calendar, {1});'.format(
+                table, column))
+
+
+def _migrate_6(db):
+    """the properties needed for displaying VEVENTs"""
+    db.sql_ex('''CREATE TABLE IF NOT EXISTS vevents (
+        href TEXT NOT NULL,
+        calendar TEXT NOT NULL,
+        ref TEXT NOT NULL,
+        uid TEXT,
+        summary TEXT,
+        location TEXT,
+        description TEXT,
+        recurring INT NOT NULL,
+        x_birthday TEXT,
+        x_fname TEXT,
+        primary key (href, calendar, ref)
+        );''')
+    return _backfill_props
+
+
+def _migrate_7(db):
+    """full text index"""
+    try:
+        db.sql_ex('''CREATE VIRTUAL TABLE IF NOT EXISTS events_fts USING fts5(
+            summary, description, location, attendees,
+            href UNINDEXED, calendar UNINDEXED
+            );''')
+    except sqlite3.OperationalError:
+        return None
+    return _backfill_search
+
+
+def _migrate_8(db):
+    """instances of events recurring forever are saved up to a horizon"""
+    db.sql_ex('ALTER TABLE events ADD COLUMN expanded_until INT;')
+    db.sql_ex('CREATE INDEX IF NOT EXISTS events_expanded_until '
+              'ON events (calendar, expanded_until);')
+    return _backfill_expanded_until
+
+
+def _migrate_9(db):
+    """inode, size and mtime of all files in the vdirs"""
+    db.sql_ex('''CREATE TABLE IF NOT EXISTS files (
+        calendar TEXT NOT NULL,
+        name TEXT NOT NULL,
+        inode INT NOT NULL,
+        size INT NOT NULL,
+        mtime_ns INT NOT NULL,
+        primary key (calendar, name)
+        );''')
+
+
+def _migrate_10(db):
+    """integer ids for calendars and events, compact instance tables"""
+    for table in ['calendars', 'events', 'recs_loc', 'recs_float', 'vevents']:
+        db.sql_ex('ALTER TABLE {0} RENAME TO {0}_10;'.format(table))
+    db.sql_ex('''CREATE TABLE calendars (
+        id INTEGER PRIMARY KEY,
+        calendar TEXT NOT NULL UNIQUE,
+        resource TEXT NOT NULL,
+        ctag TEXT
+        );''')
+    db.sql_ex('INSERT INTO calendars (calendar, resource, ctag) '
+              'SELECT calendar, resource, ctag FROM calendars_10;')
+    db.sql_ex('INSERT OR IGNORE INTO calendars (calendar, resource) '
+              'SELECT DISTINCT calendar, \'\' FROM events_10;')
+    db.sql_ex('''CREATE TABLE events (
+        id INTEGER PRIMARY KEY,
+        href TEXT NOT NULL,
+        calendar_id INT NOT NULL,
+        sequence INT,
+        etag TEXT,
+        item TEXT,
+        expanded_until INT,
+        UNIQUE (href, calendar_id)
+        );''')
+    db.sql_ex('INSERT INTO events (href, calendar_id, sequence, etag, item, expanded_until) '
+              'SELECT href, calendars.id, sequence, etag, item, expanded_until '
+              'FROM events_10 JOIN calendars ON events_10.calendar = calendars.calendar;')
+    # the old tables are joined to the new ones by their href and calendar
+    join = ('{0}_10 JOIN calendars ON {0}_10.calendar = calendars.calendar '
+            'JOIN events ON {0}_10.href = events.href AND events.calendar_id = calendars.id')
+    ref = 'CASE {0}_10.ref WHEN \'PROTO\' THEN NULL ELSE CAST({0}_10.ref AS INT) END'
+    for table in ['recs_loc', 'recs_float']:
+        db.sql_ex('''CREATE TABLE {0} (
+            event_id INT NOT NULL,
+            rec_inst INT NOT NULL,
+            calendar_id INT NOT NULL,
+            dtstart INT NOT NULL,
+            dtend INT NOT NULL,
+            ref INT,
+            dtype INT NOT NULL,
+            primary key (event_id, rec_inst)
+            ) WITHOUT ROWID;'''.format(table))
+        db.sql_ex(
+            'INSERT INTO {0} (event_id, rec_inst, calendar_id, dtstart, dtend, ref, dtype) '
+            'SELECT events.id, CAST(rec_inst AS INT), calendars.id, dtstart, dtend, {1}, dtype '
+            'FROM {2};'.format(table, ref.format(table), join.format(table)))
+    db.sql_ex('''CREATE TABLE vevents (
+        event_id INT NOT NULL,
+        ref INT,
+        uid TEXT,
+        summary TEXT,
+        location TEXT,
+        description TEXT,
+        recurring INT NOT NULL,
+        x_birthday TEXT,
+        x_fname TEXT
+        );''')
+    db.sql_ex(
+        'INSERT INTO vevents (event_id, ref, uid, summary, location, description, recurring, '
+        'x_birthday, x_fname) '
+        'SELECT events.id, {0}, uid, summary, location, description, recurring, '
+        'x_birthday, x_fname FROM {1};'.format(ref.format('vevents'), join.format('vevents')))
+    if db.sql_ex("SELECT name FROM sqlite_master WHERE name = 'events_fts';"):
+        db.sql_ex('ALTER TABLE events_fts RENAME TO events_fts_10;')
+        db.sql_ex('''CREATE VIRTUAL TABLE events_fts USING fts5(
+            summary, description, location, attendees
+            );''')
+        db.sql_ex(
+            'INSERT INTO events_fts (rowid, summary, description, location, attendees) '
+            'SELECT events.id, events_fts_10.summary, events_fts_10.description, '
+            'events_fts_10.location, events_fts_10.attendees FROM {0};'.format(
+                join.format('events_fts')))
+        db.sql_ex('DROP TABLE events_fts_10;')
+    # this also drops their indexes, which are created anew afterwards
+    for table in ['recs_loc', 'recs_float', 'vevents', 'events', 'calendars']:
+        db.sql_ex('DROP TABLE {0}_10;'.format(table))
+
+
+def _migrate_11(db):
+    """birthdays are not expanded any more
+
+    The expanded birthday events are deleted (birthday calendars are the only
+    ones with .vcf files), as are the records of their files, so their vcards
+    are read again on the next update.
+    """
+    db.sql_ex('''CREATE TABLE IF NOT EXISTS birthdays (
+        event_id INT NOT NULL PRIMARY KEY,
+        calendar_id INT NOT NULL,
+        month_day INT NOT NULL,
+        year INT NOT NULL
+        ) WITHOUT ROWID;''')
+    db.sql_ex('CREATE INDEX IF NOT EXISTS birthdays_month_day '
+              'ON birthdays (calendar_id, month_day);')
+    birthdays = "SELECT id FROM events WHERE href LIKE '%.vcf'"
+    for table in ['recs_loc', 'recs_float', 'vevents']:
+        db.sql_ex('DELETE FROM {0} WHERE event_id IN ({1});'.format(table, birthdays))
+    if db.sql_ex("SELECT name FROM sqlite_master WHERE name = 'events_fts';"):
+        db.sql_ex('DELETE FROM events_fts WHERE rowid IN ({0});'.format(birthdays))
+    db.sql_ex("DELETE FROM events WHERE href LIKE '%.vcf';")
+    db.sql_ex("DELETE FROM files WHERE name LIKE '%.vcf';")
+
+
+def _migrate_12(db):
+    """preset dictionaries for compressing items, the items saved so far are
+    compressed once a dictionary has been trained"""
+    db.sql_ex('''CREATE TABLE IF NOT EXISTS zdicts (
+        id INTEGER PRIMARY KEY,
+        zdict BLOB NOT NULL
+        );''')
+
+
+def _migrate_13(db):
+    """the lines printed for events are cached"""
+    db.sql_ex(RENDERED_TABLE)
+
+
+def _backfill_props(db, event_id, href, calendar, vevents):
+    """the properties needed for displaying VEVENTs"""
+    db._write_props(calendar, event_id, [_props(vevent) for vevent in vevents])
+
+
+def _backfill_search(db, event_id, href, calendar, vevents):
+    """the full text index"""
+    db._write_search(calendar, event_id, _search_texts(vevents))
+
+
+def _backfill_expanded_until(db, event_id, href, calendar, vevents):
+    """up to when events recurring forever have been expanded"""
+    if any(aux.is_unbounded(vevent) for vevent in vevents):
+        # up to here those events have been expanded so far
+        expanded_until = aux.to_unix_time(datetime(2037, 12, 31))
+        db.sql_ex('UPDATE events SET expanded_until = ? WHERE id = ?;',
+                  (expanded_until, event_id))
+
+
+# the steps for upgrading a db from one version to the next, each step can
+# return a function (one of the `_backfill_*` functions above) which needs
+# to be called for each event in the db, with its parsed VEVENTs, once all
+# steps are done
+MIGRATIONS = {
+    5: _migrate_5,
+    6: _migrate_6,
+    7: _migrate_7,
+    8: _migrate_8,
+    9: _migrate_9,
+    10: _migrate_10,
+    11: _migrate_11,
+    12: _migrate_12,
+    13: _migrate_13,
+}
+
+
+def _as_list(prop):
+    """icalendar returns a list for properties which appear more than once"""
+    if isinstance(prop, list):
+        return prop
+    return [prop]
 
 
 def check_support(vevent, href, calendar):
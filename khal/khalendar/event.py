@@ -21,7 +21,9 @@
 
 """this module cointains the event model, hopefully soon in a cleaned up version"""
 
+from bisect import bisect_left, bisect_right
 from datetime import date, datetime, time, timedelta
+from functools import lru_cache
 
 import os
 import icalendar
@@ -32,6 +34,51 @@ from .aux import to_naive_utc, to_unix_time, invalid_timezone, delete_instance
 from ..log import logger
 
 
+def vevents_by_ref(events_list, locale):
+    """sort the VEVENTs of one event by their recurrence-id
+
+    :type events_list: list(icalendar.Event)
+    :param locale: used for VEVENTs with a RECURRENCE-ID in a timezone we do
+                   not understand
+    :returns: the VEVENTs, the proto event under 'PROTO', all others under
+              their recurrence-id in unix time
+    :rtype: dict
+    """
+    vevents = dict()
+    if len(events_list) == 1:
+        vevents['PROTO'] = events_list[0]  # TODO set mutable = False
+    else:
+        for event in events_list:
+            if 'RECURRENCE-ID' in event:
+                if invalid_timezone(event['RECURRENCE-ID']):
+                    default_timezone = locale['default_timezone']
+                    recur_id = default_timezone.localize(event['RECURRENCE-ID'].dt)
+                    ident = str(to_unix_time(recur_id))
+                else:
+                    ident = str(to_unix_time(event['RECURRENCE-ID'].dt))
+                vevents[ident] = event
+            else:
+                vevents['PROTO'] = event
+    return vevents
+
+
+# the symbols used when printing events, see Event.symbol_strings
+UNICODE_SYMBOLS = dict(
+    recurring='\N{Clockwise gapped circle arrow}',
+    range='\N{Left right arrow}',
+    range_end='\N{Rightwards arrow to bar}',
+    range_start='\N{Rightwards arrow from bar}',
+    right_arrow='\N{Rightwards arrow}'
+)
+ASCII_SYMBOLS = dict(
+    recurring='R',
+    range='<->',
+    range_end='->|',
+    range_start='|->',
+    right_arrow='->'
+)
+
+
 class Event(object):
     """base Event class for representing a *recurring instance* of an Event
 
@@ -43,9 +90,15 @@ class Event(object):
         all end times are as presented to a user, i.e. an event scheduled for
         only one day will have the same start and end date (even though the
         icalendar standard would have the end date be one day later)
+
+    As there can be a lot of events around (e.g. in ikhal's search results),
+    events have no __dict__, all their attributes are listed in __slots__.
     """
     allday = False
 
+    __slots__ = ('_vevents', '_locale', 'readonly', 'href', 'etag', 'calendar', 'ref',
+                 '_start', '_end', '_key', '_end_local', '_raw', 'color')
+
     def __init__(self, vevents, ref=None, **kwargs):
         """
         :param start: start datetime of this event instance
@@ -77,6 +130,11 @@ class Event(object):
                 self._end = self._start + self._vevents[self.ref]['DURATION'].dt
         else:
             self._end = end
+        # the sort key (which includes start_local) and end_local, computed
+        # when first needed
+        self._key = self._end_local = None
+        # see `raw`
+        self._raw = None
         if kwargs:
             raise TypeError('%s are invalid keyword arguments to this function' % kwargs.keys())
 
@@ -109,21 +167,7 @@ class Event(object):
         """
         assert isinstance(events_list, list)
 
-        vevents = dict()
-        if len(events_list) == 1:
-            vevents['PROTO'] = events_list[0]  # TODO set mutable = False
-        else:
-            for event in events_list:
-                if 'RECURRENCE-ID' in event:
-                    if invalid_timezone(event['RECURRENCE-ID']):
-                        default_timezone = kwargs['locale']['default_timezone']
-                        recur_id = default_timezone.localize(event['RECURRENCE-ID'].dt)
-                        ident = str(to_unix_time(recur_id))
-                    else:
-                        ident = str(to_unix_time(event['RECURRENCE-ID'].dt))
-                    vevents[ident] = event
-                else:
-                    vevents['PROTO'] = event
+        vevents = vevents_by_ref(events_list, kwargs.get('locale'))
         if ref is None:
             ref = 'PROTO'
 
@@ -146,15 +190,32 @@ class Event(object):
         return cls.fromVEvents(events, ref, **kwargs)
 
     def __lt__(self, other):
-        try:
-            return self.start_local <= other.start_local
-        except TypeError:  # not the same type (should be datetime and date)
-            if not isinstance(other.start_local, datetime):
-                return 0
-            elif not isinstance(self.start_local, datetime):
-                return 1
+        # allday events (with dates) come before all others (with datetimes)
+        return self.sort_key <= other.sort_key
+
+    @property
+    def sort_key(self):
+        """events are ordered by their start (in local time), allday events
+        before all others
+
+        As sorting compares the keys over and over again, this is computed only
+        once (together with start_local).
+
+        :rtype: tuple(bool, datetime.date or datetime.datetime, date or datetime)
+        """
+        if self._key is None:
+            start_local = self._to_local(self.start)
+            if isinstance(start_local, datetime):
+                # naive datetimes (in UTC) compare a lot faster than aware ones
+                utc = start_local.replace(tzinfo=None) - start_local.utcoffset()
+                self._key = (True, utc, start_local)
             else:
-                raise ValueError('Cannot compare events {} and {}'.format(self, other))
+                self._key = (False, start_local, start_local)
+        return self._key
+
+    def _to_local(self, dtime):
+        """return `dtime` (this event's start or end) in the local timezone"""
+        return dtime
 
     def update_start_end(self, start, end):
         """update start and end time of this event
@@ -167,6 +228,8 @@ class Event(object):
         if type(start) != type(end):  # flake8: noqa
             raise ValueError('DTSTART and DTEND should be of the same type (datetime or date)')
         self.__class__ = self._get_type_from_date(start)
+        self._key = self._end_local = None
+        self._changed()
 
         self._vevents[self.ref].pop('DTSTART')
         self._vevents[self.ref].add('DTSTART', start)
@@ -202,6 +265,7 @@ class Event(object):
             return icalendar.vRecur()
 
     def update_rrule(self, rrule):
+        self._changed()
         self._vevents['PROTO'].pop('RRULE')
         if rrule is not None:
             self._vevents['PROTO'].add('RRULE', rrule)
@@ -219,6 +283,7 @@ class Event(object):
         """update the SEQUENCE number, call before saving this event"""
         # TODO we might want to do this automatically in raw() everytime
         # the event has changed, this will f*ck up the tests though
+        self._changed()
         try:
             self._vevents[self.ref]['SEQUENCE'] += 1
         except KeyError:
@@ -226,32 +291,24 @@ class Event(object):
 
     @property
     def symbol_strings(self):
+        """the symbols used for printing this event (shared by all events, do
+        not modify)"""
         if self._locale['unicode_symbols']:
-            return dict(
-                recurring='\N{Clockwise gapped circle arrow}',
-                range='\N{Left right arrow}',
-                range_end='\N{Rightwards arrow to bar}',
-                range_start='\N{Rightwards arrow from bar}',
-                right_arrow='\N{Rightwards arrow}'
-            )
+            return UNICODE_SYMBOLS
         else:
-            return dict(
-                recurring='R',
-                range='<->',
-                range_end='->|',
-                range_start='|->',
-                right_arrow='->'
-            )
+            return ASCII_SYMBOLS
 
     @property
     def start_local(self):
         """self.start() localized to local timezone"""
-        return self.start
+        return self.sort_key[2]
 
     @property
     def end_local(self):
         """self.end() localized to local timezone"""
-        return self.end
+        if self._end_local is None:
+            self._end_local = self._to_local(self.end)
+        return self._end_local
 
     @property
     def start(self):
@@ -304,27 +361,24 @@ class Event(object):
     def raw(self):
         """needed for vdirsyncer comat
 
+        The text is kept until the event is changed (by any of the methods
+        changing it), as it is needed several times when saving the event.
+
         return text
         """
-        calendar = self._create_calendar()
-        tzs = list()
-        for vevent in self._vevents.values():
-            if hasattr(vevent['DTSTART'].dt, 'tzinfo') and vevent['DTSTART'].dt.tzinfo is not None:
-                tzs.append(vevent['DTSTART'].dt.tzinfo)
-            if 'DTEND' in vevent and hasattr(vevent['DTEND'].dt, 'tzinfo') and \
-                    vevent['DTEND'].dt.tzinfo is not None and \
-                    vevent['DTEND'].dt.tzinfo not in tzs:
-                tzs.append(vevent['DTEND'].dt.tzinfo)
-
-        for tzinfo in tzs:
-            if tzinfo == pytz.UTC:
-                continue
-            timezone = create_timezone(tzinfo, self.start)
-            calendar.add_component(timezone)
+        if self._raw is None:
+            calendar = self._create_calendar()
+            for tzinfo in used_timezones(self._vevents.values()):
+                calendar.add_component(create_timezone(tzinfo, self.start))
+
+            for vevent in self._vevents.values():
+                calendar.add_component(vevent)
+            self._raw = calendar.to_ical().decode('utf-8')
+        return self._raw
 
-        for vevent in self._vevents.values():
-            calendar.add_component(vevent)
-        return calendar.to_ical().decode('utf-8')
+    def _changed(self):
+        """to be called whenever the VEVENTs are changed"""
+        self._raw = None
 
     def export_ics(self, path):
         """export event as ICS
@@ -340,15 +394,20 @@ class Event(object):
 
     @property
     def summary(self):
-        bday = self._vevents[self.ref].get('x-birthday', None)
+        vevent = self._vevents[self.ref]
+        return self._summary(vevent.get('SUMMARY', ''),
+                             vevent.get('x-birthday', None),
+                             vevent.get('x-fname', None))
+
+    def _summary(self, summary, bday, name):
         if bday:
             number = self.start_local.year - int(bday[:4])
-            name = self._vevents[self.ref].get('x-fname', None)
             return '{name}\'s {number}th birthday'.format(name=name, number=number)
         else:
-            return self._vevents[self.ref].get('SUMMARY', '')
+            return summary
 
     def update_summary(self, summary):
+        self._changed()
         self._vevents[self.ref]['SUMMARY'] = summary
 
     @property
@@ -356,6 +415,7 @@ class Event(object):
         return self._vevents[self.ref].get('LOCATION', '')
 
     def update_location(self, location):
+        self._changed()
         self._vevents[self.ref]['LOCATION'] = location
 
     @property
@@ -363,6 +423,7 @@ class Event(object):
         return self._vevents[self.ref].get('DESCRIPTION', '')
 
     def update_description(self, description):
+        self._changed()
         self._vevents[self.ref]['DESCRIPTION'] = description
 
     @property
@@ -455,6 +516,7 @@ class Event(object):
     def delete_instance(self, instance):
         """delete an instance from this event"""
         assert self.recurring
+        self._changed()
         delete_instance(self._vevents['PROTO'], instance)
 
         # in case the instance we want to delete is specified as a RECURRENCE-ID
@@ -473,6 +535,8 @@ class Event(object):
 
 
 class DatetimeEvent(Event):
+    __slots__ = ()
+
     @property
     def _rangestr(self):
         # same day
@@ -492,6 +556,8 @@ class LocalizedEvent(DatetimeEvent):
     """
     see parent
     """
+    __slots__ = ()
+
     @property
     def start(self):
         """in case DTSTART has no tzinfo (or it is set to None) we assume
@@ -506,37 +572,26 @@ class LocalizedEvent(DatetimeEvent):
             return self._end
         return self._locale['default_timezone'].localize(self._end)
 
-    @property
-    def start_local(self):
-        """
-        see parent
-        """
-        return self.start.astimezone(self._locale['local_timezone'])
-
-    @property
-    def end_local(self):
+    def _to_local(self, dtime):
         """
         see parent
         """
-        return self.end.astimezone(self._locale['local_timezone'])
+        return dtime.astimezone(self._locale['local_timezone'])
 
 
 class FloatingEvent(DatetimeEvent):
     """
     """
     allday = False
+    __slots__ = ()
 
-    @property
-    def start_local(self):
-        return self._locale['local_timezone'].localize(self.start)
-
-    @property
-    def end_local(self):
-        return self._locale['local_timezone'].localize(self.end)
+    def _to_local(self, dtime):
+        return self._locale['local_timezone'].localize(dtime)
 
 
 class AllDayEvent(Event):
     allday = True
+    __slots__ = ()
 
     @property
     def end(self):
@@ -593,10 +648,132 @@ class AllDayEvent(Event):
         return rangestr
 
 
+class LightEvent(object):
+    """read-only instance of an event, built from the properties saved in the db
+
+    Displaying an event (e.g. in khal's agenda) only needs a few of its
+    properties, which the db keeps around in its own columns. Only if any of
+    the other properties (or the raw event) are needed, the whole event is
+    loaded and parsed by calling `loader`.
+
+    LightEvents should not be modified, use CalendarCollection.get_event() to
+    get an editable event.
+
+    Only the classes combining LightEvent with an Event class have slots for
+    `_attributes`, Python can't lay out a class with two bases that both have
+    slots of their own.
+    """
+    __slots__ = ()
+    _attributes = ('_loader', '_loaded', '_uid', '_summary_str', '_location',
+                   '_description', '_recurring', '_bday', '_fname')
+
+    def __init__(self, loader, props, ref=None, locale=None, href=None, etag=None,
+                 calendar=None, start=None, end=None):
+        """
+        :param loader: returns all of this event's VEVENTs, sorted by ref
+        :type loader: callable
+        :param props: uid, summary, location, description, whether the
+                      event is recurring and x-birthday and x-fname as
+                      saved in the db
+        :type props: tuple
+        """
+        self._loader = loader
+        self._loaded = None
+        self._uid, self._summary_str, self._location, self._description, \
+            self._recurring, self._bday, self._fname = props
+        self._locale = locale
+        self.readonly = None
+        self.href = href
+        self.etag = etag
+        self.calendar = calendar
+        self.ref = ref
+        self._start = start
+        self._end = end
+        self._key = self._end_local = None
+        self._raw = None
+
+    @classmethod
+    def create(cls, loader, props, **kwargs):
+        """return an instance of the LightEvent subclass matching `start`"""
+        eventcls = Event._get_type_from_date(kwargs['start'])
+        return LIGHT_EVENT_CLASSES[eventcls](loader, props, **kwargs)
+
+    @property
+    def _vevents(self):
+        if self._loaded is None:
+            self._loaded = self._loader()
+        return self._loaded
+
+    @property
+    def uid(self):
+        return self._uid
+
+    ident = uid
+
+    @property
+    def summary(self):
+        return self._summary(self._summary_str or '', self._bday, self._fname)
+
+    @property
+    def location(self):
+        return self._location or ''
+
+    @property
+    def description(self):
+        return self._description or ''
+
+    @property
+    def recurring(self):
+        return bool(self._recurring)
+
+
+class LightLocalizedEvent(LightEvent, LocalizedEvent):
+    __slots__ = LightEvent._attributes
+
+
+class LightFloatingEvent(LightEvent, FloatingEvent):
+    __slots__ = LightEvent._attributes
+
+
+class LightAllDayEvent(LightEvent, AllDayEvent):
+    __slots__ = LightEvent._attributes
+
+
+LIGHT_EVENT_CLASSES = {
+    LocalizedEvent: LightLocalizedEvent,
+    FloatingEvent: LightFloatingEvent,
+    AllDayEvent: LightAllDayEvent,
+}
+
+
+def used_timezones(vevents):
+    """return the timezones (except UTC) DTSTART and DTEND of `vevents` are in
+
+    :type vevents: iterable of icalendar.Event
+    :rtype: list(pytz.tzinfo)
+    """
+    timezones = dict()
+    for vevent in vevents:
+        for prop in ('DTSTART', 'DTEND'):
+            tzinfo = getattr(vevent[prop].dt, 'tzinfo', None) if prop in vevent else None
+            # pytz has one tzinfo for each offset of a timezone
+            if tzinfo is not None and tzinfo != pytz.UTC and str(tzinfo) not in timezones:
+                timezones[str(tzinfo)] = tzinfo
+    return list(timezones.values())
+
+
+# how many VTIMEZONEs (by timezone and the first and last transition they
+# include) are kept, see `create_timezone`
+VTIMEZONE_CACHE_SIZE = 64
+
+
 def create_timezone(tz, first_date=None, last_date=None):
     """
     create an icalendar vtimezone from a pytz.tzinfo
 
+    VTIMEZONEs are cached by the transitions they include, so the one returned
+    might be shared with other calendars and must not be modified.
+
     :param tz: the timezone
     :type tz: pytz.tzinfo
     :param first_date: the very first datetime that needs to be included in the
@@ -627,6 +804,25 @@ def create_timezone(tz, first_date=None, last_date=None):
 
     first_date = datetime.today() if not first_date else to_naive_utc(first_date)
     last_date = datetime.today() if not last_date else to_naive_utc(last_date)
+
+    # the first and last transition time we need to include: the last one
+    # before `first_date` and the first one after `last_date`
+    transition_times = tz._utc_transition_times
+    first_num = max(bisect_left(transition_times, first_date) - 1, 0)
+    last_num = min(bisect_right(transition_times, last_date), len(transition_times) - 1)
+    return _cached_timezone(str(tz), first_num, last_num)
+
+
+@lru_cache(maxsize=VTIMEZONE_CACHE_SIZE)
+def _cached_timezone(zone, first_num, last_num):
+    """the VTIMEZONE including the transitions `first_num` to `last_num` of
+    the timezone named `zone`, the most recently used ones are cached"""
+    return _create_timezone(pytz.timezone(zone), first_num, last_num)
+
+
+def _create_timezone(tz, first_num, last_num):
+    """create the VTIMEZONE including the transitions `first_num` to
+    `last_num` of `tz`"""
     timezone = icalendar.Timezone()
     timezone.add('TZID', tz)
 
@@ -639,18 +835,6 @@ def create_timezone(tz, first_date=None, last_date=None):
         for one, two in iter(tz._tzinfos.items())
     }
 
-    # looking for the first and last transition time we need to include
-    first_num, last_num = 0, len(tz._utc_transition_times) - 1
-    first_tt = tz._utc_transition_times[0]
-    last_tt = tz._utc_transition_times[-1]
-    for num, dt in enumerate(tz._utc_transition_times):
-        if dt > first_tt and dt < first_date:
-            first_num = num
-            first_tt = dt
-        if dt < last_tt and dt > last_date:
-            last_num = num
-            last_tt = dt
-
     timezones = dict()
     for num in range(first_num, last_num + 1):
         name = tz._transition_info[num][2]
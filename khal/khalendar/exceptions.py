@@ -54,6 +54,16 @@ class UpdateFailed(Error):
     """could not update the event in the database"""
 
 
+class ChangedFileError(Error):
+
+    """the file of an event (which is not saved in the database) changed since
+    the database was last updated"""
+
+    def __init__(self, path):
+        Error.__init__(self, '{0} changed since khal last read it, please run khal '
+                             'again'.format(path))
+
+
 class UnsupportedRecursion(Error):
 
     """raised if the RRULE is not understood by dateutil.rrule"""
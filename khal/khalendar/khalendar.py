@@ -25,23 +25,35 @@ CalendarCollection should enable modifying and querying a collection of
 calendars. Each calendar is defined by the contents of a vdir, but uses an
 SQLite db for caching (see backend if you're interested).
 """
+from bisect import bisect_left
+import collections
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 import datetime
+import hashlib
 import os
 import os.path
+from stat import S_ISREG
 import itertools
-import math
+from operator import attrgetter
 
 from vdirsyncer.storage.filesystem import FilesystemStorage
 from vdirsyncer.exceptions import AlreadyExistingError
+from vdirsyncer.utils import get_etag_from_file
 
 from . import backend
-from .event import Event
-from .. import log
+from .aux import to_unix_time
+from .event import Event, EventStandIn
+from .. import __version__, log
 from .exceptions import CouldNotCreateDbDir, UnsupportedFeatureError, \
     ReadOnlyCalendarError, UpdateFailed, DuplicateUid
 
 logger = log.logger
 
+# how many files are read or prepared ahead of writing them to the db
+PIPELINE_DEPTH = 64
+# how many events are written to the db in one transaction during update_db
+UPDATE_BATCH_SIZE = 1000
+
 
 def create_directory(path):
     if not os.path.isdir(path):
@@ -54,6 +66,63 @@ def create_directory(path):
             raise CouldNotCreateDbDir()
 
 
+def _prepare(raw, href, calendar, birthdays, default_timezone, until):
+    """prepare an event for writing it to the db, run in worker processes"""
+    if birthdays:
+        return backend.prepare_birthday(raw, href, calendar)
+    return backend.prepare(raw, href, calendar, default_timezone, until)
+
+
+def _parsed(item):
+    """return the VEVENTs of `item` if it has been parsed already (i.e. if it
+    is an Event and not just an Item), so the db doesn't need to parse it
+    again, None otherwise"""
+    if isinstance(item, Event):
+        return list(item._vevents.values())
+    return None
+
+
+def _instance(event):
+    """identifies the instance of a recurring event (together with its href)"""
+    return '{0} {1}'.format(event.ref, event.start.isoformat())
+
+
+def _render_key(locale, settings):
+    """a hash of everything rendering an event depends on, besides the event
+    and the day (see `CalendarCollection.rendered`)"""
+    values = (
+        sorted((key, str(value)) for key, value in locale.items()),
+        sorted((key, str(value)) for key, value in settings.items()),
+        __version__,
+    )
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+
+class _InlineExecutor(object):
+    """runs submitted functions right away, used if no workers are wanted"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def submit(self, function, *args):
+        future = Future()
+        try:
+            future.set_result(function(*args))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+
+def _executor(executor_class, workers):
+    """return an executor with `workers` workers, if more than one"""
+    if workers > 1:
+        return executor_class(workers)
+    return _InlineExecutor()
+
+
 class CalendarCollection(object):
     """CalendarCollection allows access to various calendars stored in vdirs
 
@@ -68,6 +137,14 @@ class CalendarCollection(object):
                  highlight_event_days=0,
                  locale=None,
                  dbpath=None,
+                 horizon=365,
+                 timeout=5.0,
+                 retries=3,
+                 read_threads=1,
+                 parse_processes=1,
+                 shards=False,
+                 store_items=True,
+                 update=True,
                  ):
         assert dbpath is not None
         assert calendars is not None
@@ -89,9 +166,22 @@ class CalendarCollection(object):
         self.color = color
         self.highlight_event_days = highlight_event_days
         self._locale = locale
+        self.read_threads = read_threads
+        self.parse_processes = parse_processes
+        # the calendars with events on each day, for highlighting days
+        self._day_calendars = dict()
+        # birthdays are made up from the vcards, so they are always saved
+        vdirs = None if store_items else dict(
+            (name, calendar['path']) for name, calendar in self._calendars.items()
+            if calendar.get('ctype', 'calendar') == 'calendar')
         self._backend = backend.SQLiteDb(
-            calendars=self.names, db_path=dbpath, locale=self._locale)
-        self.update_db()
+            calendars=self.names, db_path=dbpath, locale=self._locale, horizon=horizon,
+            timeout=timeout, retries=retries, shards=shards, vdirs=vdirs)
+        # a running `khal daemon` keeps the db up to date, unless the db has to
+        # be rebuilt by us (e.g. after the daemon was started with an older khal)
+        if update or self._backend.rebuilding:
+            self.update_db()
+        self._backend.finish_rebuild()
 
     @property
     def writable_names(self):
@@ -124,17 +214,33 @@ class CalendarCollection(object):
             raise ValueError(
                 'Calendar "{0}" is read-only and cannot be used as default'.format(default))
 
-    def _local_ctag(self, calendar):
-        stat = os.stat(self._calendars[calendar]['path'])
-        mtime = getattr(stat, 'st_mtime_ns', None)
-        if mtime is None:
-            mtime = stat.st_mtime
-        return str(int(math.floor(mtime * 1e9)))
+    def _stat(self, calendar, name):
+        """return inode, size and mtime (in ns) of the file `name` in the vdir of
+        `calendar`"""
+        stat = os.stat(os.path.join(self._storages[calendar].path, name))
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _scan(self, calendar):
+        """return inode, size and mtime of all files in the vdir of `calendar`
+
+        :rtype: dict(str, tuple(int, int, int))
+        """
+        storage = self._storages[calendar]
+        files = dict()
+        for name in os.listdir(storage.path):
+            if not name.endswith(storage.fileext):
+                continue
+            try:
+                stat = os.stat(os.path.join(storage.path, name))
+            except OSError:  # the file has been removed in the meantime
+                continue
+            if S_ISREG(stat.st_mode):
+                files[name] = stat.st_ino, stat.st_size, stat.st_mtime_ns
+        return files
 
     def _cover_event(self, event):
         event.color = self._calendars[event.calendar]['color']
         event.readonly = self._calendars[event.calendar]['readonly']
-        event.unicode_symbols = self._locale['unicode_symbols']
         return event
 
     def get_floating(self, start, end, minimal=False):
@@ -159,6 +265,106 @@ class CalendarCollection(object):
 
         return itertools.chain(floating_events, localized_events)
 
+    def get_events_between(self, start, end):
+        """return all events between the dates `start` and `end`, grouped by day
+
+        All events are fetched with one query and sorted into the days they
+        are scheduled on, an event spanning several days will be returned for
+        each of those days.
+
+        :param start: first day
+        :type start: datetime.date
+        :param end: last day (inclusive)
+        :type end: datetime.date
+        :returns: one (day, events) tuple for each day from `start` to `end`,
+                  the events of each day are sorted
+        :rtype: list((datetime.date, list(Event)))
+        """
+        localize = self._locale['local_timezone'].localize
+        days = [start + datetime.timedelta(days=one) for one in range((end - start).days + 1)]
+        bounds = dict()
+        for floating in (True, False):
+            starts, ends = list(), list()
+            for day in days:
+                day_start = datetime.datetime.combine(day, datetime.time.min)
+                day_end = datetime.datetime.combine(day, datetime.time.max)
+                if not floating:
+                    day_start, day_end = localize(day_start), localize(day_end)
+                starts.append(to_unix_time(day_start))
+                ends.append(to_unix_time(day_end))
+            bounds[floating] = starts, ends
+
+        buckets = [list() for _ in days]
+        events = self._backend.get_range(
+            datetime.datetime.combine(start, datetime.time.min),
+            datetime.datetime.combine(end, datetime.time.max))
+        for event, floating, dbstart, dbend in events:
+            event = self._cover_event(event)
+            starts, ends = bounds[floating]
+            # same test as backend.OVERLAPS, for each day
+            num = bisect_left(ends, dbstart)
+            while num < len(days) and (starts[num] < dbend or starts[num] <= dbstart == dbend):
+                buckets[num].append(event)
+                num += 1
+        return [(day, sorted(bucket, key=attrgetter('sort_key')))
+                for day, bucket in zip(days, buckets)]
+
+    def rendered(self, day_events, render, **settings):
+        """return the lines `render(event, day)` returns for each of
+        `day_events`, reusing the lines saved in the db where possible
+
+        What an event looks like when printed for some day only depends on the
+        locale and `settings` (e.g. the width of the lines), so the lines are
+        saved in the db and reused until the event's etag or color changes.
+
+        :param day_events: the events and the days they are rendered for
+        :type day_events: list((datetime.date, event.Event))
+        :param render: renders one event for one day
+        :type render: callable returning list(str)
+        :rtype: list(list(str))
+        """
+        if not day_events:
+            return list()
+        key = _render_key(self._locale, settings)
+        days = [day for day, _ in day_events]
+        saved = self._backend.get_rendered(min(days), max(days), key)
+        result, new = list(), list()
+        for day, event in day_events:
+            ident = (event.calendar, event.href, _instance(event), day)
+            color = getattr(event, 'color', None)
+            etag, saved_color, lines = saved.get(ident, (None, None, None))
+            if lines is None or etag != event.etag or saved_color != color:
+                lines = render(event, day)
+                if event.href is not None:
+                    new.append(ident + (event.etag, color, lines))
+            result.append(lines)
+        if new:
+            self._backend.set_rendered(key, new)
+        return result
+
+    def get_calendars_between(self, start, end):
+        """return the calendars with events on each day between the dates
+        `start` and `end`
+
+        All days are looked up with one query, which doesn't need to read the
+        events themselves.
+
+        :param start: first day
+        :type start: datetime.date
+        :param end: last day (inclusive)
+        :type end: datetime.date
+        :returns: one (day, calendars) tuple for each day from `start` to
+                  `end`, the calendars as minimal event stand ins (see
+                  `get_events_on`), sorted by their names
+        :rtype: list((datetime.date, list(EventStandIn)))
+        """
+        days = dict()
+        for day, calendar in self._backend.get_day_calendars(start, end):
+            days.setdefault(day, list()).append(self._cover_event(EventStandIn(calendar)))
+        return [(start + datetime.timedelta(days=one),
+                 days.get(start + datetime.timedelta(days=one), list()))
+                for one in range((end - start).days + 1)]
+
     def get_events_at(self, dtime=datetime.datetime.now()):
         """get all events at datetime `dtime`
 
@@ -183,8 +389,11 @@ class CalendarCollection(object):
             raise ReadOnlyCalendarError()
         with self._backend.at_once():
             event.etag = self._storages[event.calendar].update(event.href, event, event.etag)
-            self._backend.update(event.raw, event.href, event.etag, calendar=event.calendar)
-            self._backend.set_ctag(self._local_ctag(event.calendar), calendar=event.calendar)
+            self._backend.update(event.raw, event.href, event.etag, calendar=event.calendar,
+                                 vevents=_parsed(event))
+            self._backend.set_file(
+                event.calendar, event.href, self._stat(event.calendar, event.href))
+        self._day_calendars.clear()
 
     def force_update(self, event, collection=None):
         """update `event` even if an event with the same uid/href already exists"""
@@ -199,8 +408,10 @@ class CalendarCollection(object):
                 href = error.existing_href
                 _, etag = self._storages[calendar].get(href)
                 etag = self._storages[calendar].update(href, event, etag)
-            self._backend.update(event.raw, href, etag, calendar=calendar)
-            self._backend.set_ctag(self._local_ctag(calendar), calendar=calendar)
+            self._backend.update(event.raw, href, etag, calendar=calendar,
+                                 vevents=_parsed(event))
+            self._backend.set_file(calendar, href, self._stat(calendar, href))
+        self._day_calendars.clear()
 
     def new(self, event, collection=None):
         """save a new event to the vdir and the database
@@ -221,17 +432,20 @@ class CalendarCollection(object):
             except AlreadyExistingError as Error:
                 href = getattr(Error, 'existing_href', None)
                 raise DuplicateUid(href)
-            self._backend.update(event.raw, href, etag, calendar=calendar)
-            self._backend.set_ctag(self._local_ctag(calendar), calendar=calendar)
+            self._backend.update(event.raw, href, etag, calendar=calendar,
+                                 vevents=_parsed(event))
+            self._backend.set_file(calendar, href, self._stat(calendar, href))
+        self._day_calendars.clear()
 
     def delete(self, href, etag, calendar):
         if self._calendars[calendar]['readonly']:
             raise ReadOnlyCalendarError()
         self._storages[calendar].delete(href, etag)
         self._backend.delete(href, calendar=calendar)
+        self._day_calendars.clear()
 
     def get_event(self, href, calendar):
-        return self._cover_event(self._backend.get(href, calendar))
+        return self._cover_event(self._backend.get(href, calendar=calendar))
 
     def change_collection(self, event, new_collection):
         href, etag, calendar = event.href, event.etag, event.calendar
@@ -245,46 +459,126 @@ class CalendarCollection(object):
         calendar = collection or self.writable_names[0]
         return Event.fromString(ical, locale=self._locale, calendar=calendar)
 
-    def update_db(self):
+    def update_db(self, calendars=None):
         """update the db from the vdir,
 
         should be called after every change to the vdir
+
+        :param calendars: only update these calendars, defaults to all of them
+        :type calendars: list(str)
+        """
+        if calendars is None:
+            calendars = self._calendars
+        scans = dict((calendar, self._scan(calendar)) for calendar in calendars)
+        outdated = [calendar for calendar, files in scans.items()
+                    if self._needs_update(calendar, files)]
+        if not outdated:
+            return
+        self._day_calendars.clear()
+        # other khal instances might be updating the db right now, once they are
+        # done, there might be nothing left to do for us
+        with self._backend.writer_lock(outdated):
+            self._db_update(sorted((calendar, files) for calendar, files in scans.items()
+                                   if self._needs_update(calendar, files)))
+            self._backend.train_zdicts(outdated)
+            self._backend.prune_rendered(outdated)
+
+    def _needs_update(self, calendar, files=None):
+        """checks if the db for the given calendar needs an update
+
+        :param files: the result of `_scan(calendar)`, if already known
         """
-        for calendar in self._calendars:
-            if self._needs_update(calendar):
-                self._db_update(calendar)
+        if files is None:
+            files = self._scan(calendar)
+        return files != self._backend.get_files(calendar)
 
-    def _needs_update(self, calendar):
-        """checks if the db for the given calendar needs an update"""
-        return self._local_ctag(calendar) != self._backend.get_ctag(calendar)
+    def _db_update(self, scans):
+        """implements the actual db update
 
-    def _db_update(self, calendar):
-        """implements the actual db update on a per calendar base"""
-        db_hrefs = set(href for href, etag in self._backend.list(calendar))
-        storage_hrefs = set()
+        only files which changed since the last update (or whose etag differs
+        from the one in the db) are read
 
+        :param scans: calendars and the result of `_scan()` for each of them
+        :type scans: list(tuple(str, dict))
+        """
+        jobs = list()
+        deleted = list()
+        for calendar, files in scans:
+            snapshot = self._backend.get_files(calendar)
+            db_etags = self._backend.get_etags(calendar)
+            path = self._storages[calendar].path
+            for href, stat in sorted(files.items()):
+                if snapshot.get(href) == stat:
+                    continue
+                etag = get_etag_from_file(os.path.join(path, href))
+                if etag != db_etags.get(href):
+                    logger.debug('Updating {0} because {1} != {2}'.format(
+                        href, etag, db_etags.get(href)))
+                    jobs.append((calendar, href))
+            deleted.extend((calendar, href) for href in sorted(set(db_etags) - set(files)))
+
+        prepared = self._read_and_prepare(jobs)
+        for batch in iter(lambda: list(itertools.islice(prepared, UPDATE_BATCH_SIZE)), []):
+            with self._backend.at_once():
+                for calendar, href, etag, future in batch:
+                    self._update_vevent(href, calendar, etag, future)
         with self._backend.at_once():
-            for href, etag in self._storages[calendar].list():
-                storage_hrefs.add(href)
-                db_etag = self._backend.get_etag(href, calendar=calendar)
-                if etag != db_etag:
-                    logger.debug('Updating {0} because {1} != {2}'.format(href, etag, db_etag))
-                    self._update_vevent(href, calendar=calendar)
-            for href in db_hrefs - storage_hrefs:
+            for calendar, href in deleted:
                 self._backend.delete(href, calendar=calendar)
-            self._backend.set_ctag(self._local_ctag(calendar), calendar=calendar)
+            for calendar, files in scans:
+                self._backend.set_files(calendar, files)
+
+    def _read_and_prepare(self, jobs):
+        """read and prepare (parse, check and expand) the events in `jobs`
+
+        Files are read by `read_threads` threads and prepared by
+        `parse_processes` processes (if those are larger than one) while the
+        results are being consumed, always in the order of `jobs`.
 
-    def _update_vevent(self, href, calendar):
+        :param jobs: calendars and hrefs
+        :type jobs: list(tuple(str, str))
+        :returns: calendar, href, etag and the (future) result of
+                  :func:`backend.prepare` or :func:`backend.prepare_birthday`
+        :rtype: generator of tuple(str, str, str, concurrent.futures.Future)
+        """
+        until = self._backend.default_until()
+        default_timezone = self._locale['default_timezone']
+        reads = collections.deque()
+        prepares = collections.deque()
+
+        def prepare_next():
+            calendar, href, read = reads.popleft()
+            item, etag = read.result()
+            birthdays = self._calendars[calendar].get('ctype') == 'birthdays'
+            prepares.append((calendar, href, etag, parsers.submit(
+                _prepare, item.raw, href, calendar, birthdays, default_timezone, until)))
+
+        with _executor(ThreadPoolExecutor, self.read_threads) as readers, \
+                _executor(ProcessPoolExecutor, self.parse_processes) as parsers:
+            for calendar, href in jobs:
+                reads.append((calendar, href,
+                              readers.submit(self._storages[calendar].get, href)))
+                if len(reads) > PIPELINE_DEPTH:
+                    prepare_next()
+                if len(prepares) > PIPELINE_DEPTH:
+                    yield prepares.popleft()
+            while reads:
+                prepare_next()
+            while prepares:
+                yield prepares.popleft()
+
+    def _update_vevent(self, href, calendar, etag, prepared):
         """should only be called during db_update, only updates the db,
-        does not check for readonly"""
-        event, etag = self._storages[calendar].get(href)
-        try:
-            if self._calendars[calendar].get('ctype') == 'birthdays':
-                update = self._backend.update_birthday
-            else:
-                update = self._backend.update
-            update(event.raw, href=href, etag=etag, calendar=calendar)
+        does not check for readonly
 
+        :param prepared: the result of :func:`backend.prepare` (or
+                         :func:`backend.prepare_birthday`) for the event
+        :type prepared: concurrent.futures.Future
+        """
+        try:
+            prepared = prepared.result()
+            if prepared is not None:
+                self._backend.write(prepared, href=href, etag=etag, calendar=calendar)
             return True
         except Exception as e:
             if not isinstance(e, (UpdateFailed, UnsupportedFeatureError)):
@@ -294,12 +588,22 @@ class CalendarCollection(object):
                 'This event will not be available in khal.'.format(calendar, href, str(e)))
             return False
 
-    def search(self, search_string):
-        """search for the db for events matching `search_string`"""
-        return (self._cover_event(event) for event in self._backend.search(search_string))
+    def search(self, search_string, limit=None):
+        """search for the db for events matching `search_string`, best matches
+        first, at most `limit` events"""
+        return (self._cover_event(event) for event in
+                self._backend.search(search_string, limit=limit))
+
+    def prepare_day_styles(self, start, end):
+        """look up the styles of all days between `start` and `end` at once,
+        before asking for each of them with `get_styles`"""
+        if self.highlight_event_days:
+            self._day_calendars.update(self.get_calendars_between(start, end))
 
     def get_day_styles(self, day, focus):
-        devents = list(self.get_events_on(day, minimal=True))
+        if day not in self._day_calendars:
+            self._day_calendars.update(self.get_calendars_between(day, day))
+        devents = self._day_calendars[day]
         if len(devents) == 0:
             return None
         if self.color != '':
@@ -45,6 +45,42 @@ type = option('calendar', 'birthdays', default='calendar')
 # khal stores its internal caching database here, by default this will be in the *$XDG_DATA_HOME/khal/khal.db* (this will most likely be *~/.local/share/khal/khal.db*).
 path = expand_db_path(default=None)
 
+# Instances of events which recur forever are only saved in khal's database
+# this many days into the future, when looking at dates further in the future,
+# the instances up to there (and this many days more) are added.
+horizon = integer(default=365, min=1)
+
+# How long (in seconds) khal waits for other khal instances to finish writing
+# to the database before giving up.
+timeout = float(default=5.0, min=0)
+
+# How often khal retries writing to the database if it is still locked by
+# other khal instances after waiting for `timeout` seconds.
+retries = integer(default=3, min=0)
+
+# How many threads read changed files from the calendars' vdirs while updating
+# the database.
+read_threads = integer(default=1, min=1)
+
+# How many processes parse (and expand) the events read from the vdirs while
+# updating the database, setting this to the number of CPU cores can speed
+# up the initial indexing of large calendars considerably.
+parse_processes = integer(default=1, min=1)
+
+# Keep the events of each calendar in a database file of its own (in a
+# directory next to `path`). Updating one calendar then doesn't block khal
+# instances using others, only the calendars which are shown are opened and
+# deleting one of those files makes khal re-read only that calendar. At most
+# 10 calendars are opened this way at once, the events of any further
+# calendars are kept in the database at `path`.
+shards = boolean(default=False)
+
+# Save a copy of each event in the database. If disabled, the database only
+# keeps what is needed to find and show events in lists and the events are read
+# from their files when they are needed in full (e.g. for editing or
+# exporting them), which makes the database considerably smaller.
+store_items = boolean(default=True)
+
 # The most important options in the the **[locale]** section are probably (long-)time and dateformat.
 [locale]
 
@@ -26,6 +26,8 @@ import sys
 import urwid
 
 from .. import aux
+from ..khalendar.exceptions import ChangedFileError
+from ..log import logger
 from . import colors
 from .base import Pane, Window
 from .widgets import ExtendedEdit as Edit, NPile, NColumns, NListBox, Choice
@@ -61,10 +63,10 @@ class U_Event(urwid.Text):
         self.conf = eventcolumn.pane.conf
         self.relative = relative
         if self.relative:
-            text = self.event.relative_to(self.this_date)
+            self.title = self.event.relative_to(self.this_date)
         else:
-            text = self.event.event_description
-        super(U_Event, self).__init__(text)
+            self.title = self.event.event_description
+        super(U_Event, self).__init__(self.title)
         self.set_title()
 
     @property
@@ -89,11 +91,7 @@ class U_Event(urwid.Text):
             mark = 'D'
         elif self.recuid in self.eventcolumn.pane.deleted[INSTANCES]:
             mark = 'd'
-        if self.relative:
-            text = self.event.relative_to(self.this_date)
-        else:
-            text = self.event.event_description
-        self.set_text(mark + ' ' + text)
+        self.set_text(mark + ' ' + self.title)
 
     def export_event(self):
         """
@@ -601,7 +599,6 @@ class EventEditor(urwid.WidgetWrap):
         """
         if self.changed is True:
             self.update_vevent()
-            self.event.allday = self.startendeditor.allday
             self.event.increment_sequence()
             if self.event.etag is None:  # has not been saved before
                 self.event.calendar = self.calendar_chooser.active['name']
@@ -712,7 +709,8 @@ class ClassicView(Pane):
             on_press={'n': self.new_event},
             firstweekday=conf['locale']['firstweekday'],
             weeknumbers=conf['locale']['weeknumbers'],
-            get_styles=collection.get_styles
+            get_styles=collection.get_styles,
+            prepare_styles=collection.prepare_day_styles,
         )
         self.calendar = ContainerWidget(calendar)
         lwidth = 31 if conf['locale']['weeknumbers'] == 'right' else 28
@@ -772,7 +770,12 @@ class ClassicView(Pane):
             self.collection.delete(href, etag, account)
         for part, rec_id in self.deleted[INSTANCES]:
             account, href, etag = part.split('\n', 2)
-            event = self.collection.get_event(href, account)
+            try:
+                event = self.collection.get_event(href, account)
+            except ChangedFileError as error:
+                logger.warning('Cannot delete the instance of {0}/{1}: {2}'.format(
+                    account, href, error))
+                continue
             event.delete_instance(rec_id)
             self.collection.update(event)
 
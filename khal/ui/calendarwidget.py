@@ -333,13 +333,14 @@ class CListBox(urwid.ListBox):
 class CalendarWalker(urwid.SimpleFocusListWalker):
 
     def __init__(self, on_date_change, on_press, keybindings, firstweekday=0,
-                 weeknumbers=False, get_styles=None):
+                 weeknumbers=False, get_styles=None, prepare_styles=None):
         self.firstweekday = firstweekday
         self.weeknumbers = weeknumbers
         self.on_date_change = on_date_change
         self.on_press = on_press
         self.keybindings = keybindings
         self.get_styles = get_styles
+        self.prepare_styles = prepare_styles
         weeks = self._construct_month()
         urwid.SimpleFocusListWalker.__init__(self, weeks)
 
@@ -500,6 +501,8 @@ class CalendarWalker(urwid.SimpleFocusListWalker):
 
         plain_weeks = calendar.Calendar(
             self.firstweekday).monthdatescalendar(year, month)
+        if self.prepare_styles is not None:
+            self.prepare_styles(plain_weeks[0][0], plain_weeks[-1][-1])
         weeks = list()
         for number, week in enumerate(plain_weeks):
             week = self._construct_week(week)
@@ -515,7 +518,8 @@ class CalendarWalker(urwid.SimpleFocusListWalker):
 
 class CalendarWidget(urwid.WidgetWrap):
     def __init__(self, on_date_change, keybindings, on_press, firstweekday=0,
-                 weeknumbers=False, get_styles=None, initial=date.today()):
+                 weeknumbers=False, get_styles=None, initial=date.today(),
+                 prepare_styles=None):
 
         """
         :param on_date_change: a function that is called every time the selected date
@@ -539,6 +543,10 @@ class CalendarWidget(urwid.WidgetWrap):
             is the later date. The function's return values are interpreted as
             pressed keys.
         :type on_pres: dict
+        :param prepare_styles: if given, called with the first and last date
+            of each month before it is shown, so that `get_styles` can
+            look up all of its dates at once
+        :type prepare_styles: function
         """
 
         default_keybindings = {
@@ -584,7 +592,7 @@ class CalendarWidget(urwid.WidgetWrap):
             dividechars=1)
         self.walker = CalendarWalker(
             on_date_change, on_press, default_keybindings, firstweekday, weeknumbers,
-            get_styles)
+            get_styles, prepare_styles)
         self.box = CListBox(self.walker)
         frame = urwid.Frame(self.box, header=dnames)
         urwid.WidgetWrap.__init__(self, frame)
@@ -15,6 +15,7 @@ requirements = [
 
 extra_requirements = {
     'proctitle': ['setproctitle'],
+    'daemon': ['pyinotify'],
 }
 
 setup(
@@ -33,7 +34,8 @@ setup(
     entry_points={
         'console_scripts': [
             'khal = khal.cli:main_khal',
-            'ikhal = khal.cli:main_ikhal'
+            'ikhal = khal.cli:main_ikhal',
+            'khalc = khal.client:main',
         ]
     },
     install_requires=requirements,
@@ -1,12 +1,17 @@
 
+import fcntl
+import os
 import pytest
 import pytz
+import sqlite3
+import subprocess
+import sys
 
 from datetime import date, datetime, timedelta, time
 import icalendar
 
 from khal.khalendar import backend
-from khal.khalendar.event import LocalizedEvent
+from khal.khalendar.event import Event, LocalizedEvent
 from khal.khalendar.exceptions import OutdatedDbVersionError, UpdateFailed
 
 from .aux import _get_text
@@ -22,9 +27,9 @@ LOCALE_SYDNEY = {'local_timezone': SYDNEY, 'default_timezone': SYDNEY}
 calname = 'home'
 
 
-def test_new_db_version():
+def test_new_db_version(monkeypatch):
     dbi = backend.SQLiteDb(calname, ':memory:', locale=LOCALE_BERLIN)
-    backend.DB_VERSION += 1
+    monkeypatch.setattr(backend, 'DB_VERSION', backend.DB_VERSION + 1)
     with pytest.raises(OutdatedDbVersionError):
         dbi._check_table_version()
 
@@ -224,6 +229,18 @@ def test_this_and_prior():
     with pytest.raises(UpdateFailed):
         dbi.update(event_rrule_this_and_prior, href='12345.ics', etag='abcd', calendar=calname)
 
+
+def test_failed_update_is_rolled_back():
+    dbi = backend.SQLiteDb([calname], ':memory:', locale=LOCALE_BERLIN)
+    dbi.update(_get_text('event_dt_simple'), href='12345.ics', etag='abcd', calendar=calname)
+    with pytest.raises(UpdateFailed):
+        dbi.update(event_rrule_this_and_prior, href='12345.ics', etag='efgh', calendar=calname)
+    assert dbi.list(calname) == [('12345.ics', 'abcd')]
+    events = dbi.get_localized(BERLIN.localize(datetime(2014, 4, 9, 0, 0)),
+                               BERLIN.localize(datetime(2014, 4, 10, 0, 0)))
+    assert len(list(events)) == 1
+    assert [event.uid for event in dbi.search('event')] == ['V042MJ8B3SJNFXQOJL6P53OFMHJE8Z3VZWOU']
+
 event_rrule_this_and_future_temp = """
 BEGIN:VCALENDAR
 BEGIN:VEVENT
@@ -673,3 +690,701 @@ def test_birthday_does_not_parse(tmpdir):
     db.update_birthday(card_does_not_parse, 'unix.vcf', calendar=calname)
     events = list(db.get_floating(start, end))
     assert len(events) == 0
+
+
+card_leap_day = """BEGIN:VCARD
+VERSION:3.0
+FN:Leap
+BDAY:19920229
+END:VCARD
+"""
+
+
+def test_birthdays_are_not_expanded():
+    db = backend.SQLiteDb([calname], ':memory:', locale=LOCALE_BERLIN)
+    db.update_birthday(card, 'unix.vcf', calendar=calname)
+    db.update_birthday(card_no_year, 'no_year.vcf', calendar=calname)
+    assert db.sql_ex('SELECT count(*) FROM recs_float;') == [(0, )]
+    assert sorted(db.sql_ex('SELECT month_day, year FROM birthdays;')) == [
+        (311, backend.BDAY_NO_YEAR), (311, 1971)]
+    # a range spanning several years, far beyond the expansion horizon
+    events = list(db.get_range(datetime(2099, 3, 1), datetime(2101, 3, 11)))
+    assert [(event.start, event.summary) for event, _, _, _ in events] == [
+        (date(2099, 3, 11), 'Unix\'s 128th birthday'),
+        (date(2099, 3, 11), 'Unix\'s birthday'),
+        (date(2100, 3, 11), 'Unix\'s 129th birthday'),
+        (date(2100, 3, 11), 'Unix\'s birthday'),
+        (date(2101, 3, 11), 'Unix\'s 130th birthday'),
+        (date(2101, 3, 11), 'Unix\'s birthday'),
+    ]
+    assert all(floating for _, floating, _, _ in events)
+    # no birthdays before their year of birth
+    assert [event.summary for event in
+            db.get_floating(datetime(1970, 3, 11), datetime(1970, 3, 11, 23))] == \
+        ['Unix\'s birthday']
+    assert len(list(db.get_floating_at(datetime(2016, 3, 12)))) == 2
+    assert len(list(db.get_floating_at(datetime(2016, 3, 12, 1)))) == 0
+    db.delete('unix.vcf', calendar=calname)
+    assert db.sql_ex('SELECT month_day, year FROM birthdays;') == [(311, backend.BDAY_NO_YEAR)]
+
+
+def test_birthdays_leap_day():
+    db = backend.SQLiteDb([calname], ':memory:', locale=LOCALE_BERLIN)
+    db.update_birthday(card_leap_day, 'leap.vcf', calendar=calname)
+
+    def days(start, end):
+        return [(event.start, event.summary) for event, _, _, _ in db.get_range(start, end)]
+
+    assert days(datetime(2016, 2, 28), datetime(2016, 3, 1)) == \
+        [(date(2016, 2, 29), 'Leap\'s 24th birthday')]
+    assert days(datetime(2017, 2, 28), datetime(2017, 2, 28, 23)) == \
+        [(date(2017, 2, 28), 'Leap\'s 25th birthday')]
+    assert days(datetime(2017, 3, 1), datetime(2017, 3, 1, 23)) == []
+    assert days(datetime(2016, 12, 31), datetime(2018, 1, 1)) == \
+        [(date(2017, 2, 28), 'Leap\'s 25th birthday')]
+    events = list(db.get_floating(datetime(2100, 2, 28), datetime(2100, 2, 28, 23)))
+    assert [event.start for event in events] == [date(2100, 2, 28)]
+
+    # without a year
+    db.update_birthday(card_leap_day.replace('19920229', '--0229'), 'leap.vcf',
+                       calendar=calname)
+    assert days(datetime(2016, 2, 28), datetime(2016, 3, 1)) == \
+        [(date(2016, 2, 29), 'Leap\'s birthday')]
+    assert days(datetime(2017, 2, 28), datetime(2017, 3, 1, 23)) == \
+        [(date(2017, 2, 28), 'Leap\'s birthday')]
+
+
+def _query_plans(dbi, query):
+    """run `query` and return the query plans of all SELECT statements on the instance
+    tables it executed"""
+    statements = list()
+    dbi.conn.set_trace_callback(lambda statement: statements.append(statement))
+    try:
+        list(query())
+    finally:
+        dbi.conn.set_trace_callback(None)
+    plans = list()
+    for statement in statements:
+        if statement.lstrip().upper().startswith('SELECT') and 'recs_' in statement:
+            plan = dbi.conn.execute('EXPLAIN QUERY PLAN ' + statement).fetchall()
+            plans.append(' '.join(row[-1] for row in plan))
+    return plans
+
+
+@pytest.mark.parametrize('query', [
+    lambda dbi: dbi.get_localized(BERLIN.localize(datetime(2014, 4, 9, 0, 0)),
+                                  BERLIN.localize(datetime(2014, 4, 9, 23, 59))),
+    lambda dbi: dbi.get_floating(datetime(2014, 4, 9, 0, 0), datetime(2014, 4, 9, 23, 59)),
+    lambda dbi: dbi.get_localized_at(BERLIN.localize(datetime(2014, 4, 9, 12, 0))),
+    lambda dbi: dbi.get_floating_at(datetime(2014, 4, 9, 12, 0)),
+])
+def test_range_queries_use_index(query):
+    dbi = backend.SQLiteDb([calname, 'work'], ':memory:', locale=LOCALE_BERLIN)
+    dbi.update(_get_text('event_dt_simple'), href='12345.ics', calendar=calname)
+    plans = _query_plans(dbi, lambda: query(dbi))
+    assert plans
+    for plan in plans:
+        assert 'USING INDEX recs_' in plan
+        assert 'SCAN' not in plan
+
+
+def test_overlap_boundaries():
+    dbi = backend.SQLiteDb([calname], ':memory:', locale=LOCALE_BERLIN)
+    dbi.update(_get_text('event_dt_simple'), href='12345.ics', calendar=calname)
+    # event_dt_simple is scheduled for 2014-04-09 09:30 - 10:30
+    assert len(list(dbi.get_localized(BERLIN.localize(datetime(2014, 4, 9, 10, 30)),
+                                      BERLIN.localize(datetime(2014, 4, 9, 11, 0))))) == 0
+    assert len(list(dbi.get_localized(BERLIN.localize(datetime(2014, 4, 9, 9, 0)),
+                                      BERLIN.localize(datetime(2014, 4, 9, 9, 30))))) == 1
+    assert len(list(dbi.get_localized(BERLIN.localize(datetime(2014, 4, 9, 9, 45)),
+                                      BERLIN.localize(datetime(2014, 4, 9, 10, 0))))) == 1
+    assert len(list(dbi.get_localized(BERLIN.localize(datetime(2014, 4, 9, 8, 0)),
+                                      BERLIN.localize(datetime(2014, 4, 9, 9, 0))))) == 0
+
+
+def test_overlap_zero_length():
+    """instances without a duration are found if they start within the range,
+    even at its very start"""
+    dbi = backend.SQLiteDb([calname], ':memory:', locale=LOCALE_BERLIN)
+    dbi.update(_get_text('event_dt_simple').replace(
+        'DTEND;TZID=Europe/Berlin;VALUE=DATE-TIME:20140409T103000', 'DURATION:PT0S'),
+        href='12345.ics', calendar=calname)
+    # the instance starts and ends at 2014-04-09 09:30
+    at = BERLIN.localize(datetime(2014, 4, 9, 9, 30))
+    assert len(list(dbi.get_localized(at, at + timedelta(hours=1)))) == 1
+    assert len(list(dbi.get_localized(at - timedelta(hours=1), at))) == 1
+    assert len(list(dbi.get_localized(at + timedelta(minutes=1),
+                                      at + timedelta(hours=1)))) == 0
+    assert len(list(dbi.get_localized(at - timedelta(hours=1),
+                                      at - timedelta(minutes=1)))) == 0
+    assert len(list(dbi.get_range(datetime(2014, 4, 9, 9, 30), datetime(2014, 4, 9, 10)))) == 1
+    assert list(dbi.get_day_calendars(date(2014, 4, 8), date(2014, 4, 10))) == \
+        [(date(2014, 4, 9), calname)]
+
+
+def test_get_range_light_events(monkeypatch):
+    dbi = backend.SQLiteDb([calname], ':memory:', locale=LOCALE_BERLIN)
+    dbi.update(_get_text('event_rrule_recuid').replace(
+        'SUMMARY:Arbeit\nRECURRENCE-ID', 'SUMMARY:Mehr Arbeit\nRECURRENCE-ID'),
+        href='12345.ics', etag='abcd', calendar=calname)
+    dbi.update_birthday(card, 'unix.vcf', calendar=calname)
+
+    def no_parsing(*args, **kwargs):
+        raise AssertionError('items should not be parsed')
+
+    with monkeypatch.context() as m:
+        m.setattr(icalendar.Calendar, 'from_ical', no_parsing)
+        events = list(dbi.get_range(datetime(2014, 6, 30), datetime(2014, 7, 8)))
+        assert [(event.summary, event.recurring, event.uid, floating)
+                for event, floating, _, _ in events] == [
+            ('Arbeit', True, 'event_rrule_recurrence_id', False),
+            ('Mehr Arbeit', True, 'event_rrule_recurrence_id', False),
+        ]
+        assert events[1][0].start == BERLIN.localize(datetime(2014, 7, 7, 9))
+        bdays = list(dbi.get_range(datetime(2016, 3, 11), datetime(2016, 3, 12)))
+        assert len(bdays) == 1
+        assert bdays[0][0].summary == 'Unix\'s 45th birthday'
+        assert bdays[0][0].allday
+        assert bdays[0][1] is True
+
+    # everything else is loaded on demand
+    assert 'RRULE' in events[0][0].raw
+    assert events[1][0].recurpattern == ''
+
+
+event_search_template = """BEGIN:VEVENT
+UID:{uid}
+SUMMARY:{summary}
+DESCRIPTION:{description}
+DTSTART;TZID=Europe/Berlin:20140409T093000
+DTEND;TZID=Europe/Berlin:20140409T103000
+END:VEVENT"""
+
+
+def test_search():
+    dbi = backend.SQLiteDb([calname], ':memory:', locale=LOCALE_BERLIN)
+    dbi.update(event_search_template.format(
+        uid='meeting', summary='Meeting', description='talk about the lunch'),
+        href='meeting.ics', calendar=calname)
+    dbi.update(event_search_template.format(
+        uid='lunch', summary='Lunch', description='Lunch with the lunch group'),
+        href='lunch.ics', calendar=calname)
+    dbi.update(event_search_template.format(
+        uid='other', summary='Something else', description='nothing'),
+        href='other.ics', calendar=calname)
+    # the better match comes first
+    assert [event.uid for event in dbi.search('lunch')] == ['lunch', 'meeting']
+    assert [event.uid for event in dbi.search('lun')] == ['lunch', 'meeting']
+    assert [event.uid for event in dbi.search('lunch', limit=1)] == ['lunch']
+    assert [event.uid for event in dbi.search('talk lunch')] == ['meeting']
+    # neither property names nor parameters are searched
+    assert list(dbi.search('DESCRIPTION')) == []
+    assert list(dbi.search('Europe')) == []
+    assert list(dbi.search('')) == []
+
+    dbi.delete('lunch.ics', calendar=calname)
+    assert [event.uid for event in dbi.search('lunch')] == ['meeting']
+    dbi.update(event_search_template.format(
+        uid='meeting', summary='Meeting', description='no food'),
+        href='meeting.ics', calendar=calname)
+    assert list(dbi.search('lunch')) == []
+
+
+def test_search_pages(monkeypatch):
+    monkeypatch.setattr(backend, 'SEARCH_PAGE_SIZE', 2)
+    dbi = backend.SQLiteDb([calname], ':memory:', locale=LOCALE_BERLIN)
+    for num in range(5):
+        dbi.update(event_search_template.format(
+            uid='uid{0}'.format(num), summary='Meeting', description='weekly'),
+            href='{0}.ics'.format(num), calendar=calname)
+    assert sorted(event.uid for event in dbi.search('meeting')) == \
+        ['uid{0}'.format(num) for num in range(5)]
+    assert len(list(dbi.search('meeting', limit=3))) == 3
+
+
+def test_stream(tmpdir, monkeypatch):
+    monkeypatch.setattr(backend, 'STREAM_PAGE_SIZE', 2)
+    dbi = backend.SQLiteDb([calname], str(tmpdir) + '/khal.db', locale=LOCALE_BERLIN)
+    for num in range(5):
+        dbi.update(event_search_template.format(
+            uid='uid{0}'.format(num), summary='Meeting', description='weekly'),
+            href='{0}.ics'.format(num), calendar=calname)
+
+    def events():
+        return dbi.get_localized(BERLIN.localize(datetime(2014, 4, 9, 0, 0)),
+                                 BERLIN.localize(datetime(2014, 4, 10, 0, 0)))
+
+    # results are fetched page by page, several of them at once
+    first, second = events(), events()
+    assert next(first).uid == next(second).uid
+    dbi.delete('4.ics', calendar=calname)
+    assert len(list(zip(first, second))) == 4
+    assert sorted(event.uid for event in events()) == ['uid0', 'uid1', 'uid2', 'uid3']
+
+
+def test_compressed_items(monkeypatch):
+    monkeypatch.setattr(backend, 'ZDICT_MIN_ITEMS', 4)
+    dbi = backend.SQLiteDb([calname], ':memory:', locale=LOCALE_BERLIN)
+    items = dict(('{0}.ics'.format(num), _get_text('event_rrule_recuid').replace(
+        'SUMMARY:Arbeit\n', 'SUMMARY:Arbeit {0}\n'.format(num), 1)) for num in range(5))
+    for href in sorted(items)[:3]:
+        dbi.update(items[href], href=href, calendar=calname)
+
+    def sizes():
+        return dict(dbi.sql_ex('SELECT href, length(item) FROM events;'))
+
+    # not enough items to learn from, they are compressed without dictionary
+    dbi.train_zdicts([calname])
+    assert dbi.sql_ex('SELECT count(*) FROM zdicts;') == [(0, )]
+    before = sizes()
+    assert all(size < len(items[href]) for href, size in before.items())
+
+    dbi.update(items['3.ics'], href='3.ics', calendar=calname)
+    dbi.train_zdicts([calname])
+    assert dbi.sql_ex('SELECT count(*) FROM zdicts;') == [(1, )]
+    after = sizes()
+    assert all(after[href] < before[href] / 2 for href in before)
+    # later items use the same dictionary
+    dbi.update(items['4.ics'], href='4.ics', calendar=calname)
+    assert sizes()['4.ics'] == after['0.ics']
+
+    for href, item in items.items():
+        assert dbi.get(href, calendar=calname).raw == \
+            backend.Event.fromString(item, locale=LOCALE_BERLIN).raw
+    assert [event.summary for event in
+            dbi.get_localized(BERLIN.localize(datetime(2014, 6, 30)),
+                              BERLIN.localize(datetime(2014, 7, 1)))] == \
+        ['Arbeit {0}'.format(num) for num in range(5)]
+    assert [event.summary for event, _, _, _ in
+            dbi.get_range(datetime(2014, 6, 30), datetime(2014, 7, 1))] == \
+        ['Arbeit {0}'.format(num) for num in range(5)]
+
+
+def test_search_without_fts():
+    dbi = backend.SQLiteDb([calname], ':memory:', locale=LOCALE_BERLIN)
+    dbi._fts = False
+    dbi.update(event_search_template.format(
+        uid='lunch', summary='Lunch', description='with the group'),
+        href='lunch.ics', calendar=calname)
+    assert [event.uid for event in dbi.search('unc')] == ['lunch']
+    assert list(dbi.search('Europe')) == []
+
+
+event_rrule_forever = """BEGIN:VCALENDAR
+BEGIN:VEVENT
+UID:forever
+SUMMARY:Daily
+DTSTART;TZID=Europe/Berlin:20140101T100000
+DTEND;TZID=Europe/Berlin:20140101T110000
+RRULE:FREQ=DAILY
+END:VEVENT
+BEGIN:VEVENT
+UID:forever
+SUMMARY:Moved
+RECURRENCE-ID;TZID=Europe/Berlin:20500101T100000
+DTSTART;TZID=Europe/Berlin:20500101T120000
+DTEND;TZID=Europe/Berlin:20500101T130000
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+def test_expansion_horizon():
+    dbi = backend.SQLiteDb([calname], ':memory:', locale=LOCALE_BERLIN, horizon=10)
+    dbi.update(event_rrule_forever, href='forever.ics', calendar=calname)
+    dbi.update(_get_text('event_dt_simple'), href='simple.ics', calendar=calname)
+    horizon = date.today() + timedelta(days=10)
+    count = dbi.sql_ex('SELECT count(*) FROM recs_loc WHERE ref IS NULL;')
+    # the simple event and one instance per day before the horizon
+    assert count[0][0] == (horizon - date(2014, 1, 1)).days + 1
+    assert dbi.sql_ex('SELECT href, expanded_until FROM events ORDER BY href;') == [
+        ('forever.ics', backend.aux.to_unix_time(datetime.combine(horizon, time.min))),
+        ('simple.ics', None),
+    ]
+
+    def on(day):
+        return sorted(
+            (event.start_local, event.summary) for event in dbi.get_localized(
+                BERLIN.localize(datetime.combine(day, time.min)),
+                BERLIN.localize(datetime.combine(day, time.max))))
+
+    assert on(date(2045, 6, 1)) == [(BERLIN.localize(datetime(2045, 6, 1, 10)), 'Daily')]
+    # the override is not overwritten while extending
+    assert on(date(2049, 12, 31)) == [(BERLIN.localize(datetime(2049, 12, 31, 10)), 'Daily')]
+    assert on(date(2050, 1, 1)) == [(BERLIN.localize(datetime(2050, 1, 1, 12)), 'Moved')]
+    assert on(date(2050, 1, 2)) == [(BERLIN.localize(datetime(2050, 1, 2, 10)), 'Daily')]
+    watermark = dbi.sql_ex(
+        'SELECT expanded_until FROM events WHERE href = ?;', ('forever.ics', ))[0][0]
+    assert watermark >= backend.aux.to_unix_time(datetime(2050, 1, 2))
+
+
+def test_expansion_with_writer_locked(tmpdir):
+    """queries beyond the saved instances don't wait for another process
+    holding the writer lock, they return the instances saved so far"""
+    dbpath = str(tmpdir) + '/khal.db'
+    dbi = backend.SQLiteDb([calname], dbpath, locale=LOCALE_BERLIN, horizon=10)
+    dbi.update(event_rrule_forever, href='forever.ics', calendar=calname)
+
+    def on(day):
+        return [event.summary for event in dbi.get_localized(
+            BERLIN.localize(datetime.combine(day, time.min)),
+            BERLIN.localize(datetime.combine(day, time.max)))]
+
+    holder = subprocess.Popen(
+        [sys.executable, '-c', 'import fcntl, sys\n'
+         'lockfile = open(sys.argv[1], "a")\n'
+         'fcntl.flock(lockfile, fcntl.LOCK_EX)\n'
+         'print("locked", flush=True)\n'
+         'sys.stdin.read()\n', dbpath + '.lock'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+        assert holder.stdout.readline() == b'locked\n'
+        assert on(date(2045, 6, 1)) == []
+    finally:
+        holder.stdin.close()
+        holder.wait()
+    # once the lock is free again, the instances are saved
+    assert on(date(2045, 6, 1)) == ['Daily']
+
+
+def test_concurrent_access(tmpdir):
+    dbpath = str(tmpdir) + '/khal.db'
+    writer = backend.SQLiteDb([calname], dbpath, locale=LOCALE_BERLIN)
+    reader = backend.SQLiteDb([calname], dbpath, locale=LOCALE_BERLIN, timeout=0)
+    assert writer.sql_ex('PRAGMA journal_mode;') == [('wal', )]
+    writer.update(_get_text('event_dt_simple'), href='12345.ics', calendar=calname)
+
+    def events():
+        return list(reader.get_localized(BERLIN.localize(datetime(2014, 4, 9, 0, 0)),
+                                         BERLIN.localize(datetime(2014, 4, 10, 0, 0))))
+
+    with writer.at_once():
+        writer.delete('12345.ics', calendar=calname)
+        # the reader is not blocked and sees the last committed state
+        assert len(events()) == 1
+    assert events() == []
+
+    with pytest.raises(sqlite3.OperationalError):
+        reader.query_conn.execute('DELETE FROM events;')
+
+
+def test_writer_lock(tmpdir):
+    dbpath = str(tmpdir) + '/khal.db'
+    dbi = backend.SQLiteDb([calname], dbpath, locale=LOCALE_BERLIN)
+    with open(dbpath + '.lock', 'a') as lockfile:
+        with dbi.writer_lock():
+            with pytest.raises(BlockingIOError):
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def test_shards(tmpdir, monkeypatch):
+    monkeypatch.setattr(backend, 'SEARCH_PAGE_SIZE', 2)
+    dbpath = str(tmpdir) + '/khal.db'
+    dbi = backend.SQLiteDb(['home', 'work'], dbpath, locale=LOCALE_BERLIN, shards=True)
+    for calendar in ['home', 'work']:
+        assert os.path.isfile(backend.shard_path(dbpath, calendar))
+        for num in range(3):
+            dbi.update(event_search_template.format(
+                uid='{0}{1}'.format(calendar, num), summary='Meeting', description='weekly'),
+                href='{0}.ics'.format(num), calendar=calendar)
+    assert sorted(dbi.list('home')) == [('0.ics', ''), ('1.ics', ''), ('2.ics', '')]
+    assert sorted(event.uid for event in dbi.search('meeting')) == \
+        ['home0', 'home1', 'home2', 'work0', 'work1', 'work2']
+
+    def events(dbi):
+        return sorted(event.uid for event in dbi.get_localized(
+            BERLIN.localize(datetime(2014, 4, 9, 0, 0)),
+            BERLIN.localize(datetime(2014, 4, 10, 0, 0))))
+
+    dbi.delete('0.ics', calendar='work')
+    assert events(dbi) == ['home0', 'home1', 'home2', 'work1', 'work2']
+
+    # only the shards of the calendars in use are attached
+    work = backend.SQLiteDb(['work'], dbpath, locale=LOCALE_BERLIN, shards=True)
+    assert [name for _, name, _ in work.sql_ex('PRAGMA database_list;')] == \
+        ['main', 'shard_0']
+    assert events(work) == ['work1', 'work2']
+    assert sorted(event.uid for event in work.search('meeting')) == ['work1', 'work2']
+
+    # each shard is locked on its own
+    with open(backend.shard_path(dbpath, 'home') + '.lock', 'a') as home, \
+            open(backend.shard_path(dbpath, 'work') + '.lock', 'a') as work:
+        with dbi.writer_lock(['home']):
+            with pytest.raises(BlockingIOError):
+                fcntl.flock(home, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(work, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(work, fcntl.LOCK_UN)
+
+    # dropping one shard leaves the others alone
+    dbi.close()
+    os.remove(backend.shard_path(dbpath, 'home'))
+    dbi = backend.SQLiteDb(['home', 'work'], dbpath, locale=LOCALE_BERLIN, shards=True)
+    assert dbi.list('home') == []
+    assert events(dbi) == ['work1', 'work2']
+
+
+def test_more_calendars_than_shards(tmpdir):
+    """SQLite can't attach more than 10 dbs, the calendars beyond MAX_SHARDS
+    are kept in the unsharded db"""
+    dbpath = str(tmpdir) + '/khal.db'
+    calendars = ['cal{0:02d}'.format(num) for num in range(backend.MAX_SHARDS + 2)]
+    dbi = backend.SQLiteDb(calendars, dbpath, locale=LOCALE_BERLIN, shards=True)
+    for calendar in calendars:
+        dbi.update(event_search_template.format(
+            uid=calendar, summary='Meeting', description='weekly'),
+            href='a.ics', calendar=calendar)
+    assert [name for _, name, _ in dbi.sql_ex('PRAGMA database_list;')] == \
+        ['main'] + ['shard_{0}'.format(num) for num in range(backend.MAX_SHARDS)]
+    assert os.path.isfile(backend.shard_path(dbpath, 'cal09'))
+    assert not os.path.exists(backend.shard_path(dbpath, 'cal10'))
+
+    def events(dbi):
+        return sorted(event.uid for event in dbi.get_localized(
+            BERLIN.localize(datetime(2014, 4, 9, 0, 0)),
+            BERLIN.localize(datetime(2014, 4, 10, 0, 0))))
+
+    assert events(dbi) == calendars
+    assert sorted(event.uid for event, _, _, _ in dbi.get_range(
+        datetime(2014, 4, 9, 0, 0), datetime(2014, 4, 10, 0, 0))) == calendars
+    assert sorted(event.uid for event in dbi.search('meeting')) == calendars
+    assert sorted(calendar for _, calendar in dbi.get_day_calendars(
+        date(2014, 4, 9), date(2014, 4, 9))) == calendars
+
+    # the unsharded db is locked like a shard
+    with open(dbpath + '.lock', 'a') as lockfile:
+        with dbi.writer_lock(['cal11']):
+            with pytest.raises(BlockingIOError):
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        with dbi.writer_lock(['cal00']):
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    dbi.close()
+    dbi = backend.SQLiteDb(calendars, dbpath, locale=LOCALE_BERLIN, shards=True)
+    assert events(dbi) == calendars
+
+
+# the layout of version 5 databases
+db_layout_5 = """
+CREATE TABLE version (version INTEGER);
+CREATE TABLE calendars (
+    calendar TEXT NOT NULL UNIQUE,
+    resource TEXT NOT NULL,
+    ctag TEXT
+    );
+CREATE TABLE events (
+    href TEXT NOT NULL,
+    calendar TEXT NOT NULL,
+    sequence INT,
+    etag TEXT,
+    item TEXT,
+    primary key (href, calendar)
+    );
+CREATE TABLE recs_loc (
+    dtstart INT NOT NULL,
+    dtend INT NOT NULL,
+    href TEXT NOT NULL REFERENCES events( href ),
+    rec_inst TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    dtype INT NOT NULL,
+    calendar TEXT NOT NULL,
+    primary key (href, rec_inst, calendar)
+    );
+CREATE TABLE recs_float (
+    dtstart INT NOT NULL,
+    dtend INT NOT NULL,
+    href TEXT NOT NULL REFERENCES events( href ),
+    rec_inst TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    dtype INT NOT NULL,
+    calendar TEXT NOT NULL,
+    primary key (href, rec_inst, calendar)
+    );
+INSERT INTO version (version) VALUES (5);
+"""
+
+
+def _create_db_5(dbpath):
+    """create a version 5 db at `dbpath` with some events in it"""
+    events = [
+        ('recuid.ics', _get_text('event_rrule_recuid').replace(
+            'SUMMARY:Arbeit\nRECURRENCE-ID', 'SUMMARY:Mehr Arbeit\nRECURRENCE-ID')),
+        ('forever.ics', event_rrule_forever),
+        ('unix.vcf', backend.prepare_birthday(card, 'unix.vcf', calname).item),
+        ('broken.ics', 'BEGIN:VCALENDAR\nBEGIN:VEVENT\nSUMMARY:broken'),
+    ]
+    conn = sqlite3.connect(dbpath)
+    conn.executescript(db_layout_5)
+    conn.execute("INSERT INTO calendars (calendar, resource) VALUES (?, '');", (calname, ))
+    for href, item in events:
+        conn.execute('INSERT INTO events (href, calendar, etag, item) VALUES (?, ?, ?, ?);',
+                     (href, calname, 'abcd', item))
+        if href == 'broken.ics':
+            continue
+        # version 5 expanded everything until 2037
+        prepared = backend.prepare(item, href, calname, BERLIN, datetime(2037, 12, 31))
+        for table, stuples, _ in prepared.instances:
+            conn.executemany(
+                'INSERT OR REPLACE INTO {0} (rec_inst, dtstart, dtend, ref, dtype, href, '
+                'calendar) VALUES (?, ?, ?, ?, ?, ?, ?);'.format(table),
+                [(str(rec_inst), start, end, backend._ref(ref), dtype, href, calname)
+                 for rec_inst, start, end, ref, dtype in stuples])
+    conn.commit()
+    conn.close()
+
+
+def test_migrate_from_5(tmpdir):
+    dbpath = str(tmpdir) + '/khal.db'
+    _create_db_5(dbpath)
+    dbi = backend.SQLiteDb([calname], dbpath, locale=LOCALE_BERLIN)
+    assert dbi.sql_ex('SELECT version FROM version;') == [(backend.DB_VERSION, )]
+    # birthdays are read again from their vcards
+    assert sorted(dbi.list(calname)) == [('forever.ics', 'abcd'), ('recuid.ics', 'abcd')]
+    assert dbi.sql_ex('SELECT href, expanded_until FROM events ORDER BY href;') == [
+        ('forever.ics', backend.aux.to_unix_time(datetime(2037, 12, 31))),
+        ('recuid.ics', None),
+    ]
+    assert dbi.get_files(calname) == dict()
+
+    def summaries(start, end):
+        return [event.summary for event, _, _, _ in dbi.get_range(start, end)]
+
+    assert [summary for summary in summaries(datetime(2014, 6, 30), datetime(2014, 7, 8))
+            if summary != 'Daily'] == ['Arbeit', 'Mehr Arbeit']
+    assert summaries(datetime(2016, 3, 11), datetime(2016, 3, 11, 23)) == ['Daily']
+    assert summaries(datetime(2050, 1, 1), datetime(2050, 1, 1, 23)) == ['Moved']
+    assert [event.uid for event in dbi.search('arbeit')] == ['event_rrule_recurrence_id']
+
+
+def test_migrate_failing(tmpdir, monkeypatch):
+    """if one step fails, the db is left as it was"""
+    dbpath = str(tmpdir) + '/khal.db'
+    _create_db_5(dbpath)
+
+    def dump():
+        conn = sqlite3.connect(dbpath)
+        try:
+            return list(conn.iterdump())
+        finally:
+            conn.close()
+
+    before = dump()
+
+    def fail(db):
+        raise ValueError('failing on purpose')
+
+    monkeypatch.setitem(backend.MIGRATIONS, 11, fail)
+    with pytest.raises(ValueError):
+        backend.SQLiteDb([calname], dbpath, locale=LOCALE_BERLIN)
+    assert dump() == before
+    monkeypatch.undo()
+    dbi = backend.SQLiteDb([calname], dbpath, locale=LOCALE_BERLIN)
+    assert dbi.sql_ex('SELECT version FROM version;') == [(backend.DB_VERSION, )]
+    assert sorted(dbi.list(calname)) == [('forever.ics', 'abcd'), ('recuid.ics', 'abcd')]
+
+
+def test_migrate_from_10(tmpdir):
+    dbpath = str(tmpdir) + '/khal.db'
+    conn = sqlite3.connect(dbpath)
+    conn.executescript(db_layout_5)
+
+    class Db(object):
+        def sql_ex(self, statement, stuple=()):
+            return conn.execute(statement, stuple).fetchall()
+
+    for step in range(5, 10):
+        backend.MIGRATIONS[step](Db())
+    conn.execute('UPDATE version SET version = 10;')
+    conn.execute("INSERT INTO calendars (calendar, resource) VALUES (?, '');", (calname, ))
+    item = _get_text('event_rrule_recuid').replace(
+        'SUMMARY:Arbeit\nRECURRENCE-ID', 'SUMMARY:Mehr Arbeit\nRECURRENCE-ID')
+    prepared = backend.prepare(item, 'recuid.ics', calname, BERLIN, datetime(2037, 12, 31))
+    conn.execute('INSERT INTO events (href, calendar, etag, item) VALUES (?, ?, ?, ?);',
+                 ('recuid.ics', calname, 'abcd', item))
+    for table, stuples, _ in prepared.instances:
+        conn.executemany(
+            'INSERT OR REPLACE INTO {0} (rec_inst, dtstart, dtend, ref, dtype, href, '
+            'calendar) VALUES (?, ?, ?, ?, ?, ?, ?);'.format(table),
+            [(str(rec_inst), start, end, backend._ref(ref), dtype, 'recuid.ics', calname)
+             for rec_inst, start, end, ref, dtype in stuples])
+    # these are copied, not parsed again
+    conn.executemany(
+        'INSERT INTO vevents (href, calendar, ref, uid, summary, location, description, '
+        'recurring, x_birthday, x_fname) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);',
+        [('recuid.ics', calname, backend._ref(props[0]), props[1], 'Copied ' + props[2]) +
+         props[3:] for props in prepared.props])
+    conn.execute('INSERT INTO events_fts (summary, description, location, attendees, href, '
+                 'calendar) VALUES (?, ?, ?, ?, ?, ?);',
+                 ('Copied', '', '', '', 'recuid.ics', calname))
+    conn.commit()
+    conn.close()
+
+    dbi = backend.SQLiteDb([calname], dbpath, locale=LOCALE_BERLIN)
+    assert dbi.sql_ex('SELECT version FROM version;') == [(backend.DB_VERSION, )]
+    assert dbi.list(calname) == [('recuid.ics', 'abcd')]
+    assert [event.summary for event, _, _, _ in
+            dbi.get_range(datetime(2014, 6, 30), datetime(2014, 7, 8))] == \
+        ['Copied Arbeit', 'Copied Mehr Arbeit']
+    assert [event.uid for event in dbi.search('copied')] == ['event_rrule_recurrence_id']
+    assert dbi.sql_ex("SELECT name FROM sqlite_master WHERE name LIKE '%_10';") == []
+
+
+def test_rebuild_old_db(tmpdir):
+    dbpath = str(tmpdir) + '/khal.db'
+    conn = sqlite3.connect(dbpath)
+    conn.executescript('CREATE TABLE version (version INTEGER);'
+                       'INSERT INTO version (version) VALUES (4);')
+    conn.commit()
+
+    dbi = backend.SQLiteDb([calname], dbpath, locale=LOCALE_BERLIN)
+    dbi.update(_get_text('event_dt_simple'), href='12345.ics', calendar=calname)
+    # other processes can still use the old db
+    assert conn.execute('SELECT version FROM version;').fetchall() == [(4, )]
+    assert len(os.listdir(str(tmpdir))) > 1
+
+    dbi.finish_rebuild()
+    assert conn.execute('SELECT version FROM version;').fetchall() == [(4, )]
+    conn.close()
+    assert sorted(os.listdir(str(tmpdir))) == ['khal.db', 'khal.db-shm', 'khal.db-wal']
+    conn = sqlite3.connect(dbpath)
+    assert conn.execute('SELECT version FROM version;').fetchall() == [(backend.DB_VERSION, )]
+    assert dbi.list(calname) == [('12345.ics', '')]
+    assert len(list(dbi.get_localized(BERLIN.localize(datetime(2014, 4, 9, 0, 0)),
+                                      BERLIN.localize(datetime(2014, 4, 10, 0, 0))))) == 1
+
+
+@pytest.mark.parametrize('name', ['event_rrule_recuid', 'event_dt_rr', 'event_d_rr',
+                                  'event_dt_floating', 'event_dt_duration'])
+def test_prepare_parsed_vevents(name):
+    """preparing already parsed VEVENTs is the same as parsing them again, and
+    leaves them untouched"""
+    item = _get_text(name)
+    event = Event.fromString(item, calendar=calname, locale=LOCALE_BERLIN)
+    vevents = list(event._vevents.values())
+    raw = event.raw
+    until = datetime(2037, 12, 31)
+    assert backend.prepare(item, 'a.ics', calname, BERLIN, until, vevents=vevents) == \
+        backend.prepare(item, 'a.ics', calname, BERLIN, until)
+    event._changed()
+    assert event.raw == raw
+
+
+def test_rendered():
+    dbi = backend.SQLiteDb([calname], ':memory:', locale=LOCALE_BERLIN)
+    today = date.today()
+    yesterday = today - timedelta(days=1)
+    instance = 'PROTO 2014-04-09T09:30:00+00:00'
+    dbi.set_rendered('a', [(calname, 'a.ics', instance, yesterday, 'abcd', None, ['one']),
+                           (calname, 'a.ics', instance, today, 'abcd', 'red', ['one', 'two'])])
+    assert dbi.get_rendered(yesterday, today, 'a') == {
+        (calname, 'a.ics', instance, yesterday): ('abcd', None, ['one']),
+        (calname, 'a.ics', instance, today): ('abcd', 'red', ['one', 'two']),
+    }
+    assert dbi.get_rendered(yesterday, today, 'b') == {}
+    dbi.set_rendered('b', [(calname, 'a.ics', instance, today, 'abcd', None, [])])
+    # the lines for days before today are dropped when the db is updated
+    dbi.prune_rendered([calname])
+    assert list(dbi.get_rendered(yesterday, today, 'a')) == [(calname, 'a.ics', instance, today)]
+    assert dbi.get_rendered(today, today, 'b') == {
+        (calname, 'a.ics', instance, today): ('abcd', None, [])}
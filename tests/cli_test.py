@@ -1,12 +1,16 @@
 import os
+import subprocess
 import sys
 import datetime
 from datetime import timedelta
 
+import click
 import pytest
 from click.testing import CliRunner
 
-from khal.cli import main_khal, main_ikhal
+from khal import cli, __version__
+from khal.cli import build_collection, main_khal, main_ikhal
+from khal.settings import get_config
 
 from .aux import _get_text
 
@@ -304,3 +308,74 @@ def test_interactive_command(runner, monkeypatch):
     result = runner.invoke(main_khal, ['interactive', '-a', 'one'])
     assert not result.exception
     assert result.output.strip() == token
+
+
+def test_answer(runner):
+    runner = runner(command='agenda', showalldays=False, days=2)
+    runner.calendars['one'].join('test.ics').write(_get_text('event_dt_simple'))
+    conf = get_config(str(runner.config))
+    collection = build_collection(click.Context(main_khal, obj={'conf': conf}))
+    request = {'version': __version__, 'color': False, 'encoding': 'utf-8',
+               'columns': 80, 'lines': 24}
+
+    def answer(*argv):
+        return cli.answer(main_khal, conf, collection, dict(request, argv=list(argv)))
+
+    assert answer('agenda', '09.04.2014') == (0, b'09.04.2014\n09:30-10:30: An Event\n', b'')
+    assert answer() == answer('agenda') == (0, b'No events\n', b'')
+    assert answer('agenda', '-a', 'two', '09.04.2014') == (0, b'No events\n', b'')
+    assert answer('agenda', '-a', 'three')[0] == 2
+    assert answer('new', '09.04.2014', 'Another Event') is None
+    # only the daemon's own configuration can be used
+    assert answer('-c', 'agenda', 'new', '09.04.2014', 'Another Event') is None
+    assert answer('--config=agenda', 'new') is None
+    assert answer('-c', 'other.conf', 'agenda') is None
+    assert answer('-v', 'agenda') == (0, b'No events\n', b'')
+    assert answer('nonsense') is None
+
+
+def test_printcalendars(runner):
+    runner = runner(command='agenda', showalldays=False, days=2)
+    result = runner.invoke(main_khal, ['printcalendars'])
+    assert not result.exception
+    assert sorted(result.output.split()) == ['one', 'two']
+    result = runner.invoke(main_khal, ['printcalendars', '-a', 'two'])
+    assert result.output == 'two\n'
+    # the db is not needed for this
+    assert not runner.db.check()
+
+
+def _imported(code):
+    """run `code` in a new interpreter
+
+    :returns: how long that took (in seconds) and the names of all modules
+        imported afterwards
+    """
+    script = ('import sys, time\n'
+              'start = time.time()\n'
+              '{0}\n'
+              'print(time.time() - start)\n'
+              'print(" ".join(sys.modules))\n').format(code)
+    output = subprocess.check_output([sys.executable, '-c', script]).decode('utf-8')
+    duration, modules = output.splitlines()[-2:]
+    return float(duration), modules.split()
+
+
+HEAVY_MODULES = ['icalendar', 'pytz', 'vdirsyncer', 'khal.khalendar', 'khal.controllers',
+                 'khal.calendar_display', 'khal.daemon', 'khal.client', 'socketserver']
+
+
+def test_startup_imports(runner):
+    runner = runner(command='agenda', showalldays=False, days=2)
+    duration, modules = _imported('import khal.cli')
+    assert set(HEAVY_MODULES).isdisjoint(modules)
+    # a generous budget, that catches importing most of khal again
+    controllers_duration, _ = _imported('import khal.controllers')
+    assert duration < controllers_duration / 2
+
+    for command in ['printcalendars', 'printformats']:
+        _, modules = _imported(
+            'from khal.cli import main_khal\n'
+            'main_khal(["-c", {0!r}, {1!r}], standalone_mode=False)'.format(
+                str(runner.config), command))
+        assert set(HEAVY_MODULES[2:]).isdisjoint(modules)
@@ -1,8 +1,13 @@
 import datetime
+import sqlite3
 from textwrap import dedent
 
+import pytest
 from vdirsyncer.storage.base import Item
-from khal.controllers import get_agenda, import_ics
+
+from khal.controllers import get_agenda, import_ics, consecutive_ranges
+from khal.khalendar import CalendarCollection
+from khal.khalendar.event import AllDayEvent
 
 from .aux import _get_text
 from . import aux
@@ -34,6 +39,42 @@ class TestGetAgenda(object):
         coll.new(event)
         assert ['\x1b[1mToday:\x1b[0m', '\x1b[34ma meeting\x1b[0m'] == get_agenda(coll, aux.locale)
 
+    def test_rendered_lines_are_reused(self, coll_vdirs, monkeypatch):
+        coll, vdirs = coll_vdirs
+        event = coll.new_event(event_today, aux.cal1)
+        coll.new(event)
+        agenda = get_agenda(coll, aux.locale)
+
+        def relative_to(self, day, full=False):
+            raise AssertionError('rendered again')
+
+        monkeypatch.setattr(AllDayEvent, 'relative_to', relative_to)
+        assert get_agenda(coll, aux.locale) == agenda
+        with pytest.raises(AssertionError):
+            get_agenda(coll, aux.locale, width=20)
+        monkeypatch.undo()
+
+        href = list(coll.get_events_on(today))[0].href
+        event = coll.get_event(href, aux.cal1)
+        event.update_summary('a longer meeting')
+        coll.update(event)
+        assert get_agenda(coll, aux.locale) == \
+            ['\x1b[1mToday:\x1b[0m', '\x1b[34ma longer meeting\x1b[0m']
+
+    def test_rendered_read_only(self, coll_vdirs, tmpdir, monkeypatch):
+        """the lines are rendered even if they cannot be saved"""
+        coll, _ = coll_vdirs
+        coll = CalendarCollection(calendars=coll._calendars, dbpath=str(tmpdir) + '/khal.db',
+                                  locale=aux.locale)
+        coll.new(coll.new_event(event_today, aux.cal1))
+        read_only = sqlite3.connect(
+            'file:{0}?mode=ro'.format(str(tmpdir) + '/khal.db'), uri=True)
+        monkeypatch.setattr(coll._backend, 'conn', read_only)
+        monkeypatch.setattr(coll._backend, 'cursor', read_only.cursor())
+        assert get_agenda(coll, aux.locale) == \
+            ['\x1b[1mToday:\x1b[0m', '\x1b[34ma meeting\x1b[0m']
+        assert coll._backend.sql_query('SELECT count(*) FROM rendered;') == [(0, )]
+
     def test_empty_recurrence(self, coll_vdirs):
         coll, vidrs = coll_vdirs
         coll.new(coll.new_event(dedent(
@@ -67,6 +108,10 @@ class TestImport(object):
         assert events[1].start_local == aux.BERLIN.localize(datetime.datetime(2014, 7, 7, 9, 0))
         assert aux.BERLIN.localize(datetime.datetime(2014, 7, 14, 7, 0)) in \
             [ev.start for ev in events]
+        items = [vdir.get(href)[0].raw for vdir in vdirs.values() for href, _ in vdir.list()]
+        assert len(items) == 1
+        assert items[0].count('BEGIN:VTIMEZONE') == 1
+        assert 'TZID:Europe/Berlin' in items[0]
 
         import_ics(coll, {'locale': aux.locale}, _get_text('event_rrule_recuid_update'),
                    batch=True)
@@ -76,3 +121,24 @@ class TestImport(object):
         assert len(events) == 5
         assert aux.BERLIN.localize(datetime.datetime(2014, 7, 14, 7, 0)) not in \
             [ev.start_local for ev in events]
+
+    def test_import_recuid_no_master(self, coll_vdirs):
+        """events made up of overwritten instances only are imported as well"""
+        coll, vdirs = coll_vdirs
+        import_ics(coll, {'locale': aux.locale}, _get_text('event_recuid_no_master'),
+                   batch=True)
+        items = [vdir.get(href)[0].raw for vdir in vdirs.values() for href, _ in vdir.list()]
+        assert len(items) == 1
+        assert items[0].count('RECURRENCE-ID') == 2
+        assert 'TZID:Europe/Berlin' in items[0]
+
+
+def test_consecutive_ranges():
+    day = datetime.date(2016, 2, 28)
+    days = [day + datetime.timedelta(days=one) for one in [0, 1, 2, 4, 6, 7]]
+    assert consecutive_ranges(days) == [
+        (day, datetime.date(2016, 3, 1)),
+        (datetime.date(2016, 3, 3), datetime.date(2016, 3, 3)),
+        (datetime.date(2016, 3, 5), datetime.date(2016, 3, 6)),
+    ]
+    assert consecutive_ranges([]) == []
@@ -0,0 +1,142 @@
+from datetime import date
+import os
+import socket
+import threading
+from time import sleep
+
+import pytest
+
+from vdirsyncer.storage.base import Item
+
+from khal import client, daemon
+from khal.khalendar import CalendarCollection
+
+from .aux import _get_text, cal1, cal2
+from . import aux
+
+
+def test_is_running(tmpdir):
+    dbpath = str(tmpdir) + '/khal.db'
+    assert not daemon.is_running(dbpath)
+    with daemon.running(dbpath):
+        assert daemon.is_running(dbpath)
+        with pytest.raises(daemon.DaemonRunning):
+            with daemon.running(dbpath):
+                pass
+    assert not daemon.is_running(dbpath)
+    assert not daemon.is_running(':memory:')
+
+
+def test_poll(monkeypatch):
+    monkeypatch.setattr(daemon.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(daemon, 'pyinotify', None)
+    changes = daemon.watch({cal2: '/cal2', cal1: '/cal1'})
+    assert next(changes) == [cal1, cal2]
+
+
+def test_run(coll_vdirs, tmpdir, monkeypatch):
+    coll, vdirs = coll_vdirs
+    dbpath = str(tmpdir) + '/khal.db'
+    updating = CalendarCollection(calendars=coll._calendars, dbpath=dbpath, locale=aux.locale)
+    seen = list()
+
+    def watch(paths, interval):
+        assert sorted(paths) == sorted(coll._calendars)
+        assert daemon.is_running(dbpath)
+        vdirs[cal1].upload(Item(_get_text('event_dt_simple')))
+        # other khal instances rely on the daemon to notice the change
+        other = CalendarCollection(calendars=coll._calendars, dbpath=dbpath,
+                                   locale=aux.locale, update=False)
+        seen.extend(event.summary for event in other.get_events_on(date(2014, 4, 9)))
+        yield [cal1]
+
+    monkeypatch.setattr(daemon, 'watch', watch)
+    daemon.run(updating, dbpath)
+    assert not daemon.is_running(dbpath)
+    assert seen == []
+    other = CalendarCollection(calendars=coll._calendars, dbpath=dbpath,
+                               locale=aux.locale, update=False)
+    assert [event.summary for event in other.get_events_on(date(2014, 4, 9))] == ['An Event']
+
+
+def test_serve(coll_vdirs, tmpdir, monkeypatch):
+    coll, _ = coll_vdirs
+    dbpath = str(tmpdir) + '/khal.db'
+    path = str(tmpdir) + '/khal.socket'
+    stop = threading.Event()
+
+    def watch(paths, interval):
+        stop.wait()
+        yield from ()
+
+    def answer(request):
+        if request['argv'] == ['new']:
+            return None
+        return 0, ' '.join(request['argv']).encode('utf-8'), b''
+
+    def serve():
+        # sqlite connections can only be used in the thread they were made in
+        collection = CalendarCollection(calendars=coll._calendars, dbpath=dbpath,
+                                        locale=aux.locale)
+        daemon.run(collection, dbpath, answer=answer, path=path)
+
+    monkeypatch.setattr(daemon, 'watch', watch)
+    assert client.request(['agenda'], path) is None
+    thread = threading.Thread(target=serve)
+    thread.start()
+    try:
+        for _ in range(100):
+            if os.path.exists(path):
+                break
+            sleep(0.01)
+        assert client.request(['agenda', 'today'], path) == (0, b'agenda today', b'')
+        assert client.request(['new'], path) is None
+        assert client.request(['-c', 'config', 'agenda'], path) is None
+    finally:
+        stop.set()
+        thread.join()
+    assert not os.path.exists(path)
+
+
+def test_serve_stalled_client(coll_vdirs, tmpdir, monkeypatch):
+    """a client which doesn't send its request doesn't block the others"""
+    coll, _ = coll_vdirs
+    dbpath = str(tmpdir) + '/khal.db'
+    path = str(tmpdir) + '/khal.socket'
+    stop = threading.Event()
+
+    def watch(paths, interval):
+        stop.wait()
+        yield from ()
+
+    def serve():
+        collection = CalendarCollection(calendars=coll._calendars, dbpath=dbpath,
+                                        locale=aux.locale)
+        daemon.run(collection, dbpath, answer=lambda request: (0, b'answered', b''),
+                   path=path)
+
+    assert daemon._Handler.timeout == daemon.REQUEST_TIMEOUT
+    monkeypatch.setattr(daemon, 'watch', watch)
+    monkeypatch.setattr(daemon._Handler, 'timeout', 0.1)
+    thread = threading.Thread(target=serve)
+    thread.start()
+    stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        for _ in range(100):
+            if os.path.exists(path):
+                break
+            sleep(0.01)
+        stalled.connect(path)
+        answers = list()
+        requesting = threading.Thread(
+            target=lambda: answers.append(client.request(['agenda'], path)))
+        requesting.daemon = True
+        requesting.start()
+        requesting.join(5)
+        assert answers == [(0, b'answered', b'')]
+        # the stalled client was dropped
+        assert stalled.recv(1) == b''
+    finally:
+        stalled.close()
+        stop.set()
+        thread.join()
@@ -5,7 +5,7 @@ import pytz
 
 from icalendar import vRecur
 
-from khal.khalendar.event import Event, AllDayEvent, LocalizedEvent, FloatingEvent
+from khal.khalendar.event import Event, AllDayEvent, LocalizedEvent, FloatingEvent, LightEvent
 
 from .aux import normalize_component, _get_text
 
@@ -70,6 +70,13 @@ def test_update_simple():
     assert normalize_component(event.raw) == normalize_component(event_updated.raw)
 
 
+def test_raw_cached():
+    event = Event.fromString(_get_text('event_dt_simple'), **EVENT_KWARGS)
+    assert event.raw is event.raw
+    event.update_summary('A not so simple Event')
+    assert 'SUMMARY:A not so simple Event' in event.raw.split('\r\n')
+
+
 def test_raw_d():
     event_d = _get_text('event_d')
     event = Event.fromString(event_d, **EVENT_KWARGS)
@@ -339,3 +346,55 @@ def test_remove_instance_from_recuid():
     event.delete_instance(BERLIN.localize(datetime(2014, 7, 7, 7, 0)))
     assert event.raw.split('\r\n').count('UID:event_rrule_recurrence_id') == 1
     assert 'EXDATE;TZID=Europe/Berlin:20140707T070000' in event.raw.split('\r\n')
+
+
+def test_sort_converts_once(monkeypatch):
+    """sorting events converts their start and end to local time only once"""
+    conversions = list()
+    to_local = LocalizedEvent._to_local
+
+    def counting(self, dtime):
+        conversions.append(dtime)
+        return to_local(self, dtime)
+
+    monkeypatch.setattr(LocalizedEvent, '_to_local', counting)
+    event_str = _get_text('event_dt_simple')
+    start = BOGOTA.localize(datetime(2014, 4, 9, 9, 30))
+    events = [Event.fromString(event_str, start=start + timedelta(hours=hours),
+                               end=start + timedelta(hours=hours + 1), **EVENT_KWARGS)
+              for hours in (4, 2, 7, 0, 1, 6, 3, 5)]
+    events.append(Event.fromString(_get_text('event_d'), **EVENT_KWARGS))
+    ordered = sorted(events)
+    assert isinstance(ordered[0], AllDayEvent)
+    assert [event.start_local.hour for event in ordered[1:]] == list(range(16, 24))
+    assert len(conversions) == 8
+
+    ordered[2].update_start_end(start, start + timedelta(hours=1))
+    assert ordered[2].start_local == BERLIN.localize(datetime(2014, 4, 9, 16, 30))
+
+
+@pytest.mark.parametrize('light', [False, True])
+def test_footprint(light):
+    """100k events (sharing their VEVENTs and locale) take up less than 256
+    bytes each"""
+    tracemalloc = pytest.importorskip('tracemalloc')
+    proto = Event.fromString(_get_text('event_dt_simple'), **EVENT_KWARGS)
+    start = BERLIN.localize(datetime(2014, 4, 9, 9, 30))
+    end = start + timedelta(hours=1)
+    props = ('V042MJ8B3SJNFXQOJL6P53OFMHJE8Z3VZWOU', 'An Event', '', '', 0, None, None)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        if light:
+            events = [LightEvent.create(list, props, locale=LOCALE, start=start, end=end)
+                      for _ in range(100000)]
+        else:
+            events = [LocalizedEvent(proto._vevents, ref='PROTO', locale=LOCALE,
+                                     start=start, end=end)
+                      for _ in range(100000)]
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    assert not hasattr(events[0], '__dict__')
+    assert events[0].relative_to(date(2014, 4, 9)) == '09:30-10:30: An Event'
+    assert used / len(events) < 256
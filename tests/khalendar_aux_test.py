@@ -599,6 +599,32 @@ class TestSpecial(object):
         assert dtstart[-1][0] == berlin.localize(
             datetime(2037, 12, 9, 19, 0))
 
+    def test_window(self):
+        dtstart = aux.expand(_get_vevent(another_problem), berlin,
+                             until=datetime(2014, 3, 1))
+        assert [start for start, _ in dtstart] == [
+            berlin.localize(datetime(2013, 11, 13, 19, 0)),
+            berlin.localize(datetime(2013, 12, 11, 19, 0)),
+            berlin.localize(datetime(2014, 1, 8, 19, 0)),
+            berlin.localize(datetime(2014, 2, 12, 19, 0)),
+        ]
+        dtstart = aux.expand(_get_vevent(another_problem), berlin,
+                             since=datetime(2040, 1, 1), until=datetime(2040, 3, 1))
+        assert [start for start, _ in dtstart] == [
+            berlin.localize(datetime(2040, 1, 11, 19, 0)),
+            berlin.localize(datetime(2040, 2, 8, 19, 0)),
+        ]
+        # bounded rules are always expanded completely
+        dtstart = aux.expand(_get_vevent(vevent_count), berlin,
+                             since=datetime(2040, 1, 1), until=datetime(2040, 3, 1))
+        assert len(dtstart) == 18
+
+    def test_window_before_start(self):
+        # no instances in the window, but the rule is fine
+        dtstart = aux.expand(_get_vevent(another_problem), berlin,
+                             until=datetime(2013, 1, 1))
+        assert dtstart == []
+
     def test_event_exdate_dt(self):
         """recurring event, one date excluded via EXCLUDE"""
         vevent = _get_vevent(event_exdate_dt)
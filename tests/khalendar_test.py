@@ -1,8 +1,10 @@
 from datetime import datetime, date, timedelta, time
 import os
+import shutil
 from time import sleep
 from textwrap import dedent
 
+import icalendar
 import pytest
 
 from vdirsyncer.storage.base import Item
@@ -68,26 +70,47 @@ class TestCalendar(object):
     def test_db_needs_update(self, coll_vdirs):
         coll, vdirs = coll_vdirs
 
-        print('init')
-        for calendar in coll._calendars:
-            print('{}: saved ctag: {}, vdir ctag: {}'.format(
-                calendar, coll._local_ctag(calendar), coll._backend.get_ctag(calendar)))
         assert len(list(vdirs[cal1].list())) == 0
         assert coll._needs_update(cal1) is False
         sleep(0.01)
 
-        vdirs[cal1].upload(item_today)
-        print('upload')
-        for calendar in coll._calendars:
-            print('{}: saved ctag: {}, vdir ctag: {}'.format(
-                calendar, coll._local_ctag(calendar), coll._backend.get_ctag(calendar)))
+        href, etag = vdirs[cal1].upload(item_today)
         assert len(list(vdirs[cal1].list())) == 1
         assert coll._needs_update(cal1) is True
         coll.update_db()
-        print('updated')
-        for calendar in coll._calendars:
-            print('{}: saved ctag: {}, vdir ctag: {}'.format(
-                calendar, coll._local_ctag(calendar), coll._backend.get_ctag(calendar)))
+        assert coll._needs_update(cal1) is False
+
+    def test_db_update_in_place_edit(self, coll_vdirs):
+        """editing a file without changing the vdir's mtime is noticed"""
+        coll, vdirs = coll_vdirs
+        href, etag = vdirs[cal1].upload(item_today)
+        coll.update_db()
+        assert [event.summary for event in coll.get_events_on(today)] == ['a meeting']
+        sleep(0.01)
+
+        dir_mtime = os.stat(vdirs[cal1].path).st_mtime_ns
+        with open(os.path.join(vdirs[cal1].path, href), 'w') as ics:
+            ics.write(event_today.replace('a meeting', 'another meeting'))
+        assert os.stat(vdirs[cal1].path).st_mtime_ns == dir_mtime
+        assert coll._needs_update(cal1) is True
+        coll.update_db()
+        assert [event.summary for event in coll.get_events_on(today)] == ['another meeting']
+
+    def test_db_update_reads_changed_files_only(self, coll_vdirs, monkeypatch):
+        coll, vdirs = coll_vdirs
+        coll.new(coll.new_event(event_today, cal1))
+        assert coll._needs_update(cal1) is False
+        updated = list()
+        monkeypatch.setattr(coll, '_update_vevent', lambda href, *args: updated.append(href))
+        coll.update_db()
+        # replacing a file with a copy changes its inode, but not its etag
+        href = list(coll._backend.get_etags(cal1))[0]
+        path = os.path.join(vdirs[cal1].path, href)
+        shutil.copy2(path, path + '.tmp')
+        os.rename(path + '.tmp', path)
+        assert coll._needs_update(cal1) is True
+        coll.update_db()
+        assert updated == []
         assert coll._needs_update(cal1) is False
 
 
@@ -228,6 +251,34 @@ class TestCollection(object):
         assert len(events) == 1
         assert events[0].summary == 'really simple event'
 
+    def test_save_without_parsing(self, coll_vdirs, monkeypatch):
+        """saving an Event neither parses nor serializes it again"""
+        coll, vdirs = coll_vdirs
+        event = Event.fromString(
+            _get_text('event_rrule_recuid'), calendar=cal1, locale=aux.locale)
+        raw = event.raw
+
+        def from_ical(*args, **kwargs):
+            raise AssertionError('parsed again')
+
+        monkeypatch.setattr(icalendar.Event, 'from_ical', from_ical)
+        coll.new(event, cal1)
+        assert event.raw is raw
+        monkeypatch.undo()
+
+        start = aux.BERLIN.localize(datetime(2014, 6, 30))
+        end = aux.BERLIN.localize(datetime(2014, 7, 15))
+        event = sorted(coll.get_localized(start, end))[0]
+        event.update_summary('Freizeit')
+        assert 'Freizeit' in event.raw
+        monkeypatch.setattr(icalendar.Event, 'from_ical', from_ical)
+        coll.update(event)
+        monkeypatch.undo()
+
+        events = sorted(coll.get_localized(start, end))
+        assert [event.summary for event in events] == ['Freizeit', 'Arbeit', 'Freizeit']
+        assert events[1].start_local == aux.BERLIN.localize(datetime(2014, 7, 7, 9))
+
     def test_newevent(self, coll_vdirs):
         coll, vdirs = coll_vdirs
         event = khal.aux.new_event(dtstart=aday, timezone=aux.BERLIN)
@@ -265,6 +316,63 @@ class TestCollection(object):
         assert len(list(coll.get_events_at(a_time))) == 1
         assert len(list(coll.get_events_at(b_time))) == 0
 
+    def test_get_events_between(self, coll_vdirs):
+        coll, vdirs = coll_vdirs
+        for name in ['event_dt_simple', 'event_dt_long', 'event_d_long', 'event_dt_rr']:
+            coll._backend.update(_get_text(name), href=name, calendar=cal1)
+        first, last = date(2014, 4, 7), date(2014, 4, 14)
+        days = coll.get_events_between(first, last)
+        assert [day for day, _ in days] == \
+            [first + timedelta(days=one) for one in range(8)]
+        for day, events in days:
+            assert set((event.href, event.start) for event in events) == \
+                set((event.href, event.start) for event in coll.get_events_on(day))
+            assert all(event.color == 'dark blue' for event in events)
+        assert [len(events) for _, events in days] == [0, 0, 4, 3, 3, 2, 1, 1]
+
+    def test_get_events_between_zero_length(self, coll_vdirs):
+        """an instance without a duration at midnight is on the day it starts"""
+        coll, vdirs = coll_vdirs
+        coll._backend.update(
+            _get_text('event_dt_simple').replace(
+                'DTEND;TZID=Europe/Berlin;VALUE=DATE-TIME:20140409T103000',
+                'DURATION:PT0S').replace('20140409T093000', '20140410T000000'),
+            href='zero', calendar=cal1)
+        first, last = date(2014, 4, 9), date(2014, 4, 11)
+        days = coll.get_events_between(first, last)
+        assert [len(events) for _, events in days] == [0, 1, 0]
+        assert [len(list(coll.get_events_on(day))) for day, _ in days] == [0, 1, 0]
+        assert [(day, [event.calendar for event in events]) for day, events in
+                coll.get_calendars_between(first, last)] == \
+            [(date(2014, 4, 9), []), (date(2014, 4, 10), [cal1]), (date(2014, 4, 11), [])]
+
+    def test_get_calendars_between(self, coll_vdirs):
+        coll, vdirs = coll_vdirs
+        for name in ['event_dt_simple', 'event_dt_long', 'event_dt_rr']:
+            coll._backend.update(_get_text(name), href=name, calendar=cal1)
+        coll._backend.update(_get_text('event_d_long'), href='event_d_long', calendar=cal2)
+        coll._backend.update_birthday(dedent("""
+            BEGIN:VCARD
+            VERSION:3.0
+            FN:Unix
+            BDAY:--0411
+            END:VCARD
+            """), 'unix.vcf', calendar=cal3)
+        first, last = date(2014, 4, 7), date(2014, 4, 14)
+        days = coll.get_calendars_between(first, last)
+        assert [day for day, _ in days] == \
+            [first + timedelta(days=one) for one in range(8)]
+        for day, calendars in days:
+            assert [calendar.calendar for calendar in calendars] == \
+                sorted(set(event.calendar for event in coll.get_events_on(day)))
+            assert all(calendar.color == 'dark blue' for calendar in calendars)
+        assert [calendar.calendar for calendar in dict(days)[date(2014, 4, 11)]] == \
+            sorted([cal1, cal2, cal3])
+        coll.highlight_event_days = True
+        coll.prepare_day_styles(first, last)
+        assert coll.get_day_styles(date(2014, 4, 7), False) is None
+        assert coll.get_day_styles(date(2014, 4, 14), False) == 'calendar ' + cal1
+
     def test_delete_two_events(self, coll_vdirs):
             """testing if we can delete any of two events in two different
             calendars with the same filename"""
@@ -360,9 +468,9 @@ def test_only_update_old_event(coll_vdirs, monkeypatch):
     old_update_vevent = coll._update_vevent
     updated_hrefs = []
 
-    def _update_vevent(href, calendar):
+    def _update_vevent(href, calendar, *args):
         updated_hrefs.append(href)
-        return old_update_vevent(href, calendar)
+        return old_update_vevent(href, calendar, *args)
     monkeypatch.setattr(coll, '_update_vevent', _update_vevent)
 
     href_three, etag_three = vdirs[cal1].upload(coll.new_event(dedent("""
@@ -379,3 +487,103 @@ def test_only_update_old_event(coll_vdirs, monkeypatch):
     coll.update_db()
     sleep(0.01)
     assert updated_hrefs == [href_three]
+
+
+def test_parallel_update(coll_vdirs, tmpdir, monkeypatch):
+    """updating with several workers gives the same result as without"""
+    coll, vdirs = coll_vdirs
+    for name in ['event_dt_simple', 'event_dt_rr', 'event_d_long', 'event_rrule_recuid']:
+        vdirs[cal1].upload(Item(_get_text(name).replace('UID:', 'UID:' + name)))
+    vdirs[cal2].upload(Item(dedent("""
+    BEGIN:VEVENT
+    UID:this-and-prior
+    SUMMARY:unsupported
+    RECURRENCE-ID;RANGE=THISANDPRIOR:20140707T050000Z
+    DTSTART;TZID=Europe/Berlin:20140707T090000
+    DTEND;TZID=Europe/Berlin:20140707T140000
+    END:VEVENT
+    """)))
+    # there are more files than the pipeline is deep and are written in several batches
+    monkeypatch.setattr(khal.khalendar.khalendar, 'PIPELINE_DEPTH', 2)
+    monkeypatch.setattr(khal.khalendar.khalendar, 'UPDATE_BATCH_SIZE', 3)
+    coll.update_db()
+
+    parallel = CalendarCollection(
+        calendars=coll._calendars, dbpath=str(tmpdir) + '/parallel.db', locale=aux.locale,
+        read_threads=3, parse_processes=2)
+
+    def contents(backend):
+        return [backend.sql_ex('SELECT * FROM {0} ORDER BY 1, 2, 3'.format(table))
+                for table in ['events', 'recs_loc', 'recs_float', 'vevents']]
+
+    assert len(coll._backend.list(cal1)) == 4
+    assert coll._backend.list(cal2) == []
+    assert contents(parallel._backend) == contents(coll._backend)
+
+
+def test_sharded_update(coll_vdirs, tmpdir):
+    """a sharded db holds the same events as an unsharded one"""
+    coll, vdirs = coll_vdirs
+    vdirs[cal1].upload(Item(_get_text('event_dt_simple')))
+    vdirs[cal2].upload(Item(_get_text('event_rrule_recuid')))
+    coll.update_db()
+
+    sharded = CalendarCollection(
+        calendars=coll._calendars, dbpath=str(tmpdir) + '/sharded.db', locale=aux.locale,
+        shards=True)
+    assert sharded._backend.list(cal1) == coll._backend.list(cal1)
+    assert sharded._backend.list(cal2) == coll._backend.list(cal2)
+
+    start, end = date(2014, 4, 9), date(2014, 7, 14)
+    assert [(day, [event.uid for event in events]) for day, events in
+            sharded.get_events_between(start, end)] == \
+        [(day, [event.uid for event in events]) for day, events in
+         coll.get_events_between(start, end)]
+    assert not sharded._needs_update(cal1)
+
+
+def test_referenced_items(coll_vdirs, tmpdir):
+    """events can be read from their files instead of being saved in the db"""
+    coll, vdirs = coll_vdirs
+    href, etag = vdirs[cal1].upload(Item(_get_text('event_dt_simple')))
+    dbpath = str(tmpdir) + '/khal.db'
+    referring = CalendarCollection(
+        calendars=coll._calendars, dbpath=dbpath, locale=aux.locale, store_items=False)
+    assert referring._backend.sql_ex('SELECT item FROM events;') == [(None, )]
+    assert referring.get_event(href, cal1).summary == 'An Event'
+    assert [event.summary for event in referring.get_events_on(aday)] == ['An Event']
+
+    # changed behind khal's back
+    sleep(0.01)
+    with open(os.path.join(vdirs[cal1].path, href), 'w') as ics:
+        ics.write(_get_text('event_dt_simple').replace('An Event', 'Another Event'))
+    assert [event.summary for event in referring.get_events_on(aday)] == ['Another Event']
+    # and saved again, without updating the db
+    assert referring._backend.sql_ex('SELECT summary FROM vevents;') == [('Another Event', )]
+    assert [event.summary for event in referring.search('Another')] == ['Another Event']
+    assert referring.get_event(href, cal1).etag == vdirs[cal1].get(href)[1]
+    assert not referring._needs_update(cal1)
+    referring.update_db()
+    assert referring.get_event(href, cal1).summary == 'Another Event'
+    referring._backend.close()
+
+    # once events are to be saved again, they are read again
+    copying = CalendarCollection(calendars=coll._calendars, dbpath=dbpath, locale=aux.locale)
+    assert copying._backend.sql_ex('SELECT count(*) FROM events WHERE item IS NULL;') == [(0, )]
+    assert copying.get_event(href, cal1).summary == 'Another Event'
+
+
+def test_referenced_item_deleted(coll_vdirs, tmpdir):
+    """events whose files were deleted since the last update are skipped"""
+    coll, vdirs = coll_vdirs
+    href, etag = vdirs[cal1].upload(Item(_get_text('event_dt_simple')))
+    vdirs[cal1].upload(Item(_get_text('event_dt_simple').replace(
+        'An Event', 'Another Event').replace('V042MJ8B3SJNFXQOJL6P53OFMHJE8Z3VZWOU', 'other')))
+    referring = CalendarCollection(
+        calendars=coll._calendars, dbpath=str(tmpdir) + '/khal.db', locale=aux.locale,
+        store_items=False)
+    os.remove(os.path.join(vdirs[cal1].path, href))
+    assert [event.summary for event in referring.get_events_on(aday)] == ['Another Event']
+    assert [event.summary for event in referring.search('Event')] == ['Another Event']
+    with pytest.raises(khal.khalendar.exceptions.ChangedFileError):
+        referring.get_event(href, cal1)
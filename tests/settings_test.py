@@ -22,7 +22,10 @@ class TestSettings(object):
                 'work': {'path': os.path.expanduser('~/.calendars/work/'),
                          'readonly': False, 'color': '', 'type': 'calendar'},
             },
-            'sqlite': {'path': os.path.expanduser('~/.local/share/khal/khal.db')},
+            'sqlite': {'path': os.path.expanduser('~/.local/share/khal/khal.db'),
+                       'horizon': 365, 'timeout': 5.0, 'retries': 3,
+                       'read_threads': 1, 'parse_processes': 1, 'shards': False,
+                       'store_items': True},
             'locale': {
                 'local_timezone': pytz.timezone('Europe/Berlin'),
                 'default_timezone': pytz.timezone('Europe/Berlin'),
@@ -62,7 +65,10 @@ class TestSettings(object):
                 'work': {'path': os.path.expanduser('~/.calendars/work/'),
                          'readonly': True, 'color': '',
                          'type': 'calendar'}},
-            'sqlite': {'path': os.path.expanduser('~/.local/share/khal/khal.db')},
+            'sqlite': {'path': os.path.expanduser('~/.local/share/khal/khal.db'),
+                       'horizon': 365, 'timeout': 5.0, 'retries': 3,
+                       'read_threads': 1, 'parse_processes': 1, 'shards': False,
+                       'store_items': True},
             'locale': {
                 'local_timezone': get_localzone(),
                 'default_timezone': get_localzone(),
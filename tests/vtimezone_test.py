@@ -1,5 +1,6 @@
-from datetime import datetime as datetime
+from datetime import datetime as datetime, timedelta
 import pytz
+from khal.khalendar import event
 from khal.khalendar.event import create_timezone
 
 berlin = pytz.timezone('Europe/Berlin')
@@ -73,3 +74,22 @@ def test_bogota():
                b'END:VTIMEZONE',
                b'']
     assert create_timezone(bogota, atime, atime).to_ical().split(b'\r\n') == vbogota
+
+
+def test_cached():
+    """VTIMEZONEs including the same transitions are only created once"""
+    vberlin = create_timezone(berlin, atime, atime)
+    later = atime + timedelta(days=1)
+    assert create_timezone(berlin, later, later) is vberlin
+    assert create_timezone(berlin, atime, later) is vberlin
+    assert create_timezone(berlin, atime, btime) is not vberlin
+    assert create_timezone(bogota, atime, atime) is not vberlin
+
+
+def test_cache_bounded():
+    """only the most recently used VTIMEZONEs are kept"""
+    for num in range(event.VTIMEZONE_CACHE_SIZE + 10):
+        day = datetime(1981, 1, 1) + timedelta(days=182 * num)
+        create_timezone(berlin, day, day)
+    info = event._cached_timezone.cache_info()
+    assert info.currsize == info.maxsize == event.VTIMEZONE_CACHE_SIZE